@@ -7,19 +7,60 @@ from orbit.teapot import teapot, TEAPOT_Lattice
 from orbit.utils import helper_funcs as hf
 
 
+class OrbitTracer:
+    """Trace single-particle orbits through a lattice.
+
+    Bunch monitors are added to the lattice once, when the tracer is
+    created, so the lattice can be traced any number of times. All initial
+    orbits passed to `trace` are tracked together in one bunch.
+
+    Attributes
+    ----------
+    positions : ndarray, shape (n_positions,)
+        Position of each monitor in the lattice [m].
+    """
+    def __init__(self, lattice, mass, kin_energy):
+        self.lattice = lattice
+        self.mass = mass
+        self.kin_energy = kin_energy
+        self.monitors = add_analysis_nodes(lattice, kind='bunch_monitor')
+        self.positions = np.array([node.position for node in self.monitors])
+
+    def trace(self, init_coords):
+        """Return the orbits at each monitor.
+
+        Parameters
+        ----------
+        init_coords : ndarray, shape (n_orbits, 4) or (4,)
+            Initial [x, x', y, y'] of each orbit [m, rad].
+
+        Returns
+        -------
+        ndarray, shape (n_orbits, n_positions, 4) or (n_positions, 4)
+            Coordinates at each monitor [mm, mrad].
+        """
+        init_coords = np.asarray(init_coords, dtype=float)
+        single = init_coords.ndim == 1
+        init_coords = np.atleast_2d(init_coords)
+        bunch_, params_dict_ = hf.initialize_bunch(self.mass, self.kin_energy)
+        for x, xp, y, yp in init_coords[:, :4]:
+            bunch_.addParticle(x, xp, y, yp, 0.0, 0.0)
+        self.lattice.trackBunch(bunch_, params_dict_)
+        coords = np.zeros((len(init_coords), len(self.monitors), 4))
+        for j, node in enumerate(self.monitors):
+            coords[:, j, :] = np.asarray(node.get_data('bunch_coords'))[:, :4]
+            node.clear_data()
+        return coords[0] if single else coords
+
+
 def get_traj(lattice, init_coords, mass, kin_energy):
-    """Return single particle trajectory through lattice."""
-    bunch_, params_dict_ = hf.initialize_bunch(mass, kin_energy)
-    x, xp, y, yp = init_coords
-    bunch_.addParticle(x, xp, y, yp, 0.0, 0.0)
-    monitors = add_analysis_nodes(lattice, kind='bunch_monitor')
-    lattice.trackBunch(bunch_, params_dict_)
-    coords, positions = [], []
-    for node in monitors:
-        coords.append(node.get_data('bunch_coords')[0])
-        positions.append(node.position)
-        node.clear_data()
-    return np.array(coords), np.array(positions)
+    """Return single particle trajectory through lattice.
+    
+    Adds monitors to the lattice on every call; use `OrbitTracer` to trace
+    the same lattice more than once.
+    """
+    tracer = OrbitTracer(lattice, mass, kin_energy)
+    return tracer.trace(init_coords), tracer.positions
 
 
 def track_part(lattice, init_coords, mass, kin_energy):
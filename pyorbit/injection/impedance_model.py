@@ -0,0 +1,134 @@
+"""Longitudinal impedance tables for the SNS ring.
+
+The tables are complex arrays of Z(n)/n [Ohms] at harmonics n = 1, 2, ...,
+stored under a name in an `ImpedanceModel`. Combinations such as the SNS
+extraction-kicker plus RF impedance are computed with vectorized NumPy
+operations and memoized, so parameter sweeps do not rebuild them. The
+tables can be saved to and loaded from a single compressed .npz file.
+"""
+import os
+
+import numpy as np
+
+
+# SNS Longitudinal Impedance tables. EKicker impedance from private
+# communication with J.G. Wang. Seems to be for 7 of the 14 kickers
+# (not sure why). Impedance in Ohms/n. Kicker and RF impedances are
+# inductive with real part positive and imaginary is negative by Chao
+# definition.
+ZL_EKICKER = np.array([
+    42.0 - 182.0j, 35.0 - 101.5j, 30.3333 - 74.6667j, 31.5 - 66.5j,
+    32.2 - 57.4j, 31.5 - 51.333j, 31.0 - 49.0j, 31.5 - 46.375j,
+    31.8889 - 43.556j, 32.9 - 40.6j, 32.7273 - 38.18j, 32.25 - 35.58j,
+    34.46 - 32.846j, 35.0 - 30.5j, 35.4667 - 28.0j, 36.75 - 25.81j,
+    36.647 - 23.88j, 36.944 - 21.1667j, 36.474 - 20.263j, 36.4 - 18.55j,
+    35.333 - 17.0j, 35.0 - 14.95j, 33.478 - 13.69j, 32.375 - 11.67j,
+    30.8 - 10.08j, 29.615 - 8.077j, 28.519 - 6.74j, 27.5 - 5.0j,
+    26.552 - 4.103j, 25.433 - 3.266j, 24.3871 - 2.7j, 23.40625 - 2.18j,
+])
+ZL_RF = np.array([
+    0.0, 0.750, 0.333, 0.250, 0.200, 0.167, 3.214, 0.188,
+    0.167, 0.150, 1.000, 0.125, 0.115, 0.143, 0.333, 0.313,
+    0.294, 0.278, 0.263, 0.250, 0.714, 0.682, 0.652, 0.625,
+    0.600, 0.577, 0.536, 0.536, 0.517, 0.500, 0.484, 0.469,
+], dtype=complex)
+
+# Only 7 of the 14 extraction kickers are included in ZL_EKICKER.
+EKICKER_SCALE = 1.0 / 1.75
+
+
+class ImpedanceModel:
+    """Named impedance tables and memoized combinations of them.
+
+    Attributes
+    ----------
+    tables : dict[str, ndarray]
+        Complex impedance arrays, all with the same length.
+    """
+    def __init__(self, tables=None):
+        if tables is None:
+            tables = {'ekicker': ZL_EKICKER, 'rf': ZL_RF}
+        self.tables = dict()
+        for name, Z in tables.items():
+            self.tables[name] = np.asarray(Z, dtype=complex)
+            self.tables[name].setflags(write=False)
+        self._cache = dict()
+
+    @classmethod
+    def load(cls, filename):
+        """Load tables from an .npz file written by `save`."""
+        npz_file = np.load(filename)
+        return cls({name: npz_file[name] for name in npz_file.files})
+
+    def save(self, filename):
+        """Save the tables to a compressed .npz file."""
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.savez_compressed(filename, **self.tables)
+
+    def combine(self, **scales):
+        """Return sum of scale * table over the named tables (memoized).
+
+        Example: `model.combine(ekicker=EKICKER_SCALE, rf=1.0)`. The
+        returned array is read-only and shared between calls.
+        """
+        key = tuple(sorted(scales.items()))
+        if key not in self._cache:
+            Z = np.zeros(self.n_harmonics(), dtype=complex)
+            for name, scale in key:
+                Z += scale * self.tables[name]
+            Z.setflags(write=False)
+            self._cache[key] = Z
+        return self._cache[key]
+
+    def n_harmonics(self):
+        return len(next(iter(self.tables.values())))
+
+    def sns_longitudinal(self, scale=1.0):
+        """Return the SNS ring impedance (extraction kickers + RF) times `scale`."""
+        return self.combine(ekicker=scale * EKICKER_SCALE, rf=scale)
+
+
+_zeros = dict()
+
+
+def zero_impedance(n_harmonics=32):
+    """Return a (memoized, read-only) table of zeros."""
+    if n_harmonics not in _zeros:
+        Z = np.zeros(n_harmonics, dtype=complex)
+        Z.setflags(write=False)
+        _zeros[n_harmonics] = Z
+    return _zeros[n_harmonics]
+
+
+def as_list(Z):
+    """Convert a table to the list of complex numbers used by PyORBIT nodes."""
+    return [complex(z) for z in Z]
+
+
+_models = dict()
+
+
+def _same_tables(model, other):
+    return (sorted(model.tables) == sorted(other.tables)
+            and all(np.array_equal(model.tables[name], other.tables[name])
+                    for name in model.tables))
+
+
+def get_model(filename=None):
+    """Return a shared `ImpedanceModel` (one per file) of the built-in tables.
+
+    The model is always built from the built-in SNS tables. If `filename`
+    is given, it is used as a cache: it is (re)written whenever it does not
+    hold exactly these tables, so edits to `ZL_EKICKER` or `ZL_RF` are never
+    hidden by an old file. Use `ImpedanceModel.load` to read other tables.
+    """
+    if filename not in _models:
+        model = ImpedanceModel()
+        if filename is not None:
+            if not (os.path.isfile(filename)
+                    and _same_tables(model, ImpedanceModel.load(filename))):
+                model.save(filename)
+        _models[filename] = model
+    return _models[filename]
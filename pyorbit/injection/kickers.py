@@ -0,0 +1,178 @@
+"""Linear-response solver for the SNS injection kickers.
+
+The orbit through the injection region is linear in the kicker angles and in
+the coordinates at the foil. For each half of the injection region, the
+coordinates at the end of the region are
+
+    coords_out = M * inj_coords + R * angles + c,
+
+where M is the 4x4 transfer matrix of the region, R is the 4x4 response
+matrix of its four kickers and c is the output with zero input. These are
+measured once by tracking single particles (central differences). Kicker
+angles for any target coordinates at the foil are then found by a bounded
+linear solve (coords_out = 0) instead of a tracking-based optimization.
+
+The right half of the region is tracked forward from 'inj_mid' to
+'inj_end'; the left half is tracked backward from s = 0 to 'inj_start', so
+the slopes of the target coordinates change sign.
+"""
+import numpy as np
+import numpy.linalg as la
+import scipy.optimize as opt
+
+from orbit.utils import helper_funcs as hf
+
+from helpers import track_part
+
+
+class InjectionKickers:
+    """Injection kicker settings from the linear orbit response.
+
+    Attributes
+    ----------
+    nodes : list[AccNode]
+        The kicker nodes (the first four are in the left half of the
+        injection region, the last four in the right half).
+    param_names : list[str]
+        The parameter ('kx' or 'ky') of each kicker.
+    min_angles, max_angles : ndarray, shape (8,)
+        Kicker angle limits [rad].
+    M, R, c : dict
+        The transfer matrix, kicker response matrix and offset of each
+        region ('left', 'right'). See the module docstring.
+    """
+    regions = {'left': slice(0, 4), 'right': slice(4, 8)}
+
+    def __init__(self, ring, mass, kin_energy, kicker_names, kicker_param_names,
+                 min_angles, max_angles, delta_coords=1e-5, delta_angle=1e-5):
+        self.ring = ring
+        self.mass = mass
+        self.kin_energy = kin_energy
+        self.nodes = [ring.getNodeForName(name) for name in kicker_names]
+        self.param_names = list(kicker_param_names)
+        self.min_angles = np.asarray(min_angles, dtype=float)
+        self.max_angles = np.asarray(max_angles, dtype=float)
+        self.M, self.R, self.c = dict(), dict(), dict()
+        saved_angles = self.get_angles()
+        self.set_angles(np.zeros(8))
+        for region in ['right', 'left']:
+            self.M[region], self.R[region], self.c[region] = self._response(
+                region, delta_coords, delta_angle)
+        self.set_angles(saved_angles)
+
+    def set_angles(self, angles, region='all'):
+        """Set kicker angles in one half of the injection region."""
+        lo, hi = 0, 8
+        if region != 'all':
+            lo, hi = self.regions[region].start, self.regions[region].stop
+        for node, param_name, angle in zip(self.nodes[lo:hi], self.param_names[lo:hi], angles):
+            node.setParam(param_name, angle)
+
+    def get_angles(self):
+        return np.array([node.getParam(param)
+                         for node, param in zip(self.nodes, self.param_names)])
+
+    def _sublattice(self, region):
+        if region == 'right':
+            return hf.get_sublattice(self.ring, 'inj_mid', 'inj_end')
+        sublattice = hf.get_sublattice(self.ring, 'inj_start', None)
+        sublattice.reverseOrder() # track backwards from s = 0
+        return sublattice
+
+    def _response(self, region, delta_coords, delta_angle):
+        """Measure (M, R, c) of one region by tracking single particles."""
+        sublattice = self._sublattice(region)
+
+        def track(coords, angles):
+            self.set_angles(angles, region)
+            return np.array(track_part(sublattice, coords, self.mass, self.kin_energy))
+
+        zeros = np.zeros(4)
+        c = track(zeros, zeros)
+        M, R = np.zeros((4, 4)), np.zeros((4, 4))
+        for j in range(4):
+            step = np.zeros(4)
+            step[j] = delta_coords
+            M[:, j] = (track(step, zeros) - track(-step, zeros)) / (2 * delta_coords)
+            step[j] = delta_angle
+            R[:, j] = (track(zeros, step) - track(zeros, -step)) / (2 * delta_angle)
+        self.set_angles(zeros, region)
+        if region == 'left':
+            sublattice.reverseOrder() # restore the node order
+        return M, R, c
+
+    def _region_coords(self, inj_coords, region):
+        """Return the initial coordinates for tracking through `region`."""
+        coords = np.array(inj_coords, dtype=float)
+        if region == 'left':
+            coords[..., [1, 3]] *= -1 # initial slopes change sign
+        return coords
+
+    def solve(self, inj_coords, **kws):
+        """Return kicker angles which put the closed orbit at `inj_coords`.
+
+        Parameters
+        ----------
+        inj_coords : ndarray, shape (..., 4)
+            Target [x, x', y, y'] at s = 0. Any number of targets (for
+            example, one per turn) are solved at once.
+        **kws
+            Key word arguments passed to scipy.optimize.lsq_linear, which is
+            only called for targets whose unconstrained solution violates
+            the kicker limits.
+
+        Returns
+        -------
+        ndarray, shape (..., 8)
+        """
+        inj_coords = np.asarray(inj_coords, dtype=float)
+        angles = np.zeros(inj_coords.shape[:-1] + (8,))
+        for region, idx in self.regions.items():
+            M, R, c = self.M[region], self.R[region], self.c[region]
+            lb, ub = self.min_angles[idx], self.max_angles[idx]
+            coords = self._region_coords(inj_coords, region)
+            b = -(np.matmul(coords, M.T) + c) # required kicker contribution
+            flat_b = b.reshape(-1, 4)
+            sol = la.solve(R, flat_b.T).T
+            bad, = np.where(np.any((sol < lb) | (sol > ub), axis=1))
+            for k in bad:
+                sol[k] = opt.lsq_linear(R, flat_b[k], bounds=(lb, ub), **kws).x
+            angles[..., idx] = sol.reshape(b.shape)
+        return angles
+
+    def residuals(self, inj_coords, angles):
+        """Return the predicted coordinates outside each half of the region.
+
+        Returns
+        -------
+        ndarray, shape (..., 2, 4)
+            The coordinates at 'inj_start' (left) and 'inj_end' (right),
+            which should be zero.
+        """
+        inj_coords = np.asarray(inj_coords, dtype=float)
+        angles = np.asarray(angles, dtype=float)
+        out = []
+        for region in ['left', 'right']:
+            idx = self.regions[region]
+            coords = self._region_coords(inj_coords, region)
+            out.append(np.matmul(coords, self.M[region].T)
+                       + np.matmul(angles[..., idx], self.R[region].T)
+                       + self.c[region])
+        return np.stack(out, axis=-2)
+
+    def track_residuals(self, inj_coords, angles):
+        """Return the tracked coordinates outside each half of the region.
+
+        Used to check the linear model for a single target.
+        """
+        saved_angles = self.get_angles()
+        out = []
+        for region in ['left', 'right']:
+            sublattice = self._sublattice(region)
+            self.set_angles(np.asarray(angles)[self.regions[region]], region)
+            coords = self._region_coords(inj_coords, region)
+            out.append(track_part(sublattice, coords, self.mass, self.kin_energy))
+            if region == 'left':
+                sublattice.reverseOrder()
+        self.set_angles(saved_angles)
+        return np.array(out)
@@ -21,7 +21,8 @@ from orbit.teapot import teapot, TEAPOT_Lattice, DriftTEAPOT
 from orbit.time_dep import time_dep
 from orbit.utils import helper_funcs as hf
 
-from helpers import get_traj, get_part_coords, track_part
+from helpers import OrbitTracer, get_part_coords, track_part
+from kickers import InjectionKickers
 
 sys.path.append('/Users/46h/Research/code/accphys/tools')
 from utils import delete_files_not_folders
@@ -59,7 +60,6 @@ ring_length = ring.getLength()
 kicker_names = ['ikickh_a10', 'ikickv_a10', 'ikickh_a11', 'ikickv_a11',
                 'ikickv_a12', 'ikickh_a12', 'ikickv_a13', 'ikickh_a13']
 kicker_param_names = ['kx', 'ky', 'kx', 'ky', 'ky', 'kx', 'ky', 'kx']
-kicker_nodes = [ring.getNodeForName(name) for name in kicker_names]
 
 # Maximum injection kicker angles at 1 GeV kinetic energy [mrad]
 min_kicker_angles = 1.15 * np.array([0.0, 0.0, -7.13, -7.13, -7.13, -7.13, 0.0, 0.0])
@@ -79,58 +79,36 @@ artificial_increase_factor = 1.5
 min_kicker_angles *= artificial_increase_factor
 max_kicker_angles *= artificial_increase_factor
 
+kickers = InjectionKickers(ring, mass, kin_energy, kicker_names,
+                           kicker_param_names, min_kicker_angles,
+                           max_kicker_angles)
+
 def set_kicker_angles(angles, region='all'):
     """Set kicker angles in one half of the injection region."""
-    if region == 'left':
-        lo, hi = 0, 4
-    elif region == 'right':
-        lo, hi = 4, 8
-    elif region == 'all':
-        lo, hi = 0, 8
-    for node, param_name, angle in zip(kicker_nodes[lo:hi], kicker_param_names[lo:hi], angles):
-        node.setParam(param_name, angle)
+    kickers.set_angles(angles, region)
         
 def get_kicker_angles():
-    return [node.getParam(param) for node, param in zip(kicker_nodes, kicker_param_names)]
+    return kickers.get_angles()
 
 def optimize_kickers(inj_coords, **kws):
     """Ensure closed orbit at s = 0 has [x, x', y, y'] = inj_coords.""" 
-    kicker_angles = []
-    for region in ['right', 'left']:
-        if region == 'right':
-            sublattice = hf.get_sublattice(ring, 'inj_mid', 'inj_end')
-            lb = min_kicker_angles[4:]
-            ub = max_kicker_angles[4:]
-        elif region == 'left':
-            sublattice = hf.get_sublattice(ring, 'inj_start', None)
-            sublattice.reverseOrder() # track backwards from s = 0 
-            inj_coords[[1, 3]] *= -1 # initial slopes therefore change sign
-            lb = min_kicker_angles[:4]
-            ub = max_kicker_angles[:4]
-            
-        def penalty(angles):
-            set_kicker_angles(angles, region)
-            coords_outside_inj = track_part(sublattice, inj_coords, mass, kin_energy)
-            return 1e6 * sum(np.square(coords_outside_inj))
-        
-        guess = np.zeros(4)
-        result = opt.least_squares(penalty, guess, bounds=(lb, ub), **kws)
-        kicker_angles[:0] = result.x    
-    return np.array(kicker_angles)
+    return kickers.solve(inj_coords, **kws)
 
 print 'Optimizing injection kickers.'
-kws = dict(max_nfev=10000, verbose=1)
-kicker_angles_t0 = optimize_kickers(inj_coords_t0, **kws)  
-kicker_angles_t1 = optimize_kickers(inj_coords_t1, **kws)  
+kicker_angles_t0 = optimize_kickers(inj_coords_t0)  
+kicker_angles_t1 = optimize_kickers(inj_coords_t1)  
 
 # Save initial/final closed orbit trajectory 
 ring.split(0.01)
 inj_region1 = hf.get_sublattice(ring, 'inj_start', None)
 inj_region2 = hf.get_sublattice(ring, 'inj_mid', 'inj_end')
+tracer1 = OrbitTracer(inj_region1, mass, kin_energy)
+tracer2 = OrbitTracer(inj_region2, mass, kin_energy)
+positions1, positions2 = tracer1.positions, tracer2.positions
 for i, kicker_angles in enumerate([kicker_angles_t0, kicker_angles_t1]):
     set_kicker_angles(kicker_angles)
-    coords1, positions1 = get_traj(inj_region1, [0, 0, 0, 0], mass, kin_energy)
-    coords2, positions2 = get_traj(inj_region2, 1e-3 * coords1[-1], mass, kin_energy)
+    coords1 = tracer1.trace([0, 0, 0, 0])
+    coords2 = tracer2.trace(1e-3 * coords1[-1])
     coords = np.vstack([coords1, coords2])
     positions = np.hstack([positions1, positions2 + positions1[-1]])
     np.save('_output/data/inj_region_coords_t{}.npy'.format(i), coords)
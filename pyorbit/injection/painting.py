@@ -0,0 +1,155 @@
+"""Time-dependent painting schedules for the injection kickers.
+
+A painting schedule gives the target closed-orbit coordinates at the foil
+as a function of time. `PaintingSchedule` solves for the kicker angles on a
+fine time grid covering the injection period (one vectorized call to
+`InjectionKickers.solve`), caches the table on disk, and returns linearly
+interpolated angles at any time in O(1). `TableWaveform` feeds the table to
+a `TIME_DEP_Lattice` in place of `SquareRootWaveform`/`ConstantWaveform`.
+
+The cache is keyed by the lattice file contents, the kinetic energy, the
+kicker limits and the schedule parameters.
+"""
+import os
+
+import numpy as np
+
+from tools.cache import hash_items, makedirs
+
+
+def linear_paint(frac):
+    """Painting fraction for a linear waveform."""
+    return frac
+
+
+def sqrt_paint(frac):
+    """Painting fraction for a square-root waveform (uniform density)."""
+    return np.sqrt(frac)
+
+
+paint_shapes = {'linear': linear_paint, 'sqrt': sqrt_paint}
+
+
+class PaintingSchedule:
+    """Table of kicker angles over the injection period.
+
+    The target coordinates at time t are
+    inj_coords_t0 + f((t - t0) / (t1 - t0)) * (inj_coords_t1 - inj_coords_t0),
+    where f is the painting shape. Before t0 and after t1 the coordinates
+    are held at their end values.
+
+    Attributes
+    ----------
+    times : ndarray, shape (n_steps,)
+        Evenly spaced times from t0 to t1 [s].
+    inj_coords : ndarray, shape (n_steps, 4)
+        Target [x, x', y, y'] at s = 0 at each time.
+    angles : ndarray, shape (n_steps, 8)
+        Kicker angles at each time [rad].
+    """
+    def __init__(self, kickers, inj_coords_t0, inj_coords_t1, t0, t1,
+                 shape='sqrt', n_steps=1001, latfile=None, cache_dir=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        kickers : InjectionKickers
+            Linear kicker solver for the ring.
+        inj_coords_t0, inj_coords_t1 : ndarray, shape (4,)
+            Target coordinates at the start and end of painting.
+        t0, t1 : float
+            Start and end of painting [s].
+        shape : str or callable
+            Painting shape f(frac), with f(0) = 0 and f(1) = 1. Either a
+            key of `paint_shapes` or a function acting on arrays.
+        n_steps : int
+            Number of times in the table.
+        latfile : str
+            Lattice file, used in the cache key. Required for caching.
+        cache_dir : str or None
+            Directory of the cached tables. If None, nothing is cached.
+        """
+        self.kickers = kickers
+        self.inj_coords_t0 = np.asarray(inj_coords_t0, dtype=float)
+        self.inj_coords_t1 = np.asarray(inj_coords_t1, dtype=float)
+        self.t0, self.t1 = float(t0), float(t1)
+        self.shape = paint_shapes[shape] if shape in paint_shapes else shape
+        self.times = np.linspace(self.t0, self.t1, n_steps)
+        self.dt = self.times[1] - self.times[0]
+        self.inj_coords = self.get_inj_coords(self.times)
+
+        filename = None
+        if cache_dir is not None and latfile is not None:
+            filename = os.path.join(cache_dir, 'kicker_table_{}.npy'.format(
+                self.cache_key(latfile, shape)))
+        if filename is not None and os.path.isfile(filename):
+            self.angles = np.load(filename)
+        else:
+            self.angles = kickers.solve(self.inj_coords)
+            if filename is not None:
+                makedirs(cache_dir)
+                # Write then rename, so that runs in parallel processes
+                # never read a partly written table.
+                tmp_filename = '{}.{}.tmp.npy'.format(filename[:-4], os.getpid())
+                np.save(tmp_filename, self.angles)
+                os.rename(tmp_filename, filename)
+
+    def cache_key(self, latfile, shape):
+        """Return hash of the inputs which determine the table."""
+        with open(latfile, 'rb') as file:
+            lattice_hash = hash_items(file.read())
+        if not isinstance(shape, str):
+            # Custom shapes are identified by their values on the table.
+            shape = self.shape(np.linspace(0.0, 1.0, len(self.times)))
+        return hash_items(lattice_hash, self.kickers.kin_energy, self.kickers.mass,
+                     self.kickers.min_angles, self.kickers.max_angles,
+                     self.inj_coords_t0, self.inj_coords_t1, self.t0, self.t1,
+                     len(self.times), shape)[:16]
+
+    def get_inj_coords(self, t):
+        """Return target coordinates at time(s) t, shape (..., 4)."""
+        frac = np.clip((np.asarray(t, dtype=float) - self.t0) / (self.t1 - self.t0), 0.0, 1.0)
+        frac = self.shape(frac)[..., np.newaxis]
+        return self.inj_coords_t0 + frac * (self.inj_coords_t1 - self.inj_coords_t0)
+
+    def get_angles(self, t):
+        """Return interpolated kicker angles at time t, shape (8,)."""
+        x = (t - self.t0) / self.dt
+        last = len(self.times) - 1
+        if x <= 0.0:
+            return self.angles[0]
+        if x >= last:
+            return self.angles[last]
+        i = int(x)
+        w = x - i
+        return (1.0 - w) * self.angles[i] + w * self.angles[i + 1]
+
+    def set_angles(self, t):
+        """Set the kicker angles in the ring to their values at time t."""
+        self.kickers.set_angles(self.get_angles(t))
+
+
+class TableWaveform:
+    """Kick factor of one kicker from a `PaintingSchedule`.
+
+    The kick factor multiplies the kicker angle which is set when the
+    waveform is added to the lattice; that angle should be `ref_angle`.
+    Use `ref_angles` to get suitable values.
+    """
+    def __init__(self, sync_part, schedule, index, ref_angle):
+        self.sync_part = sync_part
+        self.schedule = schedule
+        self.index = index
+        self.ref_angle = ref_angle
+
+    def getKickFactor(self):
+        if self.ref_angle == 0.0:
+            return 0.0
+        angle = self.schedule.get_angles(self.sync_part.time())[self.index]
+        return angle / self.ref_angle
+
+
+def ref_angles(schedule):
+    """Return the angle of largest magnitude reached by each kicker."""
+    idx = np.argmax(np.abs(schedule.angles), axis=0)
+    return schedule.angles[idx, np.arange(schedule.angles.shape[1])]
@@ -0,0 +1,167 @@
+"""Per-node-type timing of lattice tracking.
+
+`NodeProfiler` replaces the `track` method of every node in a lattice
+(including child nodes) with a wrapper which records the wall time, the
+number of calls and the number of particles tracked, grouped by node type.
+The records are kept per turn and can be saved as a CSV or JSON timeline.
+Nothing is changed in the lattice until `install` is called, so there is no
+overhead when profiling is disabled; `uninstall` restores the nodes.
+
+Example:
+
+    profiler = NodeProfiler(ring)
+    profiler.install()
+    for turn in range(turns):
+        with profiler.turn(turn):
+            ring.trackBunch(bunch, params_dict)
+    profiler.save_csv('_output/data/profile.csv')
+    profiler.print_summary()
+"""
+import json
+from timeit import default_timer
+
+import numpy as np
+
+
+def node_type(node):
+    """Default grouping of nodes: the node class name."""
+    return node.__class__.__name__
+
+
+def _all_nodes(lattice):
+    """Return all nodes in the lattice, including child nodes."""
+    nodes = []
+    stack = list(reversed(lattice.getNodes()))
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        children = node.getAllChildren() if hasattr(node, 'getAllChildren') else []
+        stack.extend(reversed(children))
+    return nodes
+
+
+class _Turn:
+    def __init__(self, profiler, turn):
+        self.profiler = profiler
+        self.turn = turn
+
+    def __enter__(self):
+        self.profiler.start_turn(self.turn)
+
+    def __exit__(self, *args):
+        self.profiler.end_turn()
+
+
+class NodeProfiler:
+    """Record time spent in each type of node, turn by turn.
+
+    Attributes
+    ----------
+    timeline : list[dict]
+        One record per turn: {'turn', 'time', 'n_parts', 'nodes'}, where
+        'nodes' maps node type to [time, calls, particles]. 'particles' is
+        the sum over calls of the bunch size.
+    totals : dict
+        Maps node type to [time, calls, particles] summed over all turns.
+    """
+    def __init__(self, lattice, key=node_type):
+        self.lattice = lattice
+        self.key = key
+        self.timeline = []
+        self.totals = dict()
+        self._current = None
+        self._turn = None
+        self._t_start = None
+        self._wrapped = []
+
+    def install(self):
+        """Wrap the `track` method of every node."""
+        if self._wrapped:
+            return
+        for node in _all_nodes(self.lattice):
+            self._wrap(node)
+
+    def uninstall(self):
+        """Restore the original `track` methods."""
+        for node in self._wrapped:
+            del node.track
+        self._wrapped = []
+
+    def _wrap(self, node):
+        track = node.track
+        name = self.key(node)
+        profiler = self
+
+        def timed_track(params_dict):
+            t0 = default_timer()
+            result = track(params_dict)
+            elapsed = default_timer() - t0
+            bunch = params_dict.get('bunch') if hasattr(params_dict, 'get') else None
+            n_parts = bunch.getSize() if bunch is not None else 0
+            profiler._record(name, elapsed, n_parts)
+            return result
+
+        node.track = timed_track
+        self._wrapped.append(node)
+
+    def _record(self, name, elapsed, n_parts):
+        for records in (self._current, self.totals):
+            if records is None:
+                continue
+            if name not in records:
+                records[name] = [0.0, 0, 0]
+            record = records[name]
+            record[0] += elapsed
+            record[1] += 1
+            record[2] += n_parts
+
+    def turn(self, turn):
+        """Context manager which times one turn."""
+        return _Turn(self, turn)
+
+    def start_turn(self, turn):
+        self._turn = turn
+        self._current = dict()
+        self._t_start = default_timer()
+
+    def end_turn(self, n_parts=None):
+        elapsed = default_timer() - self._t_start
+        if n_parts is None:
+            n_parts = max([record[2] // max(record[1], 1)
+                           for record in self._current.values()] or [0])
+        self.timeline.append({'turn': self._turn, 'time': elapsed,
+                              'n_parts': n_parts, 'nodes': self._current})
+        self._current = None
+
+    def summary(self):
+        """Return (node type, time, fraction of tracked time, calls, time per
+        particle-call) rows, sorted by time."""
+        total = sum(record[0] for record in self.totals.values())
+        rows = []
+        for name, (time, calls, parts) in self.totals.items():
+            rows.append((name, time, time / total if total else 0.0, calls,
+                         time / parts if parts else np.nan))
+        return sorted(rows, key=lambda row: -row[1])
+
+    def print_summary(self):
+        print('{:<32} {:>10} {:>7} {:>10} {:>12}'.format(
+            'node type', 'time [s]', 'frac', 'calls', 's/particle'))
+        for name, time, frac, calls, per_part in self.summary():
+            print('{:<32} {:>10.3f} {:>7.3f} {:>10d} {:>12.3e}'.format(
+                name, time, frac, calls, per_part))
+
+    def save_csv(self, filename):
+        """Save the timeline with one row per (turn, node type)."""
+        with open(filename, 'w') as file:
+            file.write('turn,node_type,time,calls,particles\n')
+            for record in self.timeline:
+                turn = record['turn']
+                file.write('{},{},{},{},{}\n'.format(
+                    turn, '_turn', record['time'], 1, record['n_parts']))
+                for name, (time, calls, parts) in sorted(record['nodes'].items()):
+                    file.write('{},{},{},{},{}\n'.format(turn, name, time, calls, parts))
+
+    def save_json(self, filename):
+        """Save the timeline and totals."""
+        with open(filename, 'w') as file:
+            json.dump({'timeline': self.timeline, 'totals': self.totals}, file)
@@ -0,0 +1,132 @@
+"""Incremental writer for turn-by-turn bunch coordinates.
+
+The bunch coordinates are appended to disk as the simulation runs instead of
+being held in memory until the end. The output directory has the same
+layout as the arrays written by `save_stacked_array`:
+
+    directory/
+        stacked_array.npy   -- (n_total, n_cols), all snapshots stacked
+        stacked_index.npy   -- indices at which to split the stacked array
+        turns.npy           -- turn number of each snapshot
+
+The header of `stacked_array.npy` and the index files are rewritten after
+every snapshot, so the files are valid (and can be memory-mapped) while the
+simulation is running or if it crashes. Load them with
+`StackedFrames.from_dir` in `tools/frames.py`, or with `load_snapshots`.
+"""
+import os
+
+import numpy as np
+
+
+# Fixed size of the .npy header (magic string + length + dict), so that the
+# header can be rewritten in place as the array grows.
+_HEADER_SIZE = 128
+
+
+def _npy_header(shape, dtype):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(int(n) for n in shape))
+    n_pad = _HEADER_SIZE - 10 - len(header) - 1
+    header = header + ' ' * n_pad + '\n'
+    length = np.array([len(header)], dtype='<u2').tobytes()
+    return b'\x93NUMPY\x01\x00' + length + header.encode('latin1')
+
+
+class SnapshotWriter:
+    """Append bunch coordinates to disk every `stride` turns.
+
+    Attributes
+    ----------
+    directory : str
+        Output directory.
+    stride : int
+        Only turns which are multiples of `stride` are written.
+    dtype : str
+        Data type on disk ('float64' or 'float32').
+    turns : list[int]
+        Turn numbers of the snapshots written so far.
+    n_rows : int
+        Total number of rows written so far.
+    """
+    def __init__(self, directory, stride=1, dtype='float64'):
+        self.directory = directory
+        self.stride = stride
+        self.dtype = np.dtype(dtype)
+        self.turns = []
+        self.bounds = [0]
+        self.n_rows = 0
+        self.n_cols = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.filename = os.path.join(directory, 'stacked_array.npy')
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, coords, turn):
+        """Write the coordinates at `turn` if it is a multiple of `stride`.
+
+        Parameters
+        ----------
+        coords : ndarray, shape (nparts, n_cols)
+            Bunch coordinates.
+        turn : int
+            Turn number.
+
+        Returns
+        -------
+        bool
+            Whether the snapshot was written.
+        """
+        if turn % self.stride:
+            return False
+        coords = np.asarray(coords, dtype=self.dtype)
+        if self.file is None:
+            self.n_cols = coords.shape[1]
+            self.file = open(self.filename, 'wb')
+            self.file.write(_npy_header((0, self.n_cols), self.dtype))
+        if coords.shape[1] != self.n_cols:
+            raise ValueError('Expected {} columns, got {}.'.format(
+                self.n_cols, coords.shape[1]))
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(np.ascontiguousarray(coords).tobytes())
+        self.n_rows += coords.shape[0]
+        self.turns.append(turn)
+        self.bounds.append(self.n_rows)
+        self.flush()
+        return True
+
+    def flush(self):
+        """Update the header and index files to match the data written."""
+        if self.file is None:
+            return
+        self.file.seek(0)
+        self.file.write(_npy_header((self.n_rows, self.n_cols), self.dtype))
+        self.file.flush()
+        np.save(os.path.join(self.directory, 'stacked_index.npy'),
+                np.array(self.bounds[1:-1], dtype=int))
+        np.save(os.path.join(self.directory, 'turns.npy'),
+                np.array(self.turns, dtype=int))
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def load_snapshots(directory, mmap_mode='r'):
+    """Return the list of snapshots written by `SnapshotWriter`, and turns.
+
+    The snapshots are views of one memory-mapped array unless `mmap_mode`
+    is None.
+    """
+    stacked = np.load(os.path.join(directory, 'stacked_array.npy'), mmap_mode=mmap_mode)
+    index = np.load(os.path.join(directory, 'stacked_index.npy'))
+    turns = np.load(os.path.join(directory, 'turns.npy'))
+    return np.split(stacked, index, axis=0), turns
@@ -0,0 +1,119 @@
+"""
+This script runs the injection simulation (`sim.run`) over a grid of
+parameters.
+
+Each configuration runs in its own worker process (a fresh process per run,
+since PyORBIT keeps global state) with its own output directory,
+'_output/sweep/run_XXX/'. At most `processes` runs (default: the number of
+cores) are active at once. The summary statistics of every run are
+collected in '_output/sweep/summary.csv'.
+
+Keys of the grid are `sim.default_config` keys or switches in its 'use'
+dict.
+"""
+import os
+import itertools
+import multiprocessing
+
+import impedance_model
+from sim import default_config, run
+
+
+def expand_grid(grid):
+    """Return a list of parameter dicts, one for each point in the grid.
+
+    Parameters
+    ----------
+    grid : dict
+        Maps each parameter name to a list of values.
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[grid[name] for name in names])]
+
+
+def make_config(params, output_dir):
+    """Return a full simulation config with `params` applied."""
+    config = default_config()
+    for name, value in params.items():
+        if name in config:
+            config[name] = value
+        elif name in config['use']:
+            config['use'][name] = value
+        else:
+            raise KeyError("Unknown parameter '{}'.".format(name))
+    config['output_dir'] = output_dir
+    return config
+
+
+def _run_one(args):
+    index, params, output_dir = args
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    try:
+        summary = run(make_config(params, output_dir))
+        summary['error'] = ''
+    except Exception as error:
+        summary = {'error': repr(error)}
+    return index, summary
+
+
+def write_table(filename, rows, columns=None):
+    """Write a list of dicts as a CSV table.
+
+    The columns are `columns` followed by any other keys of the rows.
+    """
+    columns = [] if columns is None else list(columns)
+    for row in rows:
+        columns.extend(key for key in row if key not in columns)
+    with open(filename, 'w') as file:
+        file.write(','.join(columns) + '\n')
+        for row in rows:
+            values = ['"{}"'.format(str(row.get(key, '')).replace('"', '""'))
+                      for key in columns]
+            file.write(','.join(values) + '\n')
+
+
+def sweep(grid, output_dir='_output/sweep/', processes=None):
+    """Run the simulation at every point of `grid` in parallel.
+
+    Returns
+    -------
+    list[dict]
+        Parameters and summary statistics of each run, in grid order.
+    """
+    points = expand_grid(grid)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(points)))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    # Create shared on-disk tables before the workers start.
+    impedance_model.get_model(default_config()['impedance_file'])
+
+    jobs = [(i, params, os.path.join(output_dir, 'run_{:03d}'.format(i), ''))
+            for i, params in enumerate(points)]
+    rows = [None] * len(points)
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        for i, summary in pool.imap_unordered(_run_one, jobs):
+            row = {'run': i}
+            row.update(points[i])
+            row.update(summary)
+            rows[i] = row
+            print 'Finished run {} ({}/{})'.format(i, sum(r is not None for r in rows), len(rows))
+            write_table(os.path.join(output_dir, 'summary.csv'),
+                        [r for r in rows if r is not None],
+                        columns=['run'] + sorted(grid))
+    finally:
+        pool.close()
+        pool.join()
+    return rows
+
+
+if __name__ == '__main__':
+    grid = {
+        'intensity': [0.5e14, 1.0e14, 1.5e14],
+        'space charge': [False, True],
+    }
+    sweep(grid)
@@ -1,14 +1,25 @@
 import numpy as np
+import numpy.linalg as la
 import scipy.optimize as opt
 
 
+# Index of each covariance matrix element in the 10 element moment vector.
+_vec_index = np.array([[0, 2, 6, 8],
+                       [2, 1, 7, 9],
+                       [6, 7, 3, 5],
+                       [8, 9, 5, 4]])
+
+# Squared moments (<xx>, <x'x'>, <yy>, <y'y'>) can't be negative.
+_nonneg_index = [0, 1, 3, 4]
+
+
 def to_mat(sigma):
-    """Return covariance matrix from 10 element moment vector."""
-    s11, s22, s12, s33, s44, s34, s13, s23, s14, s24 = sigma
-    return np.array([[s11, s12, s13, s14], 
-                     [s12, s22, s23, s24], 
-                     [s13, s23, s33, s34], 
-                     [s14, s24, s34, s44]])
+    """Return covariance matrix from 10 element moment vector.
+
+    `sigma` can also have shape (..., 10), in which case an array of shape
+    (..., 4, 4) is returned.
+    """
+    return np.asarray(sigma)[..., _vec_index]
 
 def to_vec(Sigma):
     """Return 10 element moment vector from covariance matrix."""
@@ -17,11 +28,48 @@ def to_vec(Sigma):
     s33, s34 = Sigma[2, 2:]
     s44 = Sigma[3, 3]
     return np.array([s11, s22, s12, s33, s44, s34, s13, s23, s14, s24])
-    
-    
+
+
+def get_design_matrix(transfer_mats):
+    """Return the matrix A such that A * sigma = [<xx>, <yy>, <xy>, ...].
+
+    Parameters
+    ----------
+    transfer_mats : ndarray, shape (..., n, 4, 4)
+        Stack of 4x4 transfer matrices, one for each measurement.
+
+    Returns
+    -------
+    ndarray, shape (..., 3n, 10)
+        Three rows (<xx>, <yy>, <xy>) per measurement. The columns are in
+        the order used by `to_vec`.
+    """
+    M = np.asarray(transfer_mats, dtype=float)
+    m11, m12 = M[..., 0, 0], M[..., 0, 1]
+    m33, m34 = M[..., 2, 2], M[..., 2, 3]
+    A = np.zeros(M.shape[:-2] + (3, 10))
+    A[..., 0, 0] = m11**2
+    A[..., 0, 1] = m12**2
+    A[..., 0, 2] = 2 * m11 * m12
+    A[..., 1, 3] = m33**2
+    A[..., 1, 4] = m34**2
+    A[..., 1, 5] = 2 * m33 * m34
+    A[..., 2, 6] = m11 * m33
+    A[..., 2, 7] = m12 * m33
+    A[..., 2, 8] = m11 * m34
+    A[..., 2, 9] = m12 * m34
+    return A.reshape(M.shape[:-3] + (3 * M.shape[-3], 10))
+
+
+def _bounds():
+    lb = np.full(10, -np.inf)
+    lb[_nonneg_index] = 0.0
+    return lb, np.inf
+
+
 def reconstruct(transfer_mats, moments, **kwargs):
     """Reconstruct covariance matrix from wire-scanner data.
-    
+
     Parameters
     ----------
     transfer_mats : list of (4, 4) ndarray, length n
@@ -36,16 +84,159 @@ def reconstruct(transfer_mats, moments, **kwargs):
     ndarray, shape (4, 4)
         Covariance matrix at reconstruction point.
     """
-    A, b = [], []
-    for M, (x2, y2, xy) in zip(transfer_mats, moments):
-        A.append([M[0, 0]**2, M[0, 1]**2, 2*M[0, 0]*M[0, 1], 0, 0, 0, 0, 0, 0, 0])
-        A.append([0, 0, 0, M[2, 2]**2, M[2, 3]**2, 2*M[2, 2]*M[2, 3], 0, 0, 0, 0])
-        A.append([0, 0, 0, 0, 0, 0, M[0, 0]*M[2, 2],  M[0, 1]*M[2, 2],  M[0, 0]*M[2, 3],  M[0, 1]*M[2, 3]])
-        b.append(x2)
-        b.append(y2)
-        b.append(xy)
-    A, b = np.array(A), np.array(b)
-    lb = 10 * [-np.inf]
-    lb[0] = lb[1] = lb[3] = lb[4] = 0.0 # Squared moments can't be negative
-    result = opt.lsq_linear(A, b, bounds=(lb, np.inf), **kwargs)
+    A = get_design_matrix(transfer_mats)
+    b = np.ravel(moments)
+    result = opt.lsq_linear(A, b, bounds=_bounds(), **kwargs)
     return to_mat(result.x)
+
+
+def reconstruct_batch(transfer_mats, moments, bounded=True, **kwargs):
+    """Reconstruct many covariance matrices, each with its own optics.
+
+    The normal equations of all problems are solved at once. Use
+    `Reconstructor` instead if the transfer matrices are the same for every
+    set of moments.
+
+    Parameters
+    ----------
+    transfer_mats : ndarray, shape (k, n, 4, 4)
+        Transfer matrices for each of the k problems.
+    moments : ndarray, shape (k, n, 3)
+        The [<xx>, <yy>, <xy>] moments for each of the k problems.
+    bounded : bool
+        If True, solutions with negative squared moments are recomputed
+        with scipy.optimize.lsq_linear.
+    **kwargs
+        Key word arguments passed to scipy.optimize.lsq_linear.
+
+    Returns
+    -------
+    ndarray, shape (k, 4, 4)
+    """
+    A = get_design_matrix(transfer_mats)
+    moments = np.asarray(moments, dtype=float)
+    b = moments.reshape(moments.shape[:-2] + (3 * moments.shape[-2],))
+    # Scale the columns to improve the conditioning of A^T A.
+    scale = np.sqrt(np.sum(A**2, axis=-2, keepdims=True))
+    scale[scale == 0] = 1.0
+    As = A / scale
+    AtA = np.matmul(np.swapaxes(As, -1, -2), As)
+    Atb = np.matmul(np.swapaxes(As, -1, -2), b[..., np.newaxis])
+    sigma = la.solve(AtA, Atb)[..., 0] / scale[..., 0, :]
+    if bounded:
+        for k in np.where(np.any(sigma[:, _nonneg_index] < 0, axis=1))[0]:
+            result = opt.lsq_linear(A[k], b[k], bounds=_bounds(), **kwargs)
+            sigma[k] = result.x
+    return to_mat(sigma)
+
+
+class Reconstructor:
+    """Least-squares moment reconstruction for a fixed set of optics.
+
+    The singular value decomposition of the design matrix is computed once so
+    that many sets of measured moments (for example, one per Monte Carlo
+    trial) can be reconstructed with a single matrix product. The bounded
+    solver (`scipy.optimize.lsq_linear`) is only called for the solutions
+    which have negative squared moments.
+
+    Attributes
+    ----------
+    A : ndarray, shape (3n, 10)
+        The design matrix (see `get_design_matrix`).
+    pinv : ndarray, shape (10, 3n)
+        Pseudo-inverse of `A`.
+    cov_unit : ndarray, shape (10, 10)
+        The matrix (A^T A)^-1. Multiplying by the variance of the measured
+        moments gives the covariance matrix of the reconstructed moments.
+    rank : int
+        Numerical rank of `A`. If less than 10, the moments are not fully
+        determined by the measurement.
+    """
+    def __init__(self, transfer_mats, rcond=1e-12):
+        self.A = get_design_matrix(transfer_mats)
+        self.n_meas = self.A.shape[0] // 3
+        U, s, Vt = la.svd(self.A, full_matrices=False)
+        keep = s > rcond * s[0]
+        self.rank = int(np.sum(keep))
+        s_inv = np.zeros_like(s)
+        s_inv[keep] = 1.0 / s[keep]
+        self.pinv = np.matmul(Vt.T * s_inv, U.T)
+        self.cov_unit = np.matmul(Vt.T * s_inv**2, Vt)
+
+    def _get_b(self, moments):
+        moments = np.asarray(moments, dtype=float)
+        b = moments.reshape(moments.shape[:-2] + (3 * moments.shape[-2],))
+        if b.shape[-1] != self.A.shape[0]:
+            raise ValueError('Expected {} measurements, got {}.'.format(
+                self.n_meas, moments.shape[-2]))
+        return b
+
+    def solve_vec(self, moments, bounded=True, **kwargs):
+        """Return reconstructed moment vectors (see `to_vec` for ordering).
+
+        Parameters
+        ----------
+        moments : ndarray, shape (..., n, 3)
+            The [<xx>, <yy>, <xy>] moments at each measurement. Any number of
+            leading dimensions (e.g. one per trial) are solved at once.
+        bounded : bool
+            If True, solutions with negative squared moments are recomputed
+            with the bounds enforced.
+        **kwargs
+            Key word arguments passed to scipy.optimize.lsq_linear.
+
+        Returns
+        -------
+        ndarray, shape (..., 10)
+        """
+        b = self._get_b(moments)
+        sigma = np.matmul(b, self.pinv.T)
+        if bounded:
+            flat_b = b.reshape(-1, b.shape[-1])
+            flat_sigma = sigma.reshape(-1, 10)
+            bad, = np.where(np.any(flat_sigma[:, _nonneg_index] < 0, axis=1))
+            for k in bad:
+                result = opt.lsq_linear(self.A, flat_b[k], bounds=_bounds(),
+                                        **kwargs)
+                flat_sigma[k] = result.x
+            sigma = flat_sigma.reshape(sigma.shape)
+        return sigma
+
+    def solve(self, moments, bounded=True, **kwargs):
+        """Return reconstructed covariance matrices, shape (..., 4, 4).
+
+        See `solve_vec` for the parameters.
+        """
+        return to_mat(self.solve_vec(moments, bounded, **kwargs))
+
+    def residuals(self, moments, sigma):
+        """Return A * sigma - b for each set of moments."""
+        return np.matmul(sigma, self.A.T) - self._get_b(moments)
+
+    def cov(self, moments, sigma=None, moment_std=None):
+        """Estimate covariance matrix of the reconstructed moment vector.
+
+        Parameters
+        ----------
+        moments : ndarray, shape (..., n, 3)
+            The measured moments.
+        sigma : ndarray, shape (..., 10)
+            The reconstructed moment vectors. Computed if not provided.
+        moment_std : float or None
+            Known standard deviation of the measured moments. If None, it is
+            estimated from the fit residuals.
+
+        Returns
+        -------
+        ndarray, shape (..., 10, 10)
+        """
+        if moment_std is None:
+            if sigma is None:
+                sigma = self.solve_vec(moments)
+            dof = max(self.A.shape[0] - self.rank, 1)
+            res = self.residuals(moments, sigma)
+            var = np.sum(res**2, axis=-1) / dof
+        else:
+            b = self._get_b(moments)
+            var = np.full(b.shape[:-1], moment_std**2)
+        return var[..., np.newaxis, np.newaxis] * self.cov_unit
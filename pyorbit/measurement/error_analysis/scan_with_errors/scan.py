@@ -8,6 +8,7 @@ from bunch import Bunch
 from orbit_utils import Matrix
 from spacecharge import SpaceChargeCalc2p5D
 from orbit.analysis import AnalysisNode, WireScannerNode, add_analysis_node
+from orbit.analysis.AnalysisNode import get_coords
 from orbit.analysis.analysis import intrinsic_emittances, apparent_emittances
 from orbit.envelope import Envelope
 from orbit.space_charge.envelope import set_env_solver_nodes, set_perveance
@@ -20,7 +21,9 @@ from tools.utils import delete_files_not_folders
 
 sys.path.append('/Users/46h/Research/code/accphys/pyorbit/measurement')
 from utils import PhaseController
-from data_analysis import reconstruct
+from data_analysis import reconstruct, reconstruct_batch
+from linear_errors import simulate_scan, transform_cov
+from trials import ErrorAnalysis
 
 
 # Settings
@@ -74,7 +77,34 @@ max_frac_field_error = 0.02
 max_quad_tilt_angle = 2e-3 # rad
 max_diag_wire_angle_error = np.radians(1.0) # rad
 max_frac_bin_count_error = 0.05
+error_model = {
+    'errors': errors,
+    'max_frac_twiss_error': max_frac_twiss_error,
+    'max_kin_energy_error': max_kin_energy_error,
+    'max_frac_field_error': max_frac_field_error,
+    'max_quad_tilt_angle': max_quad_tilt_angle,
+    'max_diag_wire_angle_error': max_diag_wire_angle_error,
+    'max_frac_bin_count_error': max_frac_bin_count_error,
+}
+
+# Trials
 n_trials = 50
+seed = 0
+processes = None # use all available cores
+resume = False # continue from the trials saved in `checkpoint_dir`
+checkpoint_dir = '_output/data/trials/'
+fast = False # propagate covariance matrix through linear optics instead of tracking 
+cross_check = True # compare linear optics with tracking (fast mode only)
+
+# The linear model does not include these effects; turn them off in fast mode
+# so that the lattice, tracking cross-check and trials are all consistent.
+if fast:
+    errors = dict(errors)
+    for key in ['space charge', 'fringe fields', 'energy spread']:
+        if errors[key]:
+            print "Fast mode: ignoring '{}' errors.".format(key)
+            errors[key] = False
+    error_model = dict(error_model, errors=errors)
 
 print 'Errors:'
 pprint(errors) 
@@ -82,7 +112,8 @@ pprint(errors)
 
 # Initialization
 #------------------------------------------------------------------------------
-delete_files_not_folders('_output/')
+if not resume:
+    delete_files_not_folders('_output/')
 
 
 # Get correct magnet settings
@@ -99,7 +130,9 @@ scan_phases = controller.get_phases_for_scan(phase_coverage, steps_per_dim, meth
 quad_strengths_list = np.load('quad_strengths_list.npy')
 
 
-def initialize_bunch(init_twiss):
+def initialize_env(init_twiss, error_model):
+    errors = error_model['errors']
+    max_frac_twiss_error = error_model['max_frac_twiss_error']
     init_env = Envelope(eps, mode, ex_frac, mass, kin_energy, length=0.66*248.0)
     if errors['twiss mismatch']:
         init_twiss = np.array(init_twiss)
@@ -107,6 +140,12 @@ def initialize_bunch(init_twiss):
     ax0, ay0, bx0, by0 = init_twiss
     init_env.fit_twiss2D(ax0, ay0, bx0, by0, ex_frac)
     init_env.set_twiss_param_4D('nu', np.radians(100))
+    return init_env
+
+
+def initialize_bunch(init_twiss, error_model):
+    errors = error_model['errors']
+    init_env = initialize_env(init_twiss, error_model)
     X0 = init_env.generate_dist(nparts)
     if errors['energy spread']:
         deltaE = energy_spread
@@ -129,42 +168,54 @@ if errors['space charge']:
     sc_nodes = setSC2p5DAccNodes(lattice, min_solver_spacing, calc2p5d)
     
 # Add wire-scanner nodes
+def set_ws_errors(ws_nodes, errors):
+    """Turn the wire-scanner measurement errors on/off."""
+    for ws_node in ws_nodes:
+        if errors['diag wire angle']:
+            ws_node.set_diag_wire_angle_error(max_diag_wire_angle_error)
+        else:
+            ws_node.set_diag_wire_angle_error(0.0)
+        if errors['bin counts']:
+            ws_node.set_frac_bin_count_error(max_frac_bin_count_error)
+        else:
+            ws_node.set_frac_bin_count_error(0.0)
+
+
 ws_nodes = []
 for ws_name in ws_names:
     parent_node = lattice.getNodeForName(ws_name)
     ws_node = WireScannerNode(ws_bins, diag_wire_angle, name=ws_name)
-    if errors['diag wire angle']:
-        ws_node.set_diag_wire_angle_error(max_diag_wire_angle_error)
-    if errors['bin counts']:
-        ws_node.set_frac_bin_count_error(max_frac_bin_count_error)
     parent_node.addChildNode(ws_node, parent_node.ENTRANCE)
     ws_nodes.append(ws_node)
+set_ws_errors(ws_nodes, errors)
     
     
 # Perform scan
 #------------------------------------------------------------------------------
-reconstructed_emittances = []
-
-for trial in trange(n_trials):
+def run_trial(error_model):
+    """Scan the optics once with random errors; return reconstructed emittances."""
+    errors = error_model['errors']
 
     # Tilt quads
     if errors['quad tilt angles']:
+        max_quad_tilt_angle = error_model['max_quad_tilt_angle']
         for node in lattice.getNodes():
             if node.getType() == 'quad teapot':
                 angle = np.random.uniform(-max_quad_tilt_angle, max_quad_tilt_angle)
                 node.setTiltAngle(angle)
 
     # Get scaling factor for quad strengths to simulate devation from design energy
+    max_kin_energy_error = error_model['max_kin_energy_error']
     kin_energy_error = np.random.uniform(-max_kin_energy_error, max_kin_energy_error)
     ref_momentum = hf.get_pc(mass, kin_energy)
     true_momentum = hf.get_pc(mass, kin_energy + kin_energy_error)
 
-
     # Collect data
     transfer_mats, moments = [], []
     for quad_strengths in quad_strengths_list:
 
         if errors['quad fields']:
+            max_frac_field_error = error_model['max_frac_field_error']
             lb = (1 - max_frac_field_error) * quad_strengths
             ub = (1 + max_frac_field_error) * quad_strengths
             quad_strengths = np.random.uniform(lb, ub)
@@ -176,7 +227,7 @@ for trial in trange(n_trials):
         controller.apply_settings(lattice)
 
         # Track bunch
-        bunch, params_dict = initialize_bunch(init_twiss)
+        bunch, params_dict = initialize_bunch(init_twiss, error_model)
         lattice.trackBunch(bunch, params_dict)
 
         # Compute moments and transfer matrix at each wire-scanner
@@ -189,10 +240,77 @@ for trial in trange(n_trials):
     Sigma *= 1e6 # convert to mm mrad
     eps1, eps2 = intrinsic_emittances(Sigma)
     epsx, epsy = apparent_emittances(Sigma)
-    reconstructed_emittances.append([eps1, eps2, epsx, epsy])
+    return {'emittances': [eps1, eps2, epsx, epsy]}
+
+
+def run_trials_linear(error_model):
+    """Run all trials at once using the linear-optics model.
     
+    The initial covariance matrix is propagated through the perturbed 
+    transfer matrices; the wire-scanner errors are applied analytically.
+    """
+    errors = error_model['errors']
+    for key in ['space charge', 'fringe fields', 'energy spread']:
+        if errors[key]:
+            raise ValueError("Linear model does not include '{}'.".format(key))
+    np.random.seed(seed)
+    if errors['twiss mismatch']:
+        Sigma0 = [[initialize_env(init_twiss, error_model).cov() 
+                   for _ in quad_strengths_list] for _ in range(n_trials)]
+    else:
+        Sigma0 = initialize_env(init_twiss, error_model).cov()
+    max_kin_energy_error = error_model['max_kin_energy_error']
+    kin_energy_errors = np.random.uniform(-max_kin_energy_error, max_kin_energy_error, size=n_trials)
+    ref_momentum = hf.get_pc(mass, kin_energy)
+    true_momenta = [hf.get_pc(mass, kin_energy + error) for error in kin_energy_errors]
+    transfer_mats, moments = simulate_scan(
+        linear_model, Sigma0, quad_strengths_list, error_model, n_trials, 
+        ws_bins, diag_wire_angle, ref_momentum, true_momenta
+    )
+    Sigmas = reconstruct_batch(transfer_mats.reshape(n_trials, -1, 4, 4),
+                               moments.reshape(n_trials, -1, 3))
+    Sigmas *= 1e6 # convert to mm mrad
+    return np.array([list(intrinsic_emittances(Sigma)) + list(apparent_emittances(Sigma))
+                     for Sigma in Sigmas])
+
+
+def check_linear_model(scan_index=0):
+    """Compare linear model with tracking for one optics setting.
     
-reconstructed_emittances = np.array(reconstructed_emittances)
+    No random errors are applied to the optics, initial beam, or
+    wire-scanner measurements.
+    """
+    no_errors = dict(error_model)
+    no_errors['errors'] = {key: False for key in errors}
+    set_ws_errors(ws_nodes, no_errors['errors'])
+    quad_strengths = quad_strengths_list[scan_index]
+    controller.set_quad_strengths(quad_strengths)
+    controller.apply_settings(lattice)
+    bunch, params_dict = initialize_bunch(init_twiss, no_errors)
+    Sigma0 = np.cov(get_coords(bunch)[:, :4].T)
+    lattice.trackBunch(bunch, params_dict)
+    tracked_moments = np.array([ws_node.get_moments() for ws_node in ws_nodes])
+    set_ws_errors(ws_nodes, errors)
+    transfer_mats = linear_model.transfer_matrices(quad_strengths)
+    Sigma = transform_cov(transfer_mats, Sigma0)
+    moments = np.stack([Sigma[:, 0, 0], Sigma[:, 2, 2], Sigma[:, 0, 2]], axis=-1)
+    controller_transfer_mats = [controller.get_transfer_matrix(ws_name) 
+                                for ws_name in ws_names]
+    print 'Linear model vs. tracking (scan {}):'.format(scan_index)
+    print '    max |transfer matrix difference| =', np.max(np.abs(transfer_mats - controller_transfer_mats))
+    print '    moments (linear) =', moments
+    print '    moments (tracked) =', tracked_moments
+    
+
+if fast:
+    linear_model = controller.get_linear_model(ws_names)
+    if cross_check:
+        check_linear_model()
+    reconstructed_emittances = run_trials_linear(error_model)
+else:
+    runner = ErrorAnalysis(run_trial, error_model, n_trials, seed=seed,
+                           processes=processes, checkpoint_dir=checkpoint_dir)
+    reconstructed_emittances = runner.run()['emittances']
 print 'mean:', np.mean(reconstructed_emittances, axis=0)
 print 'std:', np.std(reconstructed_emittances, axis=0)
 np.save('reconstructed_emittances.npy', reconstructed_emittances)
\ No newline at end of file
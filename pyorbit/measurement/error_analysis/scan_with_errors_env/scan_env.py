@@ -27,6 +27,7 @@ from tools.utils import delete_files_not_folders
 sys.path.append('/Users/46h/Research/code/accphys/pyorbit/measurement')
 from utils import PhaseController
 from data_analysis import reconstruct
+from trials import ErrorAnalysis
 
 
 # Settings
@@ -76,12 +77,18 @@ max_kin_energy_error = 0.003 # GeV
 max_frac_field_error = 0.01
 max_quad_tilt_angle = 1e-3 # rad
 max_frac_beam_moments_error = 0.05
+
+# Trials
 n_trials = 200
+seed = 0
+processes = None # use all available cores
+resume = False # continue from the trials saved in '_output/data/trials_{i}/'
 
 
 # Initialization
 #------------------------------------------------------------------------------
-delete_files_not_folders('_output/')
+if not resume:
+    delete_files_not_folders('_output/')
 
 # Get correct magnet settings
 dummy_lattice = hf.lattice_from_file(latfile, latseq)
@@ -101,9 +108,10 @@ init_env = Envelope(eps, mode, ex_frac, mass, kin_energy, length=bunch_length)
 init_env.set_intensity(intensity)
 np.save('_output/data/env_params.npy', init_env.params)
 
-def initialize_env(init_twiss):
+def initialize_env(init_twiss, error_model):
     env = init_env.copy()
-    if errors['twiss mismatch']:
+    if error_model['errors']['twiss mismatch']:
+        max_frac_twiss_error = error_model['max_frac_twiss_error']
         init_twiss = np.array(init_twiss)
         init_twiss *= np.random.uniform(1 - max_frac_twiss_error, 1 + max_frac_twiss_error, size=4)        
     ax0, ay0, bx0, by0 = init_twiss
@@ -127,80 +135,96 @@ env_monitor_nodes = [add_analysis_node(lattice, ws_name, 'env_monitor')
     
 # Perform scan
 #------------------------------------------------------------------------------
+def run_trial(error_model):
+    """Scan the optics once with random errors; return reconstructed emittances."""
+    errors = error_model['errors']
+
+    # Tilt quads
+    if errors['quad tilt angles']:
+        max_quad_tilt_angle = error_model['max_quad_tilt_angle']
+        for node in lattice.getNodes():
+            if node.getType() == 'quad teapot':
+                angle = np.random.uniform(-max_quad_tilt_angle, max_quad_tilt_angle)
+                node.setTiltAngle(angle)
+
+    # Get scaling factor for quad strengths to simulate devation from design energy
+    max_kin_energy_error = error_model['max_kin_energy_error']
+    kin_energy_error = np.random.uniform(-max_kin_energy_error, max_kin_energy_error)
+    ref_momentum = hf.get_pc(mass, kin_energy)
+    true_momentum = hf.get_pc(mass, kin_energy + kin_energy_error)
+
+    # Collect data
+    transfer_mats, moments = [], []
+    for quad_strengths in quad_strengths_list:
+
+        if errors['quad fields']:
+            max_frac_field_error = error_model['max_frac_field_error']
+            lb = (1 - max_frac_field_error) * quad_strengths
+            ub = (1 + max_frac_field_error) * quad_strengths
+            quad_strengths = np.random.uniform(lb, ub)
+
+        if errors['energy']:
+            quad_strengths *= (ref_momentum / true_momentum)
+
+        controller.set_quad_strengths(quad_strengths)
+        controller.apply_settings(lattice)
+
+        # Track envelope
+        for monitor_node in env_monitor_nodes:
+            monitor_node.clear_data()
+        env = initialize_env(init_twiss, error_model)
+        env.track(lattice)
+
+        # Compute moments and transfer matrix at each wire-scanner
+        for ws_name, monitor_node in zip(ws_names, env_monitor_nodes):
+            env.params = monitor_node.get_data('env_params')
+            Sigma = env.cov()
+            if errors['beam moments']:
+                max_frac_beam_moments_error = error_model['max_frac_beam_moments_error']
+                Sigma *= np.random.uniform(1 - max_frac_beam_moments_error, 1 + max_frac_beam_moments_error)
+            moments.append([Sigma[0, 0], Sigma[2, 2], Sigma[0, 2]])
+            transfer_mats.append(controller.get_transfer_matrix(ws_name))
+
+    # Reconstruct beam moments
+    Sigma = reconstruct(transfer_mats, moments)
+    Sigma *= 1e6 # convert to mm mrad
+    eps1, eps2 = intrinsic_emittances(Sigma)
+    epsx, epsy = apparent_emittances(Sigma)
+    return {'emittances': [eps1, eps2, epsx, epsy],
+            'moments': moments, 
+            'transfer_mats': transfer_mats}
+
+
+# Turn on one error source at a time, then all of them.
 keys = list(errors.keys())
 
 for i in range(len(keys) + 1):
     
+    trial_errors = {key: False for key in keys}
     if i < len(keys):
-        errors[keys[i]] = True
+        trial_errors[keys[i]] = True
     else:
         for key in keys:
-            errors[key] = True   
-    pprint(errors) 
-        
-    emittances_list, moments_list, transfer_mats_list = [], [], []
-
-    for trial in trange(n_trials):
-
-        # Tilt quads
-        if errors['quad tilt angles']:
-            for node in lattice.getNodes():
-                if node.getType() == 'quad teapot':
-                    angle = np.random.uniform(-max_quad_tilt_angle, max_quad_tilt_angle)
-                    node.setTiltAngle(angle)
-
-        # Get scaling factor for quad strengths to simulate devation from design energy
-        kin_energy_error = np.random.uniform(-max_kin_energy_error, max_kin_energy_error)
-        ref_momentum = hf.get_pc(mass, kin_energy)
-        true_momentum = hf.get_pc(mass, kin_energy + kin_energy_error)
-
-        # Collect data
-        transfer_mats, moments = [], []
-        for quad_strengths in quad_strengths_list:
-
-            if errors['quad fields']:
-                lb = (1 - max_frac_field_error) * quad_strengths
-                ub = (1 + max_frac_field_error) * quad_strengths
-                quad_strengths = np.random.uniform(lb, ub)
-
-            if errors['energy']:
-                quad_strengths *= (ref_momentum / true_momentum)
-
-            controller.set_quad_strengths(quad_strengths)
-            controller.apply_settings(lattice)
-
-            # Track envelope
-            for monitor_node in env_monitor_nodes:
-                monitor_node.clear_data()
-            env = initialize_env(init_twiss)
-            env.track(lattice)
-
-            # Compute moments and transfer matrix at each wire-scanner
-            for ws_name, monitor_node in zip(ws_names, env_monitor_nodes):
-                env.params = monitor_node.get_data('env_params')
-                Sigma = env.cov()
-                if errors['beam moments']:
-                    Sigma *= np.random.uniform(1 - max_frac_beam_moments_error, 1 + max_frac_beam_moments_error)
-                moments.append([Sigma[0, 0], Sigma[2, 2], Sigma[0, 2]])
-                transfer_mats.append(controller.get_transfer_matrix(ws_name))
-
-        # Reconstruct beam moments
-        Sigma = reconstruct(transfer_mats, moments)
-        Sigma *= 1e6 # convert to mm mrad
-        eps1, eps2 = intrinsic_emittances(Sigma)
-        epsx, epsy = apparent_emittances(Sigma)
-        emittances_list.append([eps1, eps2, epsx, epsy])
-        moments_list.append(moments)
-        transfer_mats_list.append(transfer_mats)
-
-    emittances_list = np.array(emittances_list)
+            trial_errors[key] = True   
+    pprint(trial_errors) 
+    
+    error_model = {
+        'errors': trial_errors,
+        'max_frac_twiss_error': max_frac_twiss_error,
+        'max_kin_energy_error': max_kin_energy_error,
+        'max_frac_field_error': max_frac_field_error,
+        'max_quad_tilt_angle': max_quad_tilt_angle,
+        'max_frac_beam_moments_error': max_frac_beam_moments_error,
+    }
+    runner = ErrorAnalysis(run_trial, error_model, n_trials, seed=seed, 
+                           processes=processes, 
+                           checkpoint_dir='_output/data/trials_{}/'.format(i))
+    results = runner.run()
+    emittances_list = results['emittances']
     print 'means:', np.mean(emittances_list, axis=0)
     print 'stds:', np.std(emittances_list, axis=0)
     np.save('_output/data/emittances_list_{}.npy'.format(i), emittances_list)
-    np.save('_output/data/moments_list_{}.npy'.format(i), moments_list)
-    np.save('_output/data/transfer_mats_list_{}.npy'.format(i), transfer_mats_list)
-    
-    for key in keys:
-        errors[key] = False   
+    np.save('_output/data/moments_list_{}.npy'.format(i), results['moments'])
+    np.save('_output/data/transfer_mats_list_{}.npy'.format(i), results['transfer_mats'])
         
 np.save('_output/data/keys.npy', keys)
\ No newline at end of file
@@ -0,0 +1,343 @@
+"""Linear-optics error model for the wire-scanner measurement.
+
+Without space charge, the moments at the wire-scanners are a linear function
+of the initial covariance matrix: Sigma_ws = M * Sigma0 * M^T. This module
+propagates Sigma0 through transfer matrices built from thick-quadrupole
+matrices, so that quadrupole field errors, tilt angles and energy errors can
+be applied to thousands of trials at once without tracking any particles.
+Errors in the wire-scanner binning and diagonal wire angle are applied
+analytically to the computed moments.
+
+Fringe fields, energy spread and space charge are not included.
+"""
+import numpy as np
+
+
+def rotation_matrix_4D(angle):
+    """4x4 matrix to rotate [x, x', y, y'] clockwise in the x-y plane.
+
+    `angle` can be an array; the returned array then has shape
+    angle.shape + (4, 4).
+    """
+    angle = np.asarray(angle, dtype=float)
+    c, s = np.cos(angle), np.sin(angle)
+    R = np.zeros(angle.shape + (4, 4))
+    R[..., 0, 0] = R[..., 1, 1] = R[..., 2, 2] = R[..., 3, 3] = c
+    R[..., 0, 2] = R[..., 1, 3] = s
+    R[..., 2, 0] = R[..., 3, 1] = -s
+    return R
+
+
+def _quad_block(k, length):
+    """2x2 matrix elements (C, S, C', S') for focusing strength k."""
+    w = np.sqrt(k.astype(complex))
+    wl = w * length
+    small = np.abs(k) < 1e-12
+    C = np.cos(wl).real
+    S = np.where(small, length, (np.sin(wl) / np.where(small, 1.0, w)).real)
+    Cp = (-w * np.sin(wl)).real
+    return C, S, Cp
+
+
+def quad_matrix(kq, length, tilt=0.0):
+    """Thick quadrupole transfer matrix.
+
+    Parameters
+    ----------
+    kq : float or ndarray
+        Quadrupole strength [1/m^2]. Positive values focus in x.
+    length : float or ndarray
+        Quadrupole length [m].
+    tilt : float or ndarray
+        Tilt angle about the longitudinal axis [rad].
+
+    Returns
+    -------
+    ndarray, shape (..., 4, 4)
+        The arguments are broadcast against each other.
+    """
+    kq, length, tilt = np.broadcast_arrays(
+        np.asarray(kq, dtype=float), np.asarray(length, dtype=float),
+        np.asarray(tilt, dtype=float))
+    M = np.zeros(kq.shape + (4, 4))
+    for lo, k in zip((0, 2), (kq, -kq)):
+        C, S, Cp = _quad_block(k, length)
+        M[..., lo, lo] = C
+        M[..., lo, lo + 1] = S
+        M[..., lo + 1, lo] = Cp
+        M[..., lo + 1, lo + 1] = C
+    if np.any(tilt != 0):
+        M = np.matmul(rotation_matrix_4D(-tilt), np.matmul(M, rotation_matrix_4D(tilt)))
+    return M
+
+
+class LinearModel:
+    """Transfer matrices to the wire-scanners as a function of quad settings.
+
+    The beamline is stored as a sequence of fixed 4x4 matrices and
+    quadrupole slices. Consecutive fixed matrices are multiplied together
+    once, when the model is created.
+
+    Attributes
+    ----------
+    quad_source : ndarray, shape (n_quads,)
+        For each quadrupole, the index of the independent power supply which
+        sets its strength, or -1 if its strength is fixed.
+    fixed_kq : ndarray, shape (n_quads,)
+        The strengths of the quadrupoles which are not independently powered.
+    """
+    def __init__(self, sequence, ws_indices, quad_source, fixed_kq):
+        """Constructor.
+
+        Parameters
+        ----------
+        sequence : list
+            Each element is either a (4, 4) ndarray or a tuple
+            (quad_index, length) describing a quadrupole slice.
+        ws_indices : list[int]
+            The wire-scanner transfer matrices are the product of
+            `sequence[:i]` for i in `ws_indices`.
+        quad_source, fixed_kq : array-like
+            See the class attributes.
+        """
+        self.quad_source = np.asarray(quad_source, dtype=int)
+        self.fixed_kq = np.asarray(fixed_kq, dtype=float)
+        self.n_ws = len(ws_indices)
+        # Compress the sequence into [(fixed matrix, quad slice or None,
+        # wire-scanner indices at the end of the step), ...].
+        self._steps = []
+        self._part_quads, self._part_lengths = [], []
+        ws_at = {}
+        for ws_index, i in enumerate(ws_indices):
+            ws_at.setdefault(i, []).append(ws_index)
+        M = np.identity(4)
+        for i in range(len(sequence) + 1):
+            if i in ws_at:
+                self._steps.append((M, None, ws_at[i]))
+                M = np.identity(4)
+            if i == len(sequence):
+                break
+            item = sequence[i]
+            if isinstance(item, tuple):
+                quad_index, length = item
+                self._steps.append((M, len(self._part_quads), []))
+                self._part_quads.append(quad_index)
+                self._part_lengths.append(length)
+                M = np.identity(4)
+            else:
+                M = np.matmul(item, M)
+        self._part_quads = np.array(self._part_quads, dtype=int)
+        self._part_lengths = np.array(self._part_lengths)
+
+    def get_kq(self, ind_strengths):
+        """Return strengths of all quads from independent strengths."""
+        ind_strengths = np.asarray(ind_strengths, dtype=float)
+        source = np.clip(self.quad_source, 0, None)
+        return np.where(self.quad_source >= 0, ind_strengths[..., source],
+                        self.fixed_kq)
+
+    def transfer_matrices(self, ind_strengths, tilts=None):
+        """Return the transfer matrix at each wire-scanner.
+
+        Parameters
+        ----------
+        ind_strengths : ndarray, shape (..., n_ind)
+            Independent quadrupole strengths.
+        tilts : ndarray, shape (..., n_quads)
+            Tilt angle of every quadrupole [rad]. Broadcast against
+            `ind_strengths`.
+
+        Returns
+        -------
+        ndarray, shape (..., n_ws, 4, 4)
+        """
+        kq = self.get_kq(ind_strengths)
+        if tilts is None:
+            tilts = np.zeros(kq.shape[-1])
+        kq, tilts = np.broadcast_arrays(kq, np.asarray(tilts, dtype=float))
+        parts = quad_matrix(kq[..., self._part_quads], self._part_lengths,
+                            tilts[..., self._part_quads])
+        batch_shape = kq.shape[:-1]
+        out = np.zeros(batch_shape + (self.n_ws, 4, 4))
+        M = np.broadcast_to(np.identity(4), batch_shape + (4, 4))
+        for fixed, part, ws_list in self._steps:
+            M = np.matmul(fixed, M)
+            if part is not None:
+                M = np.matmul(parts[..., part, :, :], M)
+            for ws_index in ws_list:
+                out[..., ws_index, :, :] = M
+        return out
+
+
+def transform_cov(transfer_mats, Sigma):
+    """Return M * Sigma * M^T (broadcast over leading dimensions)."""
+    return np.matmul(transfer_mats, np.matmul(Sigma, np.swapaxes(transfer_mats, -1, -2)))
+
+
+def wire_moments(Sigma, diag_wire_angle, diag_wire_angle_error=0.0,
+                 frac_noise=(0.0, 0.0, 0.0), rng=None):
+    """Return the [<xx>, <yy>, <xy>] moments measured by a wire-scanner.
+
+    The diagonal wire measures <uu>, where u = x cos(phi) + y sin(phi). The
+    <xy> moment is computed from <uu> using the nominal angle, so an error in
+    the wire angle biases <xy>.
+
+    Parameters
+    ----------
+    Sigma : ndarray, shape (..., 4, 4)
+        Covariance matrix at the wire-scanner.
+    diag_wire_angle : float
+        Nominal angle of the diagonal wire [rad].
+    diag_wire_angle_error : float or ndarray
+        Difference between the true and nominal wire angle [rad].
+    frac_noise : (x, y, u)
+        Standard deviation of the fractional error in the <xx>, <yy> and
+        <uu> moments (see `bin_count_noise`).
+    rng : numpy.random.RandomState
+        Random number generator for the noise.
+
+    Returns
+    -------
+    ndarray, shape (..., 3)
+    """
+    rng = np.random if rng is None else rng
+    xx, yy, xy = Sigma[..., 0, 0], Sigma[..., 2, 2], Sigma[..., 0, 2]
+    phi = diag_wire_angle + np.asarray(diag_wire_angle_error)
+    uu = xx * np.cos(phi)**2 + yy * np.sin(phi)**2 + 2 * xy * np.sin(phi) * np.cos(phi)
+    measured = []
+    for moment, noise in zip((xx, yy, uu), frac_noise):
+        if noise:
+            moment = moment * (1.0 + noise * rng.normal(size=moment.shape))
+        measured.append(moment)
+    xx, yy, uu = measured
+    c, s = np.cos(diag_wire_angle), np.sin(diag_wire_angle)
+    xy = (uu - xx * c**2 - yy * s**2) / (2 * s * c)
+    return np.stack([xx, yy, xy], axis=-1)
+
+
+def bin_count_noise(n_bins, max_frac_bin_count_error, profile='kv', n_rms=4.0):
+    """Fractional error in a second moment computed from noisy bin counts.
+
+    Each bin count is multiplied by (1 + e), where e is uniform in
+    [-max_frac_bin_count_error, max_frac_bin_count_error]. To first order the
+    error in the measured <uu> is sum_i p_i e_i (u_i^2 - <uu>), where p_i is
+    the fraction of particles in bin i, so its variance can be computed
+    directly from the profile shape.
+
+    Parameters
+    ----------
+    n_bins : int
+        Number of wire-scanner bins spanning the profile.
+    max_frac_bin_count_error : float
+        Maximum fractional error in each bin count.
+    profile : {'kv', 'gaussian'}
+        The 1D beam profile. 'kv' is the projection of a uniformly filled
+        ellipse (such as the Danilov distribution).
+    n_rms : float
+        Half-width of a Gaussian profile in units of the rms size.
+
+    Returns
+    -------
+    float
+        Standard deviation of the fractional error in <uu>.
+    """
+    if profile == 'kv':
+        edges = np.linspace(-1.0, 1.0, n_bins + 1)
+        centers = 0.5 * (edges[:-1] + edges[1:])
+        p = np.sqrt(1.0 - centers**2)
+    elif profile == 'gaussian':
+        edges = np.linspace(-n_rms, n_rms, n_bins + 1)
+        centers = 0.5 * (edges[:-1] + edges[1:])
+        p = np.exp(-0.5 * centers**2)
+    else:
+        raise ValueError("profile must be 'kv' or 'gaussian'")
+    p /= np.sum(p)
+    m2 = np.sum(p * centers**2)
+    var = (max_frac_bin_count_error**2 / 3.0) * np.sum(p**2 * (centers**2 - m2)**2)
+    return np.sqrt(var) / m2
+
+
+def simulate_scan(model, Sigma0, ind_strengths_list, error_model, n_trials,
+                  ws_bins, diag_wire_angle, ref_momentum=1.0,
+                  true_momenta=None, profile='kv', rng=None):
+    """Simulate the wire-scanner measurement with random errors.
+
+    The errors are drawn the same way as in the tracking scripts: field
+    errors are applied to the independent strengths at every optics setting,
+    the energy error scales the independent strengths, and the quad tilts
+    change once per trial. The returned transfer matrices are the ones
+    the reconstruction would use; they include the field and energy errors
+    but not the tilts.
+
+    Parameters
+    ----------
+    model : LinearModel
+        Linear model of the beamline.
+    Sigma0 : ndarray, shape (4, 4), (n_trials, 4, 4) or (n_trials, n_scans, 4, 4)
+        Initial covariance matrix.
+    ind_strengths_list : ndarray, shape (n_scans, n_ind)
+        Nominal independent quad strengths at each optics setting.
+    error_model : dict
+        Error switches ('errors') and magnitudes ('max_frac_field_error',
+        'max_quad_tilt_angle', 'max_diag_wire_angle_error',
+        'max_frac_bin_count_error').
+    n_trials : int
+        Number of trials.
+    ws_bins : int
+        Number of wire-scanner bins.
+    diag_wire_angle : float
+        Nominal angle of the diagonal wire [rad].
+    ref_momentum : float
+        Design momentum.
+    true_momenta : ndarray, shape (n_trials,)
+        Actual beam momentum in each trial. Only used if the 'energy' error
+        is switched on.
+    profile : {'kv', 'gaussian'}
+        Beam profile shape used for the bin count errors.
+    rng : numpy.random.RandomState
+        Random number generator.
+
+    Returns
+    -------
+    transfer_mats : ndarray, shape (n_trials, n_scans, n_ws, 4, 4)
+    moments : ndarray, shape (n_trials, n_scans, n_ws, 3)
+    """
+    rng = np.random if rng is None else rng
+    errors = error_model['errors']
+    ind_strengths = np.tile(np.asarray(ind_strengths_list, dtype=float),
+                            (n_trials, 1, 1))
+    n_quads = len(model.quad_source)
+
+    if errors.get('quad fields'):
+        max_frac = error_model['max_frac_field_error']
+        ind_strengths *= rng.uniform(1 - max_frac, 1 + max_frac, size=ind_strengths.shape)
+    if errors.get('energy'):
+        ind_strengths *= (ref_momentum / np.asarray(true_momenta))[:, np.newaxis, np.newaxis]
+    tilts = np.zeros((n_trials, 1, n_quads))
+    if errors.get('quad tilt angles'):
+        max_angle = error_model['max_quad_tilt_angle']
+        tilts = rng.uniform(-max_angle, max_angle, size=(n_trials, 1, n_quads))
+
+    true_mats = model.transfer_matrices(ind_strengths, tilts)
+    if np.any(tilts != 0):
+        transfer_mats = model.transfer_matrices(ind_strengths)
+    else:
+        transfer_mats = true_mats
+
+    Sigma0 = np.asarray(Sigma0, dtype=float)
+    if Sigma0.ndim == 3:
+        Sigma0 = Sigma0[:, np.newaxis]
+    if Sigma0.ndim == 4:
+        Sigma0 = Sigma0[:, :, np.newaxis]
+    Sigma = transform_cov(true_mats, Sigma0)
+
+    angle_error = 0.0
+    if errors.get('diag wire angle'):
+        max_angle = error_model['max_diag_wire_angle_error']
+        angle_error = rng.uniform(-max_angle, max_angle, size=Sigma.shape[:-2])
+    frac_noise = (0.0, 0.0, 0.0)
+    if errors.get('bin counts'):
+        noise = bin_count_noise(ws_bins, error_model['max_frac_bin_count_error'], profile)
+        frac_noise = (noise, noise, noise)
+    moments = wire_moments(Sigma, diag_wire_angle, angle_error, frac_noise, rng)
+    return transfer_mats, moments
@@ -23,6 +23,7 @@ from tools.utils import delete_files_not_folders
 
 sys.path.append('/Users/46h/Research/code/accphys/pyorbit/measurement')
 from utils import PhaseController
+from scan_store import ScanStore
 
 
 # Settings
@@ -167,6 +168,20 @@ for ws in ws_names:
     np.save('_output/data/{}/moments.npy'.format(ws), moments[ws])
     np.save('_output/data/{}/env_params.npy'.format(ws), env_params[ws])
     
+settings = {
+    'mass': mass, 'kin_energy': kin_energy, 'intensity': intensity,
+    'bunch_length': bunch_length, 'nparts': nparts, 'eps': eps, 'mode': mode,
+    'ex_frac': ex_frac, 'init_twiss': init_twiss, 'ref_ws_name': ref_ws_name,
+    'steps_per_dim': steps_per_dim, 'method': method, 'ws_bins': ws_bins,
+    'phase_coverage': phase_coverage, 'max_betas': max_betas,
+    'diag_wire_angle': diag_wire_angle, 'gridpts': gridpts,
+    'max_solver_spacing': max_solver_spacing,
+    'min_solver_spacing': min_solver_spacing,
+}
+data = {'phases': ws_phases, 'transfer_mats': transfer_mats, 
+        'moments': moments, 'env_params': env_params}
+ScanStore.write('_output/data/store/', ws_names, data, settings, latfile)
+    
 np.save('_output/data/Sigma0_env.npy', env.cov())
 np.savetxt('_output/data/Sigma0.dat', np.cov(X0.T))
 np.savetxt('_output/data/X0.dat', X0)
\ No newline at end of file
@@ -0,0 +1,198 @@
+"""Indexed on-disk store for wire-scanner scan data.
+
+The scan data is kept in one columnar table with one row per (scan index,
+wire-scanner) pair. Each column is saved as its own .npy file and is loaded
+as a memory map, so selecting a subset of rows does not read the whole file.
+
+    directory/
+        index.json          -- wire-scanner names, columns, hashes
+        scan_index.npy      -- (n_rows,) int
+        ws_index.npy        -- (n_rows,) int, index into `ws_names`
+        phases.npy          -- (n_rows, 2)
+        transfer_mats.npy   -- (n_rows, 4, 4)
+        moments.npy         -- (n_rows, 3)
+        env_params.npy      -- (n_rows, 8), optional
+        cache/              -- cached analysis results
+
+The store records a hash of the lattice file and of the scan settings, as
+well as a hash of all the inputs (settings plus column data). Results cached
+with `ScanStore.cached` are keyed by the input hash, so they are recomputed
+automatically when the scan is rewritten with different inputs.
+"""
+import os
+import json
+
+import numpy as np
+
+from data_analysis import reconstruct
+from tools.cache import func_name, hash_items, makedirs
+
+
+COLUMNS = ['phases', 'transfer_mats', 'moments', 'env_params']
+
+
+def hash_file(filename):
+    """Return SHA-1 hash of the file contents."""
+    with open(filename, 'rb') as file:
+        return hash_items(file.read())
+
+
+def hash_settings(settings):
+    """Return hash of a dict of settings (independent of key order)."""
+    return hash_items(sorted(settings.items()))
+
+
+class ScanStore:
+    """Columnar store of scan data keyed by (scan index, wire-scanner).
+
+    Attributes
+    ----------
+    directory : str
+        Location of the store.
+    ws_names : list[str]
+        Wire-scanner names; the `ws_index` column indexes this list.
+    n_scans : int
+        Number of scans (optics settings).
+    lattice_hash, settings_hash, input_hash : str
+        Hashes of the lattice file, of the scan settings, and of all inputs
+        (lattice, settings and column data).
+    settings : dict
+        The scan settings.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json')) as file:
+            index = json.load(file)
+        self.ws_names = index['ws_names']
+        self.n_scans = index['n_scans']
+        self.columns = index['columns']
+        self.settings = index['settings']
+        self.lattice_hash = index['lattice_hash']
+        self.settings_hash = index['settings_hash']
+        self.input_hash = index['input_hash']
+        self._arrays = {}
+
+    @classmethod
+    def write(cls, directory, ws_names, data, settings=None, latfile=None):
+        """Write scan data and return the store.
+
+        Parameters
+        ----------
+        directory : str
+            Location of the store. Created if it does not exist.
+        ws_names : list[str]
+            Wire-scanner names.
+        data : dict
+            Maps each column name ('phases', 'transfer_mats', 'moments',
+            'env_params') to a dict {ws_name: list of values, one per scan}.
+            This is the layout used by the scan scripts. Missing columns are
+            skipped.
+        settings : dict
+            Scan settings (beam, optics, wire-scanner parameters). Must be
+            representable as JSON.
+        latfile : str
+            Lattice file used for the scan.
+        """
+        settings = dict() if settings is None else dict(settings)
+        makedirs(directory)
+        columns = [col for col in COLUMNS if col in data]
+        n_scans = len(data[columns[0]][ws_names[0]])
+        n_ws = len(ws_names)
+        # Rows are ordered by scan index, then by wire-scanner.
+        scan_index = np.repeat(np.arange(n_scans), n_ws)
+        ws_index = np.tile(np.arange(n_ws), n_scans)
+        arrays = {'scan_index': scan_index, 'ws_index': ws_index}
+        for col in columns:
+            stacked = np.stack([np.asarray(data[col][ws], dtype=float)
+                                for ws in ws_names], axis=1)
+            arrays[col] = stacked.reshape((n_scans * n_ws,) + stacked.shape[2:])
+
+        lattice_hash = hash_file(latfile) if latfile is not None else None
+        settings_hash = hash_settings(settings)
+        input_hash = hash_items(lattice_hash, settings_hash, ws_names,
+                                 *[arrays[col] for col in columns])
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+        index = {
+            'ws_names': list(ws_names),
+            'n_scans': n_scans,
+            'columns': columns,
+            'settings': settings,
+            'lattice_hash': lattice_hash,
+            'settings_hash': settings_hash,
+            'input_hash': input_hash,
+        }
+        with open(os.path.join(directory, 'index.json'), 'w') as file:
+            json.dump(index, file, indent=2, sort_keys=True)
+        return cls(directory)
+
+    @classmethod
+    def from_dirs(cls, directory, ws_names, data_dir='_output/data/', **kwargs):
+        """Convert the per-wire-scanner .npy files written by `scan.py`."""
+        data = {}
+        for col in COLUMNS:
+            filenames = [os.path.join(data_dir, ws, col + '.npy') for ws in ws_names]
+            if all(os.path.isfile(filename) for filename in filenames):
+                data[col] = {ws: np.load(filename)
+                             for ws, filename in zip(ws_names, filenames)}
+        return cls.write(directory, ws_names, data, **kwargs)
+
+    def __getitem__(self, name):
+        """Return a column (memory-mapped)."""
+        if name not in self._arrays:
+            filename = os.path.join(self.directory, name + '.npy')
+            self._arrays[name] = np.load(filename, mmap_mode='r')
+        return self._arrays[name]
+
+    def rows(self, ws=None, scans=None):
+        """Return row indices for the given wire-scanner(s) and scan(s)."""
+        mask = np.ones(len(self['scan_index']), dtype=bool)
+        if ws is not None:
+            if np.ndim(ws) == 0:
+                ws = [ws]
+            ws_index = [self.ws_names.index(name) for name in ws]
+            mask &= np.isin(self['ws_index'], ws_index)
+        if scans is not None:
+            mask &= np.isin(self['scan_index'], scans)
+        return np.where(mask)[0]
+
+    def get(self, name, ws=None, scans=None):
+        """Return column values for the selected rows (loaded into memory)."""
+        return np.asarray(self[name][self.rows(ws, scans)])
+
+    def cached(self, key, func, *args, **kwargs):
+        """Return `func(*args, **kwargs)`, cached on disk.
+
+        The cache file name contains a hash of the store's inputs and of the
+        function name and arguments (the full contents of any arrays), so
+        the result is recomputed if either changes. Results
+        for `key` computed from different inputs are removed.
+        """
+        cache_dir = os.path.join(self.directory, 'cache')
+        makedirs(cache_dir)
+        prefix = '{}_{}_'.format(key, self.input_hash[:16])
+        digest = hash_items(func_name(func), args, sorted(kwargs.items()))
+        filename = os.path.join(cache_dir, prefix + digest + '.npy')
+        if os.path.isfile(filename):
+            return np.load(filename)
+        result = np.asarray(func(*args, **kwargs))
+        for old in os.listdir(cache_dir):
+            # File names are '{key}_{input hash}_{digest}.npy'; keys may
+            # contain underscores or share a prefix.
+            if old.rsplit('_', 2)[0] == key and not old.startswith(prefix):
+                os.remove(os.path.join(cache_dir, old))
+        np.save(filename, result)
+        return result
+
+    def reconstruct(self, ws=None, scans=None):
+        """Reconstruct the covariance matrix from the selected rows (cached).
+
+        Returns
+        -------
+        ndarray, shape (4, 4)
+        """
+        rows = self.rows(ws, scans)
+        def _reconstruct(rows):
+            return reconstruct(np.asarray(self['transfer_mats'][rows]),
+                               np.asarray(self['moments'][rows]))
+        return self.cached('Sigma', _reconstruct, rows.tolist())
@@ -0,0 +1,188 @@
+"""Run Monte Carlo error-analysis trials in parallel.
+
+Each trial calls a user-supplied function with the error model and returns a
+dict of arrays. The trials are distributed over a process pool; every trial
+gets its own random seed (derived from a single master seed) so that a run
+can be reproduced trial-by-trial regardless of the number of processes or
+the order in which the trials complete. Finished trials are written to a
+checkpoint directory, so an interrupted run can be resumed by calling `run`
+again with the same settings.
+"""
+import os
+import time
+import multiprocessing
+
+import numpy as np
+
+
+class RunningStats:
+    """Running mean and standard deviation (Welford's algorithm)."""
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+
+    def push(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.count == 0:
+            self.mean = np.zeros_like(x)
+            self._m2 = np.zeros_like(x)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+
+    def std(self):
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return np.sqrt(self._m2 / self.count)
+
+
+def trial_seeds(seed, n_trials):
+    """Return a reproducible random seed for each trial."""
+    return np.random.RandomState(seed).randint(0, 2**31 - 1, size=n_trials)
+
+
+# The trial function and error model are stored here by the parent process
+# before the pool is created so that forked workers inherit them.
+_worker_state = {}
+
+
+def _run_trial(args):
+    trial, seed = args
+    np.random.seed(seed)
+    result = _worker_state['func'](_worker_state['error_model'])
+    return trial, {key: np.asarray(val) for key, val in result.items()}
+
+
+class ErrorAnalysis:
+    """Parallel, resumable Monte Carlo error analysis.
+
+    Attributes
+    ----------
+    trial_func : callable
+        Function which runs one trial. It is called as
+        `trial_func(error_model)` and must return a dict of arrays, e.g.
+        {'emittances': [eps1, eps2, epsx, epsy]}. The global NumPy random
+        state is seeded before each call. Random numbers drawn outside of
+        NumPy (such as inside PyORBIT C++ classes) are not reproducible.
+    error_model : dict
+        The error switches and magnitudes, e.g. {'errors': {...},
+        'max_frac_field_error': 0.02, ...}.
+    n_trials : int
+        Total number of trials.
+    seed : int
+        Master random seed.
+    processes : int or None
+        Number of worker processes. If None, use all available cores. If 1,
+        the trials are run in the current process.
+    checkpoint_dir : str or None
+        Directory in which to save each finished trial. If None, nothing is
+        saved and the run cannot be resumed.
+    stats_key : str
+        The key of the trial output used to compute running statistics.
+    verbose : bool
+        Whether to print the running statistics as the trials finish.
+    """
+    def __init__(self, trial_func, error_model, n_trials, seed=0,
+                 processes=None, checkpoint_dir=None, stats_key='emittances',
+                 verbose=True):
+        self.trial_func = trial_func
+        self.error_model = error_model
+        self.n_trials = n_trials
+        self.seed = seed
+        self.processes = processes
+        self.checkpoint_dir = checkpoint_dir
+        self.stats_key = stats_key
+        self.verbose = verbose
+        self.seeds = trial_seeds(seed, n_trials)
+        self.stats = RunningStats()
+
+    def _trial_filename(self, trial):
+        return os.path.join(self.checkpoint_dir, 'trial_{:05d}.npz'.format(trial))
+
+    def _check_checkpoint(self):
+        """Make sure checkpoint directory belongs to this error model/seed."""
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        settings = repr(sorted(self.error_model.items())) + '\nseed = {}\n'.format(self.seed)
+        filename = os.path.join(self.checkpoint_dir, 'settings.txt')
+        if os.path.isfile(filename):
+            with open(filename) as file:
+                if file.read() != settings:
+                    raise ValueError(
+                        'Checkpoint directory {} was created with different '
+                        'settings.'.format(self.checkpoint_dir))
+        else:
+            with open(filename, 'w') as file:
+                file.write(settings)
+
+    def _save_trial(self, trial, result):
+        filename = self._trial_filename(trial)
+        tmp_filename = filename[:-4] + '.tmp.npz'
+        np.savez(tmp_filename, **result)
+        os.rename(tmp_filename, filename)
+
+    def _load_finished(self):
+        results = {}
+        if self.checkpoint_dir is None:
+            return results
+        for trial in range(self.n_trials):
+            filename = self._trial_filename(trial)
+            if os.path.isfile(filename):
+                npz_file = np.load(filename)
+                results[trial] = {key: npz_file[key] for key in npz_file.files}
+        return results
+
+    def _finish(self, trial, result, results, start_time):
+        results[trial] = result
+        if self.checkpoint_dir is not None:
+            self._save_trial(trial, result)
+        if self.stats_key in result:
+            self.stats.push(result[self.stats_key])
+            if self.verbose:
+                print('Trial {} ({}/{} finished, {:.1f} s): mean = {}, std = {}'.format(
+                    trial, len(results), self.n_trials, time.time() - start_time,
+                    np.round(self.stats.mean, 4), np.round(self.stats.std(), 4)))
+
+    def run(self):
+        """Run all unfinished trials.
+
+        Returns
+        -------
+        dict
+            Each key of the trial output maps to an array with one row per
+            trial, ordered by trial index.
+        """
+        if self.checkpoint_dir is not None:
+            self._check_checkpoint()
+        results = self._load_finished()
+        self.stats = RunningStats()
+        for trial in sorted(results):
+            if self.stats_key in results[trial]:
+                self.stats.push(results[trial][self.stats_key])
+        todo = [(trial, self.seeds[trial]) for trial in range(self.n_trials)
+                if trial not in results]
+        if self.verbose and results:
+            print('Resuming: {} of {} trials already finished.'.format(
+                len(results), self.n_trials))
+
+        _worker_state['func'] = self.trial_func
+        _worker_state['error_model'] = self.error_model
+        start_time = time.time()
+        if self.processes == 1:
+            for args in todo:
+                trial, result = _run_trial(args)
+                self._finish(trial, result, results, start_time)
+        elif todo:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                for trial, result in pool.imap_unordered(_run_trial, todo):
+                    self._finish(trial, result, results, start_time)
+            finally:
+                pool.close()
+                pool.join()
+
+        keys = results[0].keys() if results else []
+        return {key: np.array([results[trial][key] for trial in range(self.n_trials)])
+                for key in keys}
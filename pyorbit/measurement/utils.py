@@ -15,6 +15,8 @@ from orbit_utils import Matrix
 from orbit.teapot import TEAPOT_Lattice, TEAPOT_MATRIX_Lattice
 from orbit.utils import helper_funcs as hf
 
+from linear_errors import LinearModel
+
 
 # Global variables
 rtbt_ind_quad_names = ['q02', 'q03', 'q04', 'q05', 'q06', 'q12', 'q13',
@@ -24,6 +26,14 @@ rtbt_quad_coeff_lb = np.array([0, -4.35, 0, -7.95, 0, 0, -5.53,
                                0, -4.35, 0, -4.35, 0, -5.53])
 rtbt_quad_coeff_ub = np.array([5.5, 0, 5.5, 0, 7.95, 5.53, 
                                0, 4.35, 0, 4.35, 0, 5.53, 0])
+
+# Quads which share a power supply with one of the independent quads
+rtbt_shared_quad_names = {
+    'q05': ['q07', 'q09', 'q11'],
+    'q06': ['q08', 'q10'],
+    'q18': ['q20', 'q22', 'q24'],
+    'q19': ['q21', 'q23', 'q25'],
+}
     
         
 def unpack(tracked_twiss):
@@ -56,17 +66,63 @@ def set_rtbt_ind_quad_strengths(lattice, quad_strengths):
         node.setParam('kq', kq)
 
     # Handle shared power supplies
-    def set_strengths(names, kq):
-        for name in names:
-            node = lattice.getNodeForName(name)
+    for name, kq in zip(rtbt_ind_quad_names, quad_strengths):
+        for shared_name in rtbt_shared_quad_names.get(name, []):
+            node = lattice.getNodeForName(shared_name)
             node.setParam('kq', kq)
-      
-    (k02, k03, k04, k05, k06, k12, 
-     k13, k14, k15, k16, k17, k18, k19) = quad_strengths
-    set_strengths(['q07', 'q09', 'q11'], k05)
-    set_strengths(['q08', 'q10'], k06)
-    set_strengths(['q20', 'q22', 'q24'], k18)
-    set_strengths(['q21', 'q23', 'q25'], k19)
+    
+    
+def get_linear_model(lattice, matlat, ws_names):
+    """Return `LinearModel` of the transfer matrices to each wire-scanner.
+    
+    The quadrupole matrices in `matlat` are replaced by thick quadrupole
+    matrices whose strengths are set by the independent quad strengths. All 
+    other matrices are kept fixed.
+    
+    Parameters
+    ----------
+    lattice : TEAPOT_Lattice
+        The lattice. Quads which are not independently powered keep their
+        current strengths.
+    matlat : TEAPOT_MATRIX_Lattice
+        Linear matrix representation of `lattice`.
+    ws_names : list[str]
+        Names of the wire-scanner nodes.
+    """
+    quad_nodes = [node for node in lattice.getNodes() 
+                  if node.getType() == 'quad teapot']
+    quad_index = {node.getName(): i for i, node in enumerate(quad_nodes)}
+    source = {}
+    for i, name in enumerate(rtbt_ind_quad_names):
+        source[name] = i
+        for shared_name in rtbt_shared_quad_names.get(name, []):
+            source[shared_name] = i
+    quad_source = [source.get(node.getName(), -1) for node in quad_nodes]
+    fixed_kq = [node.getParam('kq') for node in quad_nodes]
+    
+    sequence = []
+    ws_indices = len(ws_names) * [None]
+    for matrix_node in matlat.getNodes():
+        for k, ws_name in enumerate(ws_names):
+            if ws_indices[k] is None and matrix_node.getName().startswith(ws_name):
+                ws_indices[k] = len(sequence)
+        if not isinstance(matrix_node, BaseMATRIX):
+            continue
+        parent_node = matrix_node.getParam('matrix_parent_node')
+        if parent_node.getName() in quad_index:
+            sequence.append((quad_index[parent_node.getName()], 
+                             matrix_node.getLength()))
+        else:
+            matrix = matrix_node.getMatrix()
+            M = np.zeros((4, 4))
+            for i in range(4):
+                for j in range(4):
+                    M[i, j] = matrix.get(i, j)
+            sequence.append(M)
+    for ws_name, ws_index in zip(ws_names, ws_indices):
+        if ws_index is None:
+            raise ValueError("Wire-scanner '{}' not found in lattice.".format(ws_name))
+    return LinearModel(sequence, ws_indices, quad_source, fixed_kq)
     
         
         
@@ -144,6 +200,10 @@ class PhaseController:
         """Adjust quad strengths in `lattice` to current controller state."""
         set_rtbt_ind_quad_strengths(lattice, self.get_quad_strengths())
         
+    def get_linear_model(self, ws_names):
+        """Return `LinearModel` of the transfer matrices to the wire-scanners."""
+        return get_linear_model(self.lattice, self.matlat, ws_names)
+        
     def get_transfer_matrix(self, node_name):
         """Calculate linear transfer matrix up to a certain node."""
         matrix = Matrix(7, 7)
@@ -0,0 +1,148 @@
+"""Wire-scanner emulator which does not depend on PyORBIT.
+
+The beam is binned along the horizontal (x), vertical (y) and diagonal (u)
+wires, where u = x cos(phi) + y sin(phi) and phi is the angle of the diagonal
+wire. The rms moments <xx>, <yy> and <xy> are computed from the histograms;
+<xy> is found from <uu> using the nominal wire angle. All wires of all frames
+are binned with a single call to `np.bincount`.
+"""
+import numpy as np
+
+
+def bin_centers(edges):
+    """Return bin centers from bin edges (along the last axis)."""
+    return 0.5 * (edges[..., :-1] + edges[..., 1:])
+
+
+def moments_from_hists(hists, edges, diag_wire_angle):
+    """Return [<xx>, <yy>, <xy>] from wire-scanner histograms.
+
+    Parameters
+    ----------
+    hists : ndarray, shape (..., 3, n_bins)
+        Bin counts of the x, y and diagonal wires.
+    edges : ndarray, shape (..., 3, n_bins + 1)
+        Bin edges of each wire.
+    diag_wire_angle : float
+        Nominal angle of the diagonal wire [rad].
+
+    Returns
+    -------
+    ndarray, shape (..., 3)
+    """
+    centers = bin_centers(edges)
+    total = np.sum(hists, axis=-1)
+    mean = np.sum(hists * centers, axis=-1) / total
+    var = np.sum(hists * (centers - mean[..., np.newaxis])**2, axis=-1) / total
+    xx, yy, uu = var[..., 0], var[..., 1], var[..., 2]
+    c, s = np.cos(diag_wire_angle), np.sin(diag_wire_angle)
+    xy = (uu - xx * c**2 - yy * s**2) / (2 * s * c)
+    return np.stack([xx, yy, xy], axis=-1)
+
+
+class WireScanner:
+    """Emulates `WireScannerNode` on coordinate arrays.
+
+    Attributes
+    ----------
+    n_bins : int
+        Number of bins along each wire.
+    diag_wire_angle : float
+        Nominal angle of the diagonal wire [rad].
+    max_diag_wire_angle_error : float
+        The true wire angle is drawn uniformly from the nominal angle plus or
+        minus this value for each measurement [rad].
+    max_frac_bin_count_error : float
+        Each bin count is multiplied by (1 + e), where e is drawn uniformly
+        from [-max_frac_bin_count_error, max_frac_bin_count_error].
+    hists, edges : ndarray
+        Histograms and bin edges of the last measurement, with shapes
+        (..., 3, n_bins) and (..., 3, n_bins + 1).
+    """
+    def __init__(self, n_bins=25, diag_wire_angle=np.radians(30.0), rng=None):
+        self.n_bins = n_bins
+        self.diag_wire_angle = diag_wire_angle
+        self.max_diag_wire_angle_error = 0.0
+        self.max_frac_bin_count_error = 0.0
+        self.rng = np.random if rng is None else rng
+        self.hists = None
+        self.edges = None
+
+    def set_diag_wire_angle_error(self, max_angle_error):
+        self.max_diag_wire_angle_error = max_angle_error
+
+    def set_frac_bin_count_error(self, max_frac_error):
+        self.max_frac_bin_count_error = max_frac_error
+
+    def wire_coords(self, X, angles=None):
+        """Return the (x, y, u) coordinates seen by the wires.
+
+        X has shape (..., nparts, 4); the result has shape (..., 3, nparts).
+        `angles` is the true diagonal wire angle for each frame.
+        """
+        if angles is None:
+            angles = self.diag_wire_angle
+        angles = np.asarray(angles)[..., np.newaxis]
+        x, y = X[..., 0], X[..., 2]
+        u = x * np.cos(angles) + y * np.sin(angles)
+        return np.stack([x, y, u], axis=-2)
+
+    def histogram(self, X, limits=None):
+        """Bin the particles along each wire.
+
+        Parameters
+        ----------
+        X : ndarray, shape (nparts, 4) or (n_frames, nparts, 4)
+            Transverse coordinates [x, x', y, y'].
+        limits : ndarray, shape (..., 3, 2) or None
+            (min, max) of the bins of each wire. If None, each wire spans
+            the range of the particle coordinates.
+
+        Returns
+        -------
+        hists : ndarray, shape (..., 3, n_bins)
+        edges : ndarray, shape (..., 3, n_bins + 1)
+        """
+        X = np.asarray(X, dtype=float)
+        angles = self.diag_wire_angle
+        if self.max_diag_wire_angle_error:
+            err = self.max_diag_wire_angle_error
+            angles = angles + self.rng.uniform(-err, err, size=X.shape[:-2])
+        U = self.wire_coords(X, angles)
+        if limits is None:
+            lo, hi = np.min(U, axis=-1), np.max(U, axis=-1)
+        else:
+            limits = np.broadcast_to(limits, U.shape[:-1] + (2,))
+            lo, hi = limits[..., 0], limits[..., 1]
+        width = np.where(hi > lo, hi - lo, 1.0)
+        idx = np.floor(self.n_bins * (U - lo[..., np.newaxis]) / width[..., np.newaxis])
+        # The last bin is closed on the right, as in np.histogram.
+        idx[U == hi[..., np.newaxis]] = self.n_bins - 1
+        inside = (idx >= 0) & (idx < self.n_bins)
+        idx = np.clip(idx, 0, self.n_bins - 1).astype(np.intp)
+        # Offset the bin indices so that every (frame, wire) pair has its
+        # own block of bins.
+        n_hists = int(np.prod(U.shape[:-1]))
+        offsets = self.n_bins * np.arange(n_hists).reshape(U.shape[:-1] + (1,))
+        hists = np.bincount((idx + offsets)[inside], minlength=n_hists * self.n_bins)
+        hists = hists.reshape(U.shape[:-1] + (self.n_bins,)).astype(float)
+        if self.max_frac_bin_count_error:
+            err = self.max_frac_bin_count_error
+            hists *= self.rng.uniform(1 - err, 1 + err, size=hists.shape)
+        frac = np.linspace(0.0, 1.0, self.n_bins + 1)
+        edges = lo[..., np.newaxis] + (hi - lo)[..., np.newaxis] * frac
+        self.hists, self.edges = hists, edges
+        return hists, edges
+
+    def measure(self, X, limits=None):
+        """Return [<xx>, <yy>, <xy>] for each frame in X.
+
+        See `histogram` for the parameters. The returned array has shape
+        (3,) or (n_frames, 3).
+        """
+        hists, edges = self.histogram(X, limits)
+        return moments_from_hists(hists, edges, self.diag_wire_angle)
+
+    def get_moments(self):
+        """Return moments from the last measurement."""
+        return moments_from_hists(self.hists, self.edges, self.diag_wire_angle)
@@ -41,10 +41,10 @@ min_solver_spacing = 1e-6 # [m]
 
 # Tracking
 lattice = hf.fodo_lattice(mu_x0, mu_y0, cell_length, fill_fac=0.5, start='quad')
-matcher = Matcher(lattice, kin_energy, eps_x, eps_y)
+matcher = Matcher(lattice, kin_energy, eps_x, eps_y, cache_dir='data/tune_tables/')
 for i, mu in enumerate(depressed_tunes):
     mu_x = mu_y = mu
-    perveance = matcher.set_tunes(mu_x, mu_y, verbose=2)
+    perveance = matcher.set_tunes(mu_x, mu_y)
     sizes = matcher.track(perveance, n_cells)
     np.save('data/sizes_{}.npy'.format(i), sizes)
 np.save('data/depressed_tunes.npy', depressed_tunes)
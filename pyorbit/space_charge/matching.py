@@ -1,4 +1,6 @@
+import os
 import sys
+import hashlib
 import numpy as np
 from scipy import optimize as opt
 from tqdm import trange
@@ -26,14 +28,31 @@ class Matcher:
     matched_params : ndarray
         Gives following parameters as function of positions s: [rx, rxp, ry,
         ryp, Dx, Dxp, s].
+    table_perveances : ndarray
+        Perveances in the table of depressed tunes (see `build_table`).
+    table_tunes : ndarray, shape (n, 2)
+        Depressed tunes [deg] at each perveance in the table.
     """
-    def __init__(self, lattice, kin_energy, eps_x, eps_y):
+    def __init__(self, lattice, kin_energy, eps_x, eps_y, cache_dir=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        lattice, kin_energy, eps_x, eps_y :
+            See class attributes.
+        cache_dir : str or None
+            Directory of saved tune tables. If None, tables are not saved.
+        """
         self.eps_x = eps_x
         self.eps_y = eps_y
         self.sigma_p = 0.0
         bunch = Bunch()
         bunch.getSyncParticle().kinEnergy(kin_energy)
         self.solver = EnvelopeSolver(Optics().readtwiss_teapot(lattice, bunch))
+        self.cache_dir = cache_dir
+        self.table_perveances = np.zeros(0)
+        self.table_tunes = np.zeros((0, 2))
+        self._table_file = None
         
     def match(self, perveance):
         """Find the matched beam for a given perveance."""
@@ -55,8 +74,21 @@ class Matcher:
         mu_x, mu_y = self.solver.phase_advance(rx, ry, Dx, self.eps_x, self.eps_y, self.sigma_p, s)  
         return np.degrees([mu_x, mu_y])
     
-    def set_tunes(self, mu_x, mu_y, **kws):
-        """Set depressed tunes by varying space charge strength."""
+    def set_tunes(self, mu_x, mu_y, use_table=True, **kws):
+        """Set depressed tunes by varying space charge strength.
+
+        If `use_table` is True, the perveance is found from the table of
+        depressed tunes (built or extended as needed), followed by one
+        Gauss-Newton step with the exact tunes. Otherwise, the perveance is
+        found by least squares; key word arguments are passed to
+        `scipy.optimize.least_squares`.
+        """
+        if use_table:
+            if kws:
+                raise TypeError('Key word arguments ({}) are only used with '
+                                'use_table=False.'.format(', '.join(sorted(kws))))
+            return self._set_tunes_from_table(mu_x, mu_y)
+
         def cost(perveance):
             self.match(perveance)
             return np.subtract([mu_x, mu_y], self.tunes())
@@ -65,6 +97,116 @@ class Matcher:
         result = opt.least_squares(cost, guess, **kws)
         perveance = result.x[0]
         return perveance
+
+    # Table of depressed tunes vs. perveance
+    #--------------------------------------------------------------------------
+    def _tunes_at(self, perveance):
+        self.match(perveance)
+        return self.tunes()
+
+    def _cache_key(self):
+        """Return hash of the zero-current envelope, which identifies the
+        lattice and emittances."""
+        self.match(0.0)
+        rx, rxp, ry, ryp, Dx, Dxp, s = self.matched_params
+        sha = hashlib.sha1()
+        for array in (rx, rxp, ry, ryp, s):
+            sha.update(np.ascontiguousarray(np.round(array, 12)).tobytes())
+        sha.update(repr((self.eps_x, self.eps_y, self.sigma_p)).encode('utf-8'))
+        return sha.hexdigest()[:16]
+
+    def _load_table(self):
+        if self._table_file is not None or self.cache_dir is None:
+            return
+        self._table_file = os.path.join(
+            self.cache_dir, 'tune_table_{}.npz'.format(self._cache_key()))
+        if os.path.isfile(self._table_file):
+            npz_file = np.load(self._table_file)
+            self.table_perveances = npz_file['perveances']
+            self.table_tunes = npz_file['tunes']
+
+    def _save_table(self):
+        if self._table_file is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # Write then rename, so that other processes never read a partly
+        # written table.
+        tmp_filename = '{}.{}.tmp.npz'.format(self._table_file[:-4], os.getpid())
+        np.savez(tmp_filename, perveances=self.table_perveances, tunes=self.table_tunes)
+        os.rename(tmp_filename, self._table_file)
+
+    def _refine(self, samples, lo, hi, tol, min_step):
+        """Add midpoints to `samples` until linear interpolation between
+        lo and hi is accurate to `tol` [deg]."""
+        stack = [(lo, hi)]
+        while stack:
+            lo, hi = stack.pop()
+            if hi - lo < min_step:
+                continue
+            mid = 0.5 * (lo + hi)
+            samples[mid] = self._tunes_at(mid)
+            if np.max(np.abs(samples[mid] - 0.5 * (samples[lo] + samples[hi]))) > tol:
+                stack.extend([(lo, mid), (mid, hi)])
+
+    def build_table(self, mu_x_min, mu_y_min, tol=0.01, perveance_step=1e-6,
+                    max_doublings=40):
+        """Tabulate depressed tunes vs. perveance.
+
+        The table starts at zero perveance and is extended (by doubling the
+        largest perveance) until both depressed tunes are below `mu_x_min`
+        and `mu_y_min` [deg]; ValueError is raised if they are not reached
+        after `max_doublings`. New intervals are bisected until linear
+        interpolation of the tunes is accurate to `tol` [deg]. Existing
+        entries (including those loaded from `cache_dir`) are kept, so
+        repeated calls only add what is missing.
+        """
+        self._load_table()
+        samples = dict(zip(self.table_perveances, map(np.asarray, self.table_tunes)))
+        n_samples = len(samples)
+        if 0.0 not in samples:
+            samples[0.0] = self._tunes_at(0.0)
+        hi = max(samples)
+        if hi == 0.0:
+            hi = perveance_step
+            samples[hi] = self._tunes_at(hi)
+            self._refine(samples, 0.0, hi, tol, 1e-6 * hi)
+        for _ in range(max_doublings):
+            if samples[hi][0] <= mu_x_min and samples[hi][1] <= mu_y_min:
+                break
+            lo, hi = hi, 2.0 * hi
+            samples[hi] = self._tunes_at(hi)
+            if not np.all(np.isfinite(samples[hi])):
+                del samples[hi]
+                break
+            self._refine(samples, lo, hi, tol, 1e-6 * hi)
+        if len(samples) > n_samples:
+            self.table_perveances = np.array(sorted(samples))
+            self.table_tunes = np.array([samples[Q] for Q in self.table_perveances])
+            self._save_table()
+        if samples[hi][0] > mu_x_min or samples[hi][1] > mu_y_min:
+            raise ValueError(
+                'Tune table does not reach ({}, {}) deg; lowest tunes are ({}, {}) '
+                'deg at perveance {:.3e}.'.format(mu_x_min, mu_y_min, 
+                                                  samples[hi][0], samples[hi][1], hi))
+
+    def _set_tunes_from_table(self, mu_x, mu_y, n_fine=10000):
+        self.build_table(mu_x, mu_y)
+        Q, tunes = self.table_perveances, self.table_tunes
+        target = np.array([mu_x, mu_y])
+        # Least-squares solution on the interpolated table.
+        Q_fine = np.linspace(Q[0], Q[-1], n_fine)
+        tunes_fine = np.column_stack([np.interp(Q_fine, Q, tunes[:, i]) for i in range(2)])
+        i = np.argmin(np.sum((tunes_fine - target)**2, axis=1))
+        perveance = Q_fine[i]
+        # Polish with one Gauss-Newton step, using the slope of the table.
+        j = np.clip(np.searchsorted(Q, perveance), 1, len(Q) - 1)
+        slope = (tunes[j] - tunes[j - 1]) / (Q[j] - Q[j - 1])
+        residual = self._tunes_at(perveance) - target
+        if np.dot(slope, slope) > 0:
+            perveance = max(0.0, perveance - np.dot(slope, residual) / np.dot(slope, slope))
+        self.match(perveance)
+        return perveance
     
     def track(self, perveance, n_turns):
         """Return period-by-period x and y beam sizes."""
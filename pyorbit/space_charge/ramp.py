@@ -0,0 +1,155 @@
+"""Tools to ramp the quadrupole strengths of a lattice during tracking.
+
+The lattice and space charge solver are built once. `QuadRamp` finds the
+quadrupole strengths which give each bare-lattice phase advance in the ramp
+(before the lattice is split), then sets them in place, cell by cell.
+`MomentReducer` keeps the bunch moments after each cell in a preallocated
+array, plus optional coordinate snapshots written to disk every `stride`
+cells, so memory does not grow with the number of cells.
+"""
+import os
+import numpy as np
+from scipy import optimize as opt
+
+from bunch import Bunch
+from orbit.analysis.AnalysisNode import get_coords
+from orbit.teapot import teapot
+from orbit.teapot import TEAPOT_MATRIX_Lattice
+
+
+class QuadRamp:
+    """Set the phase advances of a lattice by scaling its quadrupoles.
+
+    The focusing (kq > 0) and defocusing (kq < 0) quadrupoles are scaled by
+    separate factors.
+
+    Attributes
+    ----------
+    lattice : TEAPOT_Lattice
+        The lattice to track with.
+    quad_nodes : list[QuadTEAPOT]
+        The quadrupole nodes in the lattice.
+    kq0 : ndarray
+        Initial quadrupole strengths.
+    strengths : ndarray, shape (n_steps, n_quads)
+        Quadrupole strengths at each step of the ramp (see `solve`).
+    """
+    def __init__(self, lattice, kin_energy):
+        self.lattice = lattice
+        self.bunch = Bunch()
+        self.bunch.getSyncParticle().kinEnergy(kin_energy)
+        self.quad_nodes = [node for node in lattice.getNodes()
+                           if isinstance(node, teapot.QuadTEAPOT)]
+        self.kq0 = np.array([node.getParam('kq') for node in self.quad_nodes])
+        self.focusing = self.kq0 > 0
+        self.strengths = None
+
+    def set_strengths(self, kq):
+        for node, k in zip(self.quad_nodes, kq):
+            node.setParam('kq', k)
+
+    def scaled_strengths(self, scale_f, scale_d):
+        return np.where(self.focusing, scale_f, scale_d) * self.kq0
+
+    def phase_advances(self):
+        """Return the bare lattice phase advances [deg]."""
+        matrix_lattice = TEAPOT_MATRIX_Lattice(self.lattice, self.bunch)
+        tune_x, _, _ = matrix_lattice.getRingTwissDataX()
+        tune_y, _, _ = matrix_lattice.getRingTwissDataY()
+        return 360.0 * np.array([tune_x[-1][1], tune_y[-1][1]])
+
+    def solve(self, mu_x, mu_y):
+        """Compute the quadrupole strengths for each step of the ramp.
+
+        This must be called before the lattice is split, since the matrix
+        lattice is built from the nodes. The initial strengths are restored
+        afterward.
+
+        Parameters
+        ----------
+        mu_x, mu_y : ndarray, shape (n_steps,)
+            Bare lattice phase advances at each step [deg].
+        """
+        def cost(scales, target):
+            self.set_strengths(self.scaled_strengths(*scales))
+            return self.phase_advances() - target
+
+        strengths = []
+        scales = np.ones(2)
+        for target in zip(mu_x, mu_y):
+            scales = opt.fsolve(cost, scales, args=(np.array(target),))
+            strengths.append(self.scaled_strengths(*scales))
+        self.strengths = np.array(strengths)
+        self.set_strengths(self.kq0)
+        return self.strengths
+
+    def set_step(self, i):
+        """Set the quadrupole strengths to step `i` of the ramp."""
+        self.set_strengths(self.strengths[i])
+
+
+class MomentReducer:
+    """Store the bunch moments and coordinate snapshots during tracking.
+
+    Attributes
+    ----------
+    moments : ndarray, shape (n_measurements, 10)
+        Upper triangle of the transverse covariance matrix at each
+        measurement.
+    coords : memmap, shape (n_snapshots, n_parts, 6) or None
+        Bunch coordinates (all columns returned by `get_coords`) every
+        `stride` measurements, starting with the first, written to
+        `filename`.
+    snapshot_indices : list[int]
+        Measurement index of each snapshot.
+    """
+    def __init__(self, n_measurements, n_parts=None, stride=None, filename=None,
+                 n_cols=6):
+        """Constructor.
+
+        Parameters
+        ----------
+        n_measurements : int
+            Maximum number of measurements.
+        n_parts : int
+            Number of particles in the bunch. Required for snapshots.
+        stride : int or None
+            Number of measurements between coordinate snapshots. If None, no
+            coordinates are saved.
+        filename : str
+            Name of the .npy file for the snapshots.
+        n_cols : int
+            Number of coordinates per particle.
+        """
+        self.moments = np.zeros((n_measurements, 10))
+        self.count = 0
+        self.stride = stride
+        self.coords = None
+        self.n_snapshots = 0
+        self.snapshot_indices = []
+        if stride is not None:
+            directory = os.path.dirname(filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            shape = ((n_measurements - 1) // stride + 1, n_parts, n_cols)
+            self.coords = np.lib.format.open_memmap(filename, mode='w+',
+                                                    dtype=np.float64, shape=shape)
+        self._idx = np.triu_indices(4)
+
+    def measure(self, bunch):
+        X = get_coords(bunch)
+        if self.stride is not None and self.count % self.stride == 0:
+            self.coords[self.n_snapshots] = X
+            self.snapshot_indices.append(self.count)
+            self.n_snapshots += 1
+        X = X[:, :4] - np.mean(X[:, :4], axis=0)
+        Sigma = np.dot(X.T, X) / (X.shape[0] - 1)
+        self.moments[self.count] = Sigma[self._idx]
+        self.count += 1
+
+    def close(self):
+        if self.coords is not None:
+            self.coords.flush()
+
+    def get_moments(self):
+        return self.moments[:self.count]
@@ -0,0 +1,91 @@
+"""
+This script compares adaptive space charge node placement (`sc_placement`)
+with uniform splitting on a ring made of dense FODO arcs and straight
+sections with long drifts. Only NumPy is needed: the beta functions come
+from thick-lens transfer matrices.
+
+For each uniform part length, the adaptive placement is found with
+`sc_placement.match_uniform`: both its largest error per kick and the error
+of its total kick are no larger than those of the uniform placement. The
+number of kicks and the errors of the two placements are printed.
+"""
+import numpy as np
+
+# Local
+import sc_placement
+
+
+# Settings
+#------------------------------------------------------------------------------
+arc_cell = (1.2, 0.5, 2.0) # (k [1/m^2], quad length [m], drift length [m])
+straight_cell = (0.25, 0.5, 6.0)
+n_arc_cells = 8
+n_straight_cells = 2
+n_superperiods = 2
+eps_x = 20e-6 # [m rad]
+eps_y = 20e-6 # [m rad]
+max_lengths = [2.0, 1.0, 0.5, 0.1] # uniform part lengths [m]
+n_samples = 20 # Twiss samples per element
+
+
+def quad_matrix(k, length):
+    if k == 0.0:
+        return np.array([[1.0, length], [0.0, 1.0]])
+    r = np.sqrt(abs(k))
+    if k > 0:
+        return np.array([[np.cos(r * length), np.sin(r * length) / r],
+                         [-r * np.sin(r * length), np.cos(r * length)]])
+    return np.array([[np.cosh(r * length), np.sinh(r * length) / r],
+                     [r * np.sinh(r * length), np.cosh(r * length)]])
+
+
+def fodo_cell(k, quad_length, drift_length):
+    """Return [(k, length), ...], starting and ending with a half quad."""
+    return [(k, 0.5 * quad_length), (0.0, drift_length), (-k, quad_length),
+            (0.0, drift_length), (k, 0.5 * quad_length)]
+
+
+def ring_twiss(elements, plane=1, n_samples=20):
+    """Return (s, alpha, beta) sampled inside each element (plane = +/-1)."""
+    M = np.identity(2)
+    for k, length in elements:
+        M = np.dot(quad_matrix(plane * k, length), M)
+    mu = np.arccos(0.5 * np.trace(M))
+    beta = M[0, 1] / np.sin(mu)
+    alpha = (M[0, 0] - M[1, 1]) / (2.0 * np.sin(mu))
+    T = np.array([[beta, -alpha], [-alpha, (1.0 + alpha**2) / beta]])
+    s, alphas, betas = [0.0], [alpha], [beta]
+    for k, length in elements:
+        step = quad_matrix(plane * k, length / n_samples)
+        for _ in range(n_samples):
+            T = np.linalg.multi_dot([step, T, step.T])
+            s.append(s[-1] + length / n_samples)
+            alphas.append(-T[0, 1])
+            betas.append(T[0, 0])
+    return np.array(s), np.array(alphas), np.array(betas)
+
+
+elements = n_superperiods * (n_arc_cells * fodo_cell(*arc_cell)
+                             + n_straight_cells * fodo_cell(*straight_cell))
+ends = np.cumsum([length for k, length in elements])
+starts = ends - [length for k, length in elements]
+s, alpha_x, beta_x = ring_twiss(elements, +1, n_samples)
+s, alpha_y, beta_y = ring_twiss(elements, -1, n_samples)
+sizes = sc_placement.sizes_from_twiss(s, alpha_x, beta_x, alpha_y, beta_y,
+                                      eps_x, eps_y)
+
+print('Ring length = {:.1f} m, beta_x = {:.2f} to {:.2f} m'.format(
+    ends[-1], np.min(beta_x), np.max(beta_x)))
+print('{:>10} {:>8} {:>8} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+    'max_length', 'kicks', 'kicks', 'max err', 'max err', 'tol', 'total err',
+    'total err'))
+print('{:>10} {:>8} {:>8} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+    '[m]', 'unif.', 'adapt.', 'unif.', 'adapt.', '', 'unif.', 'adapt.'))
+for max_length in max_lengths:
+    result = sc_placement.benchmark(starts, ends, sizes, max_length=max_length)
+    n_uniform, max_err_uniform, total_err_uniform = result['uniform']
+    n_adaptive, max_err_adaptive, total_err_adaptive = result['adaptive']
+    print('{:>10} {:>8d} {:>8d} {:>10.4f} {:>10.4f} {:>10.4f} {:>12.2e} {:>12.2e}'.format(
+        max_length, n_uniform, n_adaptive, max_err_uniform, max_err_adaptive,
+        result['tol'] if result['tol'] is not None else np.nan,
+        total_err_uniform, total_err_adaptive))
@@ -19,6 +19,7 @@ from orbit.utils import helper_funcs as hf
 
 # Local
 from matching import Matcher
+import sc_placement
 
     
 # Settings
@@ -41,7 +42,10 @@ mu_y = 45.0 # depressed vertical tune [deg]
 bunch_kind = 'gaussian' 
 
 # Space charge solver
+sc_placement_kind = 'uniform' # {'uniform', 'adaptive'}
 max_solver_spacing = 0.1 # [m]
+solver_tol = None # max relative error per kick ('adaptive' placement); if
+                  # None, match the accuracy of uniform `max_solver_spacing`
 min_solver_spacing = 1e-6 # [m]
 gridpts = (128, 128, 1) # (x, y, z)
 
@@ -49,10 +53,10 @@ gridpts = (128, 128, 1) # (x, y, z)
 # Generate rms matched distribution
 # ------------------------------------------------------------------------------
 lattice = hf.fodo_lattice(mu_x0, mu_y0, cell_length, fill_fac=0.5, start='quad')
-matcher = Matcher(lattice, kin_energy, eps_x, eps_y)
+matcher = Matcher(lattice, kin_energy, eps_x, eps_y, cache_dir='data/tune_tables/')
 
 print 'Setting depressed tunes.'
-perveance = matcher.set_tunes(mu_x, mu_y, verbose=2)
+perveance = matcher.set_tunes(mu_x, mu_y)
 intensity = hf.get_intensity(perveance, mass, kin_energy, bunch_length)
 print 'Matched beam:'
 print '    Perveance = {:.3e}'.format(perveance)
@@ -68,7 +72,23 @@ bunch, params_dict = hf.coasting_beam(bunch_kind, n_parts, matcher.twiss(), (eps
                                       bunch_length, mass, kin_energy, intensity, **kws)
 
 # Add space charge nodes
-lattice.split(max_solver_spacing)    
+if sc_placement_kind == 'adaptive':
+    rx, rxp, ry, ryp, Dx, Dxp, s = matcher.matched_params
+    sizes = sc_placement.sizes_from_envelope(s, rx, ry)
+    starts, ends = sc_placement.node_bounds(lattice)
+    if solver_tol is None:
+        node_parts, tol = sc_placement.match_uniform(starts, ends, sizes,
+                                                     max_solver_spacing)
+    else:
+        node_parts = sc_placement.plan_parts(starts, ends, sizes, tol=solver_tol,
+                                             max_length=cell_length)
+    uniform_node_parts = sc_placement.uniform_parts(starts, ends, max_solver_spacing)
+    print 'Space charge kicks per cell (kicks, max error, error of total):'
+    print '    adaptive:', sc_placement.evaluate(starts, ends, node_parts, sizes)
+    print '    uniform: ', sc_placement.evaluate(starts, ends, uniform_node_parts, sizes)
+    sc_placement.apply_plan(lattice, node_parts)
+else:
+    lattice.split(max_solver_spacing)    
 calc2p5d = SpaceChargeCalc2p5D(*gridpts)
 sc_nodes = setSC2p5DAccNodes(lattice, min_solver_spacing, calc2p5d)
 
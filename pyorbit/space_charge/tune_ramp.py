@@ -2,16 +2,21 @@
 This script tracks a coasting beam through a symmetric FODO lattice. The
 bare lattice tune is decreased slowly from 100 degrees to 90 degrees over
 500 cells.
+
+The lattice and space charge solver are built once; the quadrupole strengths
+are updated in place before each cell. The bunch moments are saved after
+each cell ('data/moments.npy'). The full bunch coordinates are saved every
+`snapshot_stride` cells ('data/coords_snapshots.npy', with the cell indices
+in 'data/snapshot_cells.npy').
 """
 import sys
 import numpy as np
 from scipy import optimize as opt
-from tqdm import trange, tqdm
+from tqdm import trange
 
 from bunch import Bunch
 from spacecharge import SpaceChargeCalc2p5D
 from orbit.analysis import AnalysisNode
-from orbit.analysis.AnalysisNode import get_coords
 from orbit.space_charge.sc2p5d.scLatticeModifications import setSC2p5DAccNodes
 from orbit.teapot import teapot
 from orbit.teapot import TEAPOT_Lattice
@@ -20,6 +25,8 @@ from orbit.utils import helper_funcs as hf
 
 # Local
 from matching import Matcher
+import sc_placement
+from ramp import QuadRamp, MomentReducer
 
     
 # Settings
@@ -42,14 +49,22 @@ mu_y = 92.2 # initial depressed vertical tune [deg]
 bunch_kind = 'kv' 
 
 # Space charge solver
+sc_placement_kind = 'uniform' # {'uniform', 'adaptive'}
 max_solver_spacing = 0.1 # [m]
+solver_tol = None # max relative error per kick ('adaptive' placement); if
+                  # None, match the accuracy of uniform `max_solver_spacing`
 min_solver_spacing = 1e-6 # [m]
 gridpts = (128, 128, 1) # (x, y, z)
 
+# Output
+snapshot_stride = 50 # cells between coordinate snapshots (None to skip)
+
 # Set initial depressed tunes
 lattice = hf.fodo_lattice(tunes_x[0], tunes_y[0], cell_length, fill_fac=0.5, start='quad')
-matcher = Matcher(lattice, kin_energy, eps_x, eps_y)
-perveance = matcher.set_tunes(mu_x, mu_y, verbose=2)
+ramp = QuadRamp(lattice, kin_energy)
+ramp.solve(tunes_x, tunes_y)
+matcher = Matcher(lattice, kin_energy, eps_x, eps_y, cache_dir='data/tune_tables/')
+perveance = matcher.set_tunes(mu_x, mu_y)
 intensity = hf.get_intensity(perveance, mass, kin_energy, bunch_length)
 print matcher.tunes()
 
@@ -60,22 +75,32 @@ if bunch_kind == 'gaussian':
 bunch, params_dict = hf.coasting_beam(bunch_kind, n_parts, matcher.twiss(), (eps_x, eps_y), 
                                       bunch_length, mass, kin_energy, intensity, **kws)
 
-# Track bunch
-coords, moments = [], []
-def measure(bunch):
-    X = get_coords(bunch)
-    Sigma = np.cov(X.T)
-    coords.append(X)
-    moments.append(Sigma[np.triu_indices(4)])
-
-measure(bunch)
-for mu_x0, mu_y0 in tqdm(zip(tunes_x, tunes_y)):
-    lattice = hf.fodo_lattice(mu_x0, mu_y0, cell_length, fill_fac=0.5, start='quad')
+# Add space charge nodes. The adaptive placement is planned from the matched
+# envelope at the start of the ramp.
+if sc_placement_kind == 'adaptive':
+    rx, rxp, ry, ryp, Dx, Dxp, s = matcher.matched_params
+    sizes = sc_placement.sizes_from_envelope(s, rx, ry)
+    starts, ends = sc_placement.node_bounds(lattice)
+    if solver_tol is None:
+        node_parts, tol = sc_placement.match_uniform(starts, ends, sizes,
+                                                     max_solver_spacing)
+    else:
+        node_parts = sc_placement.plan_parts(starts, ends, sizes, tol=solver_tol,
+                                             max_length=cell_length)
+    sc_placement.apply_plan(lattice, node_parts)
+else:
     lattice.split(max_solver_spacing)    
-    calc2p5d = SpaceChargeCalc2p5D(*gridpts)
-    sc_nodes = setSC2p5DAccNodes(lattice, min_solver_spacing, calc2p5d)
+calc2p5d = SpaceChargeCalc2p5D(*gridpts)
+sc_nodes = setSC2p5DAccNodes(lattice, min_solver_spacing, calc2p5d)
+
+# Track bunch
+reducer = MomentReducer(n_cells + 1, bunch.getSize(), snapshot_stride, 
+                        filename='data/coords_snapshots.npy')
+reducer.measure(bunch)
+for i in trange(n_cells):
+    ramp.set_step(i)
     lattice.trackBunch(bunch, params_dict)
-    measure(bunch)
-    
-np.save('data/coords.npy', coords)
-np.save('data/moments.npy', moments)
+    reducer.measure(bunch)
+reducer.close()
+np.save('data/moments.npy', reducer.get_moments())
+np.save('data/snapshot_cells.npy', reducer.snapshot_indices)
@@ -5,30 +5,36 @@ TO DO:
     * Add option to plotting windows at the projected means of the distribution
       (see plotting.py).
 """
+import os
+import shutil
+import subprocess
+import multiprocessing
+
 from cycler import cycler
 
 import numpy as np
 import matplotlib
 import pandas as pd
 import seaborn as sns
-import scipy
+import scipy.stats
 from matplotlib import pyplot as plt, ticker
 from matplotlib import animation
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.patches import Ellipse, transforms
 
 from .beam_analysis import get_ellipse_coords
+from .frames import FrameSource, as_frames, prefetch
 from .plotting import setup_corner
 from .plotting import max_u_up, max_u_up_global
+from .plotting import point_density
 from .plotting import remove_annotations
 from .plotting import vector
 from .plotting import var_indices
-from .utils import rand_rows
+from .utils import consistent_samples
 
 
-plt.rcParams['animation.ffmpeg_path'] = '/usr/local/bin/ffmpeg'
-    
-# I had to make this global for some reason... don't remember why.
-artists_list = []
+if os.path.isfile('/usr/local/bin/ffmpeg'):
+    plt.rcParams['animation.ffmpeg_path'] = '/usr/local/bin/ffmpeg'
 
 
 def skip_frames(frames, skip=1, keep_last=False):
@@ -42,25 +48,295 @@ def skip_frames(frames, skip=1, keep_last=False):
     return frames
 
 
+# Each worker process of `render_frames` builds its own copy of the figure
+# and keeps it here.
+_render_state = {}
+
+
+def _init_render(build, args, kwargs, dpi):
+    if multiprocessing.current_process().name != 'MainProcess':
+        plt.switch_backend('Agg')
+    fig, update, n_frames = build(*args, **kwargs)
+    if dpi is not None:
+        fig.set_dpi(dpi)
+    FigureCanvasAgg(fig)
+    _render_state.update(fig=fig, update=update, n_frames=n_frames)
+
+
+def _n_frames():
+    return _render_state['n_frames']
+
+
+def _render_frame(t):
+    _render_state['update'](t)
+    fig = _render_state['fig']
+    fig.canvas.draw()
+    return np.array(fig.canvas.buffer_rgba())
+
+
+def render_frames(build, args=(), kwargs=None, frames=None, processes=None,
+                  dpi=None, chunksize=4):
+    """Rasterize the frames of an animation in parallel.
+
+    Each worker process calls `build(*args, **kwargs)` once to create its
+    own figure, then draws its share of the frames with the Agg backend.
+    Frames are yielded in order.
+
+    `build` must return `(fig, update, n_frames)`, where `update(t)` draws
+    frame `t`; see `corner_figure`, `corner_env_figure` and
+    `corner_onepart_figure`. Its arguments are sent to every worker, so they
+    should be the precomputed frame data (such as the output of
+    `corner_data`) rather than the full coordinate arrays. The update
+    function should not depend on the previously drawn frames (for example,
+    `corner_env_figure` with `clear_history=False`), since each worker only
+    draws some of the frames.
+
+    Parameters
+    ----------
+    build : callable
+        Function which returns `(fig, update, n_frames)`. It, along with
+        `args` and `kwargs`, must be picklable.
+    args, kwargs : tuple, dict
+        Arguments passed to `build`.
+    frames : int, iterable or None
+        The number of frames to render (starting from the first), or the
+        indices of the frames to render. If None, render all frames.
+    processes : int or None
+        Number of worker processes. If None, use all available cores. If 1,
+        the frames are drawn in the current process.
+    dpi : float or None
+        Figure resolution.
+    chunksize : int
+        Number of frames sent to a worker at a time.
+
+    Yields
+    ------
+    ndarray, shape (height, width, 4)
+        RGBA image of each frame.
+    """
+    kwargs = dict() if kwargs is None else kwargs
+    initargs = (build, args, kwargs, dpi)
+    if isinstance(frames, int):
+        frames = range(frames)
+    if processes == 1:
+        _init_render(*initargs)
+        try:
+            if frames is None:
+                frames = range(_n_frames())
+            for t in frames:
+                yield _render_frame(t)
+        finally:
+            plt.close(_render_state['fig'])
+            _render_state.clear()
+        return
+    pool = multiprocessing.Pool(processes, initializer=_init_render,
+                                initargs=initargs)
+    try:
+        if frames is None:
+            frames = range(pool.apply(_n_frames))
+        for image in pool.imap(_render_frame, frames, chunksize):
+            yield image
+    except BaseException:
+        # Also reached if the consumer stops early (GeneratorExit); do not
+        # wait for the workers to draw the remaining frames.
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _ffmpeg_path():
+    path = plt.rcParams['animation.ffmpeg_path']
+    if os.path.isfile(path):
+        return path
+    return shutil.which(path)
+
+
+def save_parallel(filename, build, args=(), kwargs=None, fps=1,
+                  codec='libx264', bitrate=None, extra_args=None, **render_kws):
+    """Render an animation with `render_frames` and save it to a movie file.
+
+    The RGBA frames are piped, in order, to a single ffmpeg process. If
+    ffmpeg is not found, imageio is used instead.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the output file.
+    build, args, kwargs :
+        See `render_frames`.
+    fps : int
+        Frames per second.
+    codec : str
+        Video codec passed to ffmpeg.
+    bitrate : int or None
+        Bitrate in kbit/s.
+    extra_args : list[str]
+        Extra command line arguments for ffmpeg.
+    **render_kws
+        Key word arguments passed to `render_frames` (`processes`, `dpi`,
+        `frames`, `chunksize`).
+    """
+    images = render_frames(build, args, kwargs, **render_kws)
+    try:
+        _write_movie(filename, images, fps, codec, bitrate, extra_args)
+    finally:
+        images.close() # stop the workers if writing failed
+
+
+def _write_movie(filename, images, fps, codec, bitrate, extra_args):
+    ffmpeg = _ffmpeg_path()
+    if ffmpeg is None:
+        import imageio
+        with imageio.get_writer(filename, fps=fps) as writer:
+            for image in images:
+                writer.append_data(image)
+        return
+    first = next(images)
+    height, width, _ = first.shape
+    cmd = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo',
+           '-pix_fmt', 'rgba', '-s', '{}x{}'.format(width, height),
+           '-r', str(fps), '-i', '-', '-vcodec', codec,
+           '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p']
+    if bitrate is not None:
+        cmd += ['-b:v', '{}k'.format(bitrate)]
+    if extra_args:
+        cmd += list(extra_args)
+    cmd.append(filename)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        proc.stdin.write(first.tobytes())
+        for image in images:
+            proc.stdin.write(image.tobytes())
+    finally:
+        proc.stdin.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError('ffmpeg exited with status {}.'.format(proc.returncode))
+
+
+def _load_small(frames):
+    """Load all frames of a lazy source into one array.
+
+    Used for the envelope parameters and single-particle coordinates, which
+    only hold a few numbers per frame.
+    """
+    if isinstance(frames, (FrameSource, str)):
+        return np.array(list(prefetch(as_frames(frames))))
+    return frames
+
+
+def hist_edges(X, limits, bins='auto'):
+    """Return bin edges for each dimension, fixed across frames.
+
+    X : ndarray, shape (nparts, 4)
+        Coordinate array used to choose the number of bins.
+    limits : (umax, upmax)
+        The edges span [-umax, umax] for x and y and [-upmax, upmax] for x'
+        and y'.
+    bins : int or str
+        Passed to `np.histogram_bin_edges`.
+    """
+    edges = []
+    for i in range(4):
+        umax = limits[i % 2]
+        edges.append(np.histogram_bin_edges(X[:, i], bins, range=(-umax, umax)))
+    return edges
+
+
+def frame_hists(coords, edges, max_rows=10000000):
+    """Histogram every frame along each dimension.
+
+    Consecutive frames are binned together: the particles are tagged with
+    their frame index and counted with a single `np.bincount` per dimension
+    for every group of frames holding up to `max_rows` particles. The
+    frames are only iterated over once.
+
+    Parameters
+    ----------
+    coords : iterable, shape (n_frames, nparts, 4)
+        Coordinate array at each frame. The number of particles can change
+        from frame to frame. This can be a lazy source of frames (see
+        `frames.FrameSource`).
+    edges : list[ndarray]
+        Bin edges for each of the four dimensions.
+    max_rows : int
+        Maximum number of particles binned at once.
+
+    Returns
+    -------
+    list[ndarray]
+        The counts for each dimension, with shape (n_frames, n_bins).
+    """
+    def bin_group(group):
+        n_frames = len(group)
+        X_all = np.concatenate(group)
+        frame_idx = np.repeat(np.arange(n_frames), [X.shape[0] for X in group])
+        counts_list = []
+        for i, bin_edges in enumerate(edges):
+            n_bins = len(bin_edges) - 1
+            idx = np.searchsorted(bin_edges, X_all[:, i], side='right') - 1
+            idx[X_all[:, i] == bin_edges[-1]] = n_bins - 1 # include right edge
+            valid = (idx >= 0) & (idx < n_bins)
+            counts = np.bincount(frame_idx[valid] * n_bins + idx[valid],
+                                 minlength=n_frames * n_bins)
+            counts_list.append(counts.reshape(n_frames, n_bins))
+        return counts_list
+
+    results, group, n_rows = [], [], 0
+    for X in coords:
+        group.append(X)
+        n_rows += X.shape[0]
+        if n_rows >= max_rows:
+            results.append(bin_group(group))
+            group, n_rows = [], 0
+    if group:
+        results.append(bin_group(group))
+    return [np.vstack([counts_list[i] for counts_list in results])
+            for i in range(len(edges))]
+
+
+def _step_coords(edges, heights):
+    """Outline of histograms for `drawstyle='steps-post'`."""
+    x = np.hstack([edges[0], edges])
+    pad = np.zeros(heights.shape[:-1] + (1,))
+    y = np.concatenate([pad, heights, pad], axis=-1)
+    return x, y
+
+
 def corner(
-    coords, env_params=None, limits=None, dims='all', samples=2000, skip=0,
-    keep_last=False, pad=0.5, space=0.15, figsize=None, kind='scatter',
+    coords, env_params=None, limits=None, quantile=None, dims='all',
+    samples=2000, skip=0, keep_last=False, pad=0.5, space=0.15, figsize=None, kind='scatter',
     diag_kind='hist', hist_height=0.6, units='mm-mrad', norm_labels=False,
-    text_fmt='', text_vals=None, fps=1, diag_kws={}, env_kws={}, text_kws={},
-    **plt_kws
+    text_fmt='', text_vals=None, fps=1, prefetch_depth=2, diag_kws={},
+    env_kws={}, text_kws={}, **plt_kws
 ):
     """Frame-by-frame phase space projections of the beam.
 
+    The frame data is computed by `corner_data` and the figure is built by
+    `corner_figure`; to render the frames in parallel, pass the output of
+    `corner_data` to `save_parallel` along with `corner_figure`.
+
     Parameters
     ----------
-    coords : list or ndarray, shape (n_frames, nparts, 4)
+    coords : list, ndarray, FrameSource or str
         Each element contains the transverse beam coordinate array at a
         particular frame. Each frame can have a different number of particles.
+        A lazy source of frames (see `frames.FrameSource`) or the name of a
+        file written by `utils.save_stacked_array` (or an HDF5 file) can also
+        be passed; the frames are then read one at a time and only the
+        sampled particles and histograms are kept in memory.
     env_params : ndarray, shape (n_frames, 8)
         The envelope parameters at each frame. They are not plotted if none
         are provided.
     limits : (umax, upmax)
         Maximum position and angle for plot windows.
+    quantile : float or None
+        If `limits` is None, they are computed from this quantile of the
+        absolute coordinates over all frames (such as 0.999), so that a few
+        stray particles do not set the scale. If None, use the maximum.
     dims : str or tuple
         If 'all', plot all 6 phase space projections. Otherwise provide a tuple
         like ('x', 'yp') which plots x vs. y'.
@@ -82,13 +358,15 @@ def corner(
         Size of the figure (x_size, y_size). If an int is provided, the number
         is used as the size for both dimensions. Default (6, 6) with diagonals
         (5, 5) without diagonals, or (3, 3) if only one subplot.
-    kind : {'scatter', 'hist', 'kde'}
-        The kind of plot to make on the off-diagonal subplots. Note: the 'kde'
-        and 'hist' options are not implemented yet.
+    kind : {'scatter', 'scatter_density', 'hist', 'kde'}
+        The kind of plot to make on the off-diagonal subplots. If
+        'scatter_density', the points are colored by the density computed
+        with `plotting.point_density`; 'bins' and 'smooth' can be passed in
+        `plt_kws`. Note: the 'kde' and 'hist' options are not implemented yet.
     diag_kind : {'hist', 'kde', 'none'}
         The kind of plot to make on the diagonal subplots. If 'none', these are
-        excluded and a 3x3 grid is produced. Note: the 'kde' option currently
-        does not work.
+        excluded and a 3x3 grid is produced. The histograms (or kde curves) of
+        all frames are computed before the animation starts.
     hist_height : float in range [0, 1]
         Reduce the height of the histograms on the diagonal, which normally
         extend to the top of the plotting window, by this factor.
@@ -104,13 +382,19 @@ def corner(
         `text_vals` is None, we use list(range(n_frames)).
     fps : int
         Frames per second.
+    prefetch_depth : int
+        Number of frames loaded ahead in a background thread when reading
+        from a lazy frame source.
     {plt, diag, env, text}_kws : dict
         Key word arguments. They are passed to the following functions:
         * plt_kws  : `plt.plot`. For the scatter plots. This doesn't need to be
                      passed as a dict; for example, `ms=10` can be added to the
                      function call to change the marker size.
-        * diag_kws : `plt.hist`. For the histograms on the diagonal. More
-                     options will be added in the future like kde.
+        * diag_kws : `plt.plot`. For the histograms on the diagonal, which
+                     are drawn as step lines. The 'bins' and 'density' keys
+                     are used to compute the histograms; the bin edges are
+                     fixed across frames and set from the frame
+                     with the most particles.
         * env_kws  : `plt.plot`. For plotting the envelope ellipses.
         * text_kws : `plt.annotate`. For any text displayed on the figure.
 
@@ -118,42 +402,50 @@ def corner(
     -------
     matplotlib.animation.FuncAnimation
     """
-    plt_env = env_params is not None
-    plt_diag = diag_kind not in ['none', None]
+    diag_kws = dict(diag_kws)
+    data = corner_data(
+        coords, env_params=env_params, limits=limits, quantile=quantile,
+        dims=dims, samples=samples, skip=skip, keep_last=keep_last, pad=pad,
+        diag_kind=diag_kind, bins=diag_kws.pop('bins', 'auto'),
+        density=diag_kws.pop('density', False), text_fmt=text_fmt,
+        text_vals=text_vals, prefetch_depth=prefetch_depth
+    )
+    fig, update, n_frames = corner_figure(
+        data, figsize=figsize, space=space, kind=kind, hist_height=hist_height,
+        units=units, norm_labels=norm_labels, diag_kws=diag_kws,
+        env_kws=env_kws, text_kws=text_kws, **plt_kws
+    )
+    return animation.FuncAnimation(fig, update, frames=n_frames,
+                                   blit=(dims == 'all'), interval=1000/fps)
 
-    # Set default key word arguments
-    if 's' in plt_kws:
-        ms = plt_kws['s']
-        plt_kws.pop('s', None)
-        plt_kws['ms'] = ms
-    if 'c' in plt_kws:
-        color = plt_kws['c']
-        plt_kws.pop('c', None)
-        plt_kws['color'] = color
-    plt_kws.setdefault('ms', 2)
-    plt_kws.setdefault('color', 'steelblue')
-    plt_kws.setdefault('marker', '.')
-    plt_kws.setdefault('zorder', 5)
-    plt_kws.setdefault('lw', 0)
-    plt_kws.setdefault('markeredgewidth', 0)
-    plt_kws.setdefault('fillstyle', 'full')
-    if diag_kind == 'hist':
-        diag_kws.setdefault('histtype', 'step')
-        diag_kws.setdefault('bins', 'auto')
-        diag_kws.setdefault('color', plt_kws['color'])
-    elif diag_kind == 'kde':
-        diag_kws.setdefault('lw', 1)
-    env_kws.setdefault('color', 'k')
-    env_kws.setdefault('lw', 1)
-    env_kws.setdefault('zorder', 6)
+
+def corner_data(
+    coords, env_params=None, limits=None, quantile=None, dims='all',
+    samples=2000, skip=0, keep_last=False, pad=0.5, diag_kind='hist',
+    bins='auto', density=False, text_fmt='', text_vals=None, prefetch_depth=2
+):
+    """Compute the frame data for `corner_figure` in one pass over the frames.
+
+    The parameters are described in `corner`; `bins` and `density` are used
+    to compute the diagonal histograms. Only the sampled particles, the
+    diagonal curves and the envelope coordinates are kept, so the result is
+    much smaller than `coords`.
+
+    Returns
+    -------
+    dict
+        'dims', 'limits', 'texts', 'coords_samp' (sampled particles at each
+        frame), 'coords_env' (or None), 'diag_kind', 'diag_x' and 'diag_y'
+        (the diagonal curves at each frame, or None).
+    """
+    plt_env = env_params is not None
+    plt_diag = dims == 'all' and diag_kind not in ['none', None]
 
     # Process particle coordinates
-    nparts_list = np.array([X.shape[0] for X in coords])
-    if type(coords) is np.ndarray:
-        coords = [X for X in coords]
+    coords = as_frames(coords)
     n_frames = len(coords)    
     if plt_env:
-        coords_env = np.array([get_ellipse_coords(p) for p in env_params])
+        coords_env = get_ellipse_coords(env_params)
     else:
         coords_env = None
 
@@ -165,33 +457,139 @@ def corner(
     texts = np.array([text_fmt.format(val) for val in text_vals])
     
     # Skip frames
-    coords = skip_frames(coords, skip, keep_last)
+    coords = coords.select(skip_frames(list(range(n_frames)), skip, keep_last))
     if plt_env:
         coords_env = skip_frames(coords_env, skip, keep_last)
     texts = skip_frames(texts, skip, keep_last)
     n_frames = len(coords)
-        
-    # Take random sample of particles for scatter plots
-    nparts_is_static = all([n == nparts_list[0] for n in nparts_list])
-    if nparts_is_static:
-        nparts = nparts_list[0]
-        coords_samp = np.array(coords)
-        if samples < nparts:
-            idx = np.random.choice(nparts, samples, replace=False)
-        else:
-            idx = np.arange(0, nparts)
-        coords_samp = [X[idx] for X in coords]
-    else:
-        coords_samp = coords
-        for i, X in enumerate(coords_samp):
-            if X.shape[0] > samples:
-                coords_samp[i] = rand_rows(X, samples)
                 
     # Axis limits
     if limits is None:
-        limits = max_u_up_global(coords)
+        limits = max_u_up_global(prefetch(coords, prefetch_depth), quantile)
     limits = [(1 + pad) * limit for limit in limits]
 
+    # Take random sample of particles for scatter plots. The same particles
+    # are followed through the animation (see `consistent_samples`). The
+    # samples are gathered during the pass over the frames which computes
+    # the histograms, so only a few frames are in memory at once.
+    nparts_list = [coords.nparts(t) for t in range(n_frames)]
+    idx_list = consistent_samples(nparts_list, samples,
+                                  seed=np.random.randint(2**31 - 1))
+    coords_samp = []
+
+    def frames_with_sampling():
+        for X, idx in zip(prefetch(coords, prefetch_depth), idx_list):
+            coords_samp.append(np.array(X[idx]))
+            yield X
+
+    # Precompute the diagonal curves for every frame.
+    diag_x, diag_y = None, None
+    if not plt_diag:
+        for X in frames_with_sampling():
+            pass
+    elif diag_kind == 'hist':
+        diag_x, diag_y = [], []
+        # The number of bins is chosen from the frame with the most
+        # particles; during injection the first frames hold only a few.
+        t_max = int(np.argmax(nparts_list))
+        edges = hist_edges(np.asarray(coords[t_max]), limits, bins)
+        hists = frame_hists(frames_with_sampling(), edges)
+        for bin_edges, heights in zip(edges, hists):
+            heights = heights.astype(float)
+            if density:
+                areas = np.sum(heights * np.diff(bin_edges), axis=1)
+                areas[areas == 0] = 1.0
+                heights /= areas[:, np.newaxis]
+            x, y = _step_coords(bin_edges, heights)
+            diag_x.append(x)
+            diag_y.append(y)
+    elif diag_kind == 'kde':
+        diag_x, diag_y = [], []
+        for i in range(4):
+            umax = limits[i % 2]
+            diag_x.append(np.linspace(-umax, umax, 1000))
+            diag_y.append([])
+        for X in frames_with_sampling():
+            for i in range(4):
+                kde = scipy.stats.gaussian_kde(X[:, i])
+                diag_y[i].append(kde(diag_x[i]))
+        diag_y = [np.array(y) for y in diag_y]
+    return {
+        'dims': dims,
+        'limits': limits,
+        'texts': texts,
+        'coords_samp': coords_samp,
+        'coords_env': coords_env,
+        'diag_kind': diag_kind if plt_diag else 'none',
+        'diag_x': diag_x,
+        'diag_y': diag_y,
+    }
+
+
+def corner_figure(
+    data, figsize=None, space=0.15, kind='scatter', hist_height=0.6,
+    units='mm-mrad', norm_labels=False, diag_kws={}, env_kws={}, text_kws={},
+    **plt_kws
+):
+    """Create the figure for `corner` from the output of `corner_data`.
+
+    The other parameters are described in `corner`.
+
+    Returns
+    -------
+    fig : matplotlib.figure.Figure
+    update : callable
+        `update(t)` draws frame `t` and returns the updated artists.
+    n_frames : int
+    """
+    dims = data['dims']
+    limits = data['limits']
+    texts = data['texts']
+    coords_samp = data['coords_samp']
+    coords_env = data['coords_env']
+    diag_y = data['diag_y']
+    plt_env = coords_env is not None
+    plt_diag = data['diag_kind'] != 'none'
+    n_frames = len(coords_samp)
+
+    # Set default key word arguments
+    plt_kws = dict(plt_kws)
+    if 's' in plt_kws:
+        ms = plt_kws['s']
+        plt_kws.pop('s', None)
+        plt_kws['ms'] = ms
+    if 'c' in plt_kws:
+        color = plt_kws['c']
+        plt_kws.pop('c', None)
+        plt_kws['color'] = color
+    plt_kws.setdefault('ms', 2)
+    plt_kws.setdefault('color', 'steelblue')
+    plt_kws.setdefault('marker', '.')
+    plt_kws.setdefault('zorder', 5)
+    plt_kws.setdefault('lw', 0)
+    plt_kws.setdefault('markeredgewidth', 0)
+    plt_kws.setdefault('fillstyle', 'full')
+    diag_kws = dict(diag_kws)
+    diag_kws.pop('histtype', None)
+    diag_kws.pop('bins', None)
+    diag_kws.pop('density', None)
+    diag_kws.setdefault('color', plt_kws['color'])
+    diag_kws.setdefault('lw', 1)
+    if data['diag_kind'] == 'hist':
+        diag_kws['drawstyle'] = 'steps-post'
+    env_kws = dict(env_kws)
+    env_kws.setdefault('color', 'k')
+    env_kws.setdefault('lw', 1)
+    env_kws.setdefault('zorder', 6)
+    density_kws, scatter_kws = None, None
+    if kind == 'scatter_density':
+        density_kws = {key: plt_kws.pop(key) for key in ('bins', 'smooth')
+                       if key in plt_kws}
+        scatter_kws = {'s': plt_kws['ms']**2, 'marker': plt_kws['marker'],
+                       'zorder': plt_kws['zorder'], 'ec': 'none'}
+        if 'cmap' in plt_kws:
+            scatter_kws['cmap'] = plt_kws['cmap']
+
     # Create figure
     fig, axes = setup_corner(
         limits, figsize, norm_labels, units, space, plt_diag, dims=dims,
@@ -199,100 +597,106 @@ def corner(
     )
     plt.close()
     if dims != 'all':
-        return _corner_2D(fig, axes, coords_samp, coords_env, dims, texts, fps,
-                          env_kws, text_kws, **plt_kws)
+        update = _corner_2D(axes, coords_samp, coords_env, dims, texts,
+                            env_kws, text_kws, density_kws, scatter_kws,
+                            **plt_kws)
+        return fig, update, n_frames
 
-    # Create array of Line2D objects
+    # Create array of Line2D objects (or PathCollection objects if the
+    # points are colored by density).
     lines = [[], [], []]
     lines_env = [[], [], []]
     scatter_axes = axes[1:, :-1] if plt_diag else axes
     for i in range(3):
         for j in range(i + 1):
-            line, = scatter_axes[i, j].plot([], [], **plt_kws)
+            if kind == 'scatter_density':
+                line = scatter_axes[i, j].scatter([], [], c=[], **scatter_kws)
+            else:
+                line, = scatter_axes[i, j].plot([], [], **plt_kws)
             lines[i].append(line)
             if plt_env:
                 line, = scatter_axes[i, j].plot([], [], **env_kws)
                 lines_env[i].append(line)
+    artists = [line for row in lines + lines_env for line in row]
 
-    # Compute the maximum histogram height among frames to keep ylim fixed
+    # Diagonal curves. The y limit is set from the maximum height among all
+    # frames.
     if plt_diag:
-        max_heights = np.zeros((n_frames, 4))
-        for i, X in enumerate(coords):
-            for j in range(4):
-                max_heights[i, j] = np.max(np.histogram(X[:, j], bins='auto')[0])
-        axes[0, 0].set_ylim(0, np.max(max_heights) / hist_height)
-
-    def init():
-        """Plot the background of each frame."""
-        for i in range(3):
-            for j in range(i):
-                lines[i][j].set_data([], [])
-                if plt_env:
-                    lines_env[i][j].set_data([], [])
+        lines_diag = []
+        for ax, x in zip(axes.diagonal(), data['diag_x']):
+            line, = ax.plot(x, np.zeros(len(x)), **diag_kws)
+            lines_diag.append(line)
+        artists.extend(lines_diag)
+        axes[0, 0].set_ylim(0, max(np.max(y) for y in diag_y) / hist_height)
+
+    location = (0.35, 0) if plt_diag else (0.35, 0.5)
+    text = axes[1, 2].annotate('', xy=location, xycoords='axes fraction',
+                               **text_kws)
+    artists.append(text)
 
     def update(t):
-        """Animation function to be called sequentially."""
-        remove_annotations(axes)
-        X, X_samp = coords[t], coords_samp[t]
+        """Draw frame `t`."""
+        X_samp = coords_samp[t]
         for i in range(3):
             for j in range(i + 1):
-                lines[i][j].set_data(X_samp[:, j], X_samp[:, i+1])
+                x, y = X_samp[:, j], X_samp[:, i+1]
+                if kind == 'scatter_density':
+                    _set_density_offsets(lines[i][j], x, y, density_kws)
+                else:
+                    lines[i][j].set_data(x, y)
                 if plt_env:
                     X_env = coords_env[t]
                     lines_env[i][j].set_data(X_env[:, j], X_env[:, i+1])
         if plt_diag:
-            if diag_kind == 'hist':
-                global artists_list
-                for artists in artists_list:
-                    for artist in artists:
-                        artist.remove()
-                artists_list = []
-                for i, ax in enumerate(axes.diagonal()):
-                    heights, bin_edges, artists = ax.hist(X[:, i], **diag_kws)
-                    artists_list.append(artists)
-            elif diag_kind == 'kde':
-                for i, ax in enumerate(axes.diagonal()):
-                    for line in ax.lines:
-                        ax.remove()
-                    gkde = scipy.stats.gaussian_kde(X[:, i])
-                    umax = limits[i % 2]
-                    ind = np.linspace(-umax, umax, 1000)
-                    ax.plot(ind, gkde.evaluate(ind), **diag_kws)
+            for line, y in zip(lines_diag, diag_y):
+                line.set_ydata(y[t])
+        text.set_text(texts[t])
+        return artists
 
-        # Display text
-        location = (0.35, 0) if plt_diag else (0.35, 0.5)
-        axes[1, 2].annotate(texts[t], xy=location, xycoords='axes fraction',
-                            **text_kws)
+    return fig, update, n_frames
 
-    # Call animator and possibly save the animation
-    anim = animation.FuncAnimation(fig, update, frames=n_frames, blit=False,
-                                   interval=1000/fps)
-    return anim
+
+def _set_density_offsets(collection, x, y, density_kws):
+    """Color the points of a scatter plot by density (densest on top)."""
+    if len(x) == 0:
+        collection.set_offsets(np.zeros((0, 2)))
+        collection.set_array(np.zeros(0))
+        return
+    z = point_density(x, y, **density_kws)
+    idx = np.argsort(z)
+    collection.set_offsets(np.column_stack([x[idx], y[idx]]))
+    collection.set_array(z[idx])
+    collection.set_clim(z[idx[0]], z[idx[-1]])
 
 
-def _corner_2D(fig, ax, coords, coords_env, dims, texts, fps, env_kws,
-               text_kws, **plt_kws):
-    """2D scatter plot (helper function for `corner`)."""
-    n_frames = coords.shape[0]
+def _corner_2D(ax, coords, coords_env, dims, texts, env_kws, text_kws,
+               density_kws=None, scatter_kws=None, **plt_kws):
+    """2D scatter plot (helper function for `corner_figure`).
+
+    If `scatter_kws` is provided, the points are drawn with `ax.scatter` and
+    colored by density (`kind='scatter_density'`). Returns the update
+    function.
+    """
     j, i = [var_indices[dim] for dim in dims]
-    coords_x, coords_y = coords[:, :, j], coords[:, :, i]
     
-    line, = ax.plot([], [], **plt_kws)
+    if scatter_kws is not None:
+        line = ax.scatter([], [], c=[], **scatter_kws)
+    else:
+        line, = ax.plot([], [], **plt_kws)
     line_env, = ax.plot([], [], **env_kws)
-    def init():
-        line.set_data([], [])
-        line_env.set_data([], [])
         
     def update(t):
         X = coords[t]
-        line.set_data(X[:, j], X[:, i])
+        if scatter_kws is not None:
+            _set_density_offsets(line, X[:, j], X[:, i], density_kws)
+        else:
+            line.set_data(X[:, j], X[:, i])
         if coords_env is not None:
             X_env = coords_env[t]
             line_env.set_data(X_env[:, j], X_env[:, i])
         ax.set_title(texts[t], **text_kws)
         
-    return animation.FuncAnimation(fig, update, init_func=init, frames=n_frames,
-                                   interval=1000/fps)
+    return update
     
 
 def corner_env(
@@ -309,7 +713,8 @@ def corner_env(
     params : ndarray, shape (n_frames, 8)
         If shape is (n_frames, 8), gives the envelope parameters at each frame.
         If a list of these arrays is provided, each envelope in the list will
-        be plotted.
+        be plotted. A `frames.FrameSource` of parameter vectors can also be
+        passed.
     dims : str or tuple
         If 'all', plot all 6 phase space projections. Otherwise provide a tuple
         like ('x', 'yp') which plots x vs. y'.
@@ -365,15 +770,43 @@ def corner_env(
     -------
     matplotlib.animation.FuncAnimation
     """
+    fig, update, n_frames = corner_env_figure(
+        params, dims=dims, skip=skip, keep_last=keep_last, figsize=figsize,
+        grid=grid, pad=pad, space=space, ec=ec, fc=fc, lw=lw, fill=fill,
+        plot_boundary=plot_boundary, show_init=show_init,
+        clear_history=clear_history, text_fmt=text_fmt, text_vals=text_vals,
+        units=units, norm_labels=norm_labels, cmap=cmap, cmap_range=cmap_range
+    )
+    anim = animation.FuncAnimation(fig, update, frames=n_frames,
+                                   interval=1000/fps)
+    if figname:
+        writer = animation.writers['ffmpeg'](fps=fps, bitrate=bitrate)
+        anim.save(figname, writer=writer, dpi=dpi)
+    return anim
+
+
+def corner_env_figure(
+    params, dims='all', skip=0, keep_last=False, figsize=None, grid=True,
+    pad=0.25, space=0.15, ec='k', fc='lightsteelblue', lw=1, fill=True,
+    plot_boundary=True, show_init=False, clear_history=True, text_fmt='',
+    text_vals=None, units='mm-mrad', norm_labels=False, cmap=None,
+    cmap_range=(0, 1)
+):
+    """Create the figure for `corner_env` (see its parameters).
+
+    Returns
+    -------
+    fig : matplotlib.figure.Figure
+    update : callable
+        `update(t)` draws frame `t`.
+    n_frames : int
+    """
     # Get ellipse coordinates
-    params_list = np.copy(params)
+    params_list = np.copy(_load_small(params))
     if params_list.ndim == 2:
         params_list = params_list[np.newaxis, :]
     n_envelopes, n_frames, _ = params_list.shape
-    coords_list = []
-    for params in params_list:
-        coords = np.array([get_ellipse_coords(p) for p in params])
-        coords_list.append(coords)
+    coords_list = list(get_ellipse_coords(params_list))
     X_init = coords_list[0][0]
     if n_envelopes > 1:
         fill = False
@@ -422,9 +855,10 @@ def corner_env(
     plt.close()
                 
     if dims != 'all':
-        return _corner_env_2D(fig, ax, coords_list, dims, clear_history,
-                              show_init, plot_boundary, fill, fc, ec, lw,
-                              fps, texts)
+        update = _corner_env_2D(axes, coords_list, dims, clear_history,
+                                show_init, plot_boundary, fill, fc, ec, lw,
+                                texts)
+        return fig, update, n_frames
     
     # Create list of Line2D objects
     lines_list = []
@@ -438,7 +872,7 @@ def corner_env(
         lines_list.append(lines)
     
     def update(t):
-        """Animation function to be called sequentially."""
+        """Draw frame `t`."""
         if clear_history:
             for ax in axes.flat:
                 for patch in ax.patches:
@@ -460,18 +894,12 @@ def corner_env(
         # Display text
         remove_annotations(axes[0, 1])
         axes[0, 1].annotate(texts[t], xy=(0.35, 0.5), xycoords='axes fraction')
-                        
-    # Call animator and (maybe) save the animation
-    anim = animation.FuncAnimation(fig, update, frames=n_frames,
-                                   interval=1000/fps)
-    if figname:
-        writer = animation.writers['ffmpeg'](fps=fps, bitrate=bitrate)
-        anim.save(figname, writer=writer, dpi=dpi)
-    return anim
+
+    return fig, update, n_frames
     
     
-def _corner_env_2D(fig, ax, coords_list, dims, clear_history, show_init,
-                   plot_boundary, fill, fc, ec, lw, fps, texts):
+def _corner_env_2D(ax, coords_list, dims, clear_history, show_init,
+                   plot_boundary, fill, fc, ec, lw, texts):
     X_init = coords_list[0][0]
     lines = []
     for coords in coords_list:
@@ -493,8 +921,7 @@ def _corner_env_2D(fig, ax, coords_list, dims, clear_history, show_init,
                 ax.plot(X_init[:, k], X_init[:, j], 'k--',
                         lw=0.5, alpha=0.25)
             ax.set_title(texts[t])
-    return animation.FuncAnimation(fig, update, frames=coords_list[0].shape[0],
-                                   interval=1000/fps)
+    return update
         
 
 def corner_onepart(
@@ -504,7 +931,39 @@ def corner_onepart(
     label_kws={}, tick_kws={}, tickm_kws={}, grid_kws={}, history_kws={},
     **plt_kws
 ):
+    fig, update, n_frames = corner_onepart_figure(
+        X, dims=dims, vecs=vecs, show_history=show_history, skip=skip,
+        pad=pad, space=space, figsize=figsize, units=units,
+        norm_labels=norm_labels, text_fmt=text_fmt, text_vals=text_vals,
+        text_kws=text_kws, label_kws=label_kws, tick_kws=tick_kws,
+        tickm_kws=tickm_kws, grid_kws=grid_kws, history_kws=history_kws,
+        **plt_kws
+    )
+    anim = animation.FuncAnimation(fig, update, frames=n_frames,
+                                   interval=1000/fps)
+    if figname:
+        writer = animation.writers['ffmpeg'](fps=fps, bitrate=bitrate)
+        anim.save(figname, writer=writer, dpi=dpi)
+    return anim
+
+
+def corner_onepart_figure(
+    X, dims='all', vecs=None, show_history=False, skip=0, pad=0.35, space=0.15,
+    figsize=None, units='mm-mrad', norm_labels=False, text_fmt='',
+    text_vals=None, text_kws={}, label_kws={}, tick_kws={}, tickm_kws={},
+    grid_kws={}, history_kws={}, **plt_kws
+):
+    """Create the figure for `corner_onepart`.
+
+    Returns
+    -------
+    fig : matplotlib.figure.Figure
+    update : callable
+        `update(t)` draws frame `t`.
+    n_frames : int
+    """
     # Set default key word arguments
+    history_kws = dict(history_kws)
     for kws in (plt_kws, history_kws):
         if 's' in kws:
             ms = kws['s']
@@ -524,6 +983,7 @@ def corner_onepart(
     history_kws.setdefault('zorder', 0)
     
     # Configure text updates
+    X = _load_small(X)
     n_frames = X.shape[0]
     if text_vals is None:
         text_vals = list(range(n_frames))
@@ -565,19 +1025,8 @@ def corner_onepart(
                 line, = axes[i, j].plot([], [], **history_kws)
                 lines_history[i].append(line)
 
-    def init():
-        """Plot the background of each frame."""
-        if dims != 'all':
-            line.set_data([], [])
-            line_history.set_data([], [])
-        else:
-            for i in range(3):
-                for j in range(i):
-                    lines[i][j].set_data([], [])
-                    lines_history[i][j].set_data([], [])
-
     def update(t):
-        """Animation function to be called sequentially."""
+        """Draw frame `t`."""
         remove_annotations(axes)
         _X, _Xold = X[[t]], X[:t]
         if dims != 'all':
@@ -602,9 +1051,4 @@ def corner_onepart(
             axes[1, 2].annotate(texts[t], xy=(0.35, 0.5),
                                 xycoords='axes fraction', **text_kws)
 
-    anim = animation.FuncAnimation(fig, update, init_func=init, frames=n_frames,
-                                   interval=1000/fps)
-    if figname:
-        writer = animation.writers['ffmpeg'](fps=fps, bitrate=bitrate)
-        anim.save(figname, writer=writer, dpi=dpi)
-    return anim
+    return fig, update, n_frames
@@ -1,8 +1,10 @@
+from functools import lru_cache
+
 import numpy as np
 import numpy.linalg as la
 import pandas as pd
 
-from .utils import cov2corr, symmetrize
+from .utils import cov2corr
 
 
 env_cols = ['a','b','ap','bp','e','f','ep','fp']
@@ -12,17 +14,53 @@ twiss4D_cols = ['ax','ay','bx','by','u','nu','e1','e2','e4D']
 
 
 def mat2vec(Sigma):
-    """Return vector of independent elements in 4x4 symmetric matrix Sigma."""
-    return Sigma[np.triu_indices(4)]
+    """Return vector of independent elements in 4x4 symmetric matrix Sigma.
+
+    `Sigma` can also have shape (..., 4, 4).
+    """
+    i, j = np.triu_indices(4)
+    return np.asarray(Sigma)[..., i, j]
                   
                   
 def vec2mat(moment_vec):
-    """Inverse of `mat2vec`."""
-    Sigma = np.zeros((4, 4))
-    indices = np.triu_indices(4)
-    for moment, (i, j) in zip(moment_vec, zip(*indices)):
-        Sigma[i, j] = moment
-    return symmetrize(Sigma)
+    """Inverse of `mat2vec`.
+
+    `moment_vec` can also have shape (..., 10).
+    """
+    moment_vec = np.asarray(moment_vec, dtype=float)
+    Sigma = np.zeros(moment_vec.shape[:-1] + (4, 4))
+    i, j = np.triu_indices(4)
+    Sigma[..., i, j] = moment_vec
+    Sigma[..., j, i] = moment_vec
+    return Sigma
+
+
+@lru_cache(maxsize=8)
+def _cos_sin_table(npts):
+    """Return [cos(psi), sin(psi)] at npts points in [0, 2pi], shape (npts, 2)."""
+    psi = np.linspace(0, 2 * np.pi, npts)
+    table = np.vstack([np.cos(psi), np.sin(psi)]).T
+    table.flags.writeable = False
+    return table
+
+
+def env_matrix(env_params):
+    """Return the matrix P = [[a, b], [a', b'], [e, f], [e', f']].
+
+    `env_params` can have shape (8,) or (..., 8); the result has shape
+    (..., 4, 2).
+    """
+    env_params = np.asarray(env_params, dtype=float)
+    return env_params.reshape(env_params.shape[:-1] + (4, 2))
+
+
+def env_to_cov(env_params):
+    """Return covariance matrix Sigma = P P^T / 4 from envelope parameters.
+
+    `env_params` can have shape (8,) or (..., 8).
+    """
+    P = env_matrix(env_params)
+    return 0.25 * np.matmul(P, np.swapaxes(P, -1, -2))
 
 
 def get_ellipse_coords(env_params, npts=100):
@@ -32,32 +70,32 @@ def get_ellipse_coords(env_params, npts=100):
 
     Parameters
     ----------
-    params : array-like
-        The envelope parameters [a, b, a', b', e, f, e', f'].
+    params : array-like, shape (8,) or (n_frames, 8)
+        The envelope parameters [a, b, a', b', e, f, e', f']. If a 2D array
+        is provided, the coordinates are computed for every row at once.
     npts : float
         Number of points along the ellipse.
         
     Returns
     -------
-    coords : ndarray, shape (npts, 4)
+    coords : ndarray, shape (npts, 4) or (n_frames, npts, 4)
         Columns are [x, x', y, y'].
     """
-    a, b, ap, bp, e, f, ep, fp = env_params
-    psi = np.linspace(0, 2 * np.pi, npts)
-    cos, sin = np.cos(psi), np.sin(psi)
-    x, xp = a*cos + b*sin, ap*cos + bp*sin
-    y, yp = e*cos + f*sin, ep*cos + fp*sin
-    coords = np.vstack([x, xp, y, yp]).T
-    return coords
+    P = env_matrix(env_params)
+    return np.matmul(_cos_sin_table(npts), np.swapaxes(P, -1, -2))
 
     
 def rms_ellipse_dims(Sigma, x1='x', x2='y'):
     """Return (angle, c1, c2) of rms ellipse in x1-x2 plane, where angle is the
     clockwise tilt angle and c1/c2 are the semi-axes.
+
+    `Sigma` can also have shape (..., 4, 4), in which case each returned
+    value has shape (...).
     """
     str_to_int = {'x':0, 'xp':1, 'y':2, 'yp':3}
     i, j = str_to_int[x1], str_to_int[x2]
-    sii, sjj, sij = Sigma[i, i], Sigma[j, j], Sigma[i, j]
+    Sigma = np.asarray(Sigma)
+    sii, sjj, sij = Sigma[..., i, i], Sigma[..., j, j], Sigma[..., i, j]
     angle = -0.5 * np.arctan2(2*sij, sii-sjj)
     sin, cos = np.sin(angle), np.cos(angle)
     sin2, cos2 = sin**2, cos**2
@@ -67,9 +105,13 @@ def rms_ellipse_dims(Sigma, x1='x', x2='y'):
     
     
 def intrinsic_emittances(Sigma):
-    """Return intrinsic emittances from covariance matrix."""
+    """Return intrinsic emittances from covariance matrix.
+
+    `Sigma` can also have shape (..., 4, 4).
+    """
     U = np.array([[0, 1, 0, 0], [-1, 0, 0, 0], [0, 0, 0, 1], [0, 0, -1, 0]])
-    trSU2 = np.trace(la.matrix_power(np.matmul(Sigma, U), 2))
+    SU = np.matmul(Sigma, U)
+    trSU2 = np.trace(np.matmul(SU, SU), axis1=-2, axis2=-1)
     detS = la.det(Sigma)
     eps_1 = 0.5 * np.sqrt(-trSU2 + np.sqrt(trSU2**2 - 16 * detS))
     eps_2 = 0.5 * np.sqrt(-trSU2 - np.sqrt(trSU2**2 - 16 * detS))
@@ -77,20 +119,28 @@ def intrinsic_emittances(Sigma):
     
     
 def apparent_emittances(Sigma):
-    """Return apparent emittances from covariance matrix."""
-    eps_x = np.sqrt(la.det(Sigma[:2, :2]))
-    eps_y = np.sqrt(la.det(Sigma[2:, 2:]))
+    """Return apparent emittances from covariance matrix.
+
+    `Sigma` can also have shape (..., 4, 4).
+    """
+    Sigma = np.asarray(Sigma)
+    eps_x = np.sqrt(la.det(Sigma[..., :2, :2]))
+    eps_y = np.sqrt(la.det(Sigma[..., 2:, 2:]))
     return eps_x, eps_y
     
     
 def get_twiss2D(Sigma):
-    """Return 2D Twiss parameters from covariance matrix."""
+    """Return 2D Twiss parameters from covariance matrix.
+
+    `Sigma` can also have shape (..., 4, 4); the result has shape (..., 6).
+    """
+    Sigma = np.asarray(Sigma)
     eps_x, eps_y = apparent_emittances(Sigma)
-    beta_x = Sigma[0, 0] / eps_x
-    beta_y = Sigma[2, 2] / eps_y
-    alpha_x = -Sigma[0, 1] / eps_x
-    alpha_y = -Sigma[2, 3] / eps_y
-    return np.array([alpha_x, alpha_y, beta_x, beta_y, eps_x, eps_y])
+    beta_x = Sigma[..., 0, 0] / eps_x
+    beta_y = Sigma[..., 2, 2] / eps_y
+    alpha_x = -Sigma[..., 0, 1] / eps_x
+    alpha_y = -Sigma[..., 2, 3] / eps_y
+    return np.stack([alpha_x, alpha_y, beta_x, beta_y, eps_x, eps_y], axis=-1)
     
     
 def get_twiss4D(Sigma, mode):
@@ -99,20 +149,23 @@ def get_twiss4D(Sigma, mode):
     This is technically only valid for the Danilov distribution. What we
     really need to do is compute V from the eigenvectors of Sigma U, then
     compute the Twiss parameters from V.
+
+    `Sigma` can also have shape (..., 4, 4); the result has shape (..., 9).
     """
+    Sigma = np.asarray(Sigma)
     e1, e2 = intrinsic_emittances(Sigma)
     ex, ey = apparent_emittances(Sigma)
-    eps = max([e1, e2])
-    bx = Sigma[0, 0] / eps
-    by = Sigma[2, 2] / eps
-    ax = -Sigma[0, 1] / eps
-    ay = -Sigma[2, 3] / eps
-    nu = np.arccos(Sigma[0, 2] / np.sqrt(Sigma[0, 0]*Sigma[2, 2]))
+    eps = np.where(e2 > e1, e2, e1)
+    bx = Sigma[..., 0, 0] / eps
+    by = Sigma[..., 2, 2] / eps
+    ax = -Sigma[..., 0, 1] / eps
+    ay = -Sigma[..., 2, 3] / eps
+    nu = np.arccos(Sigma[..., 0, 2] / np.sqrt(Sigma[..., 0, 0]*Sigma[..., 2, 2]))
     if mode == 1:
         u = ey / eps
     elif mode == 2:
         u = ex / eps
-    return np.array([ax, ay, bx, by, u, nu, e1, e2, e1*e2])
+    return np.stack([ax, ay, bx, by, u, nu, e1, e2, e1*e2], axis=-1)
     
 
 class Stats:
@@ -190,30 +243,36 @@ class Stats:
         self.twiss4D_arr = np.zeros((self.nframes, 9))
         
     def read_moments(self, moments_list):
+        """Compute the statistics from the 10 moments at each frame.
+
+        All frames are processed at once.
+        """
+        moments_list = np.asarray(moments_list, dtype=float)
         if not self._initialized:
             self._create_empty_arrays(moments_list)
-        for i, moments in enumerate(moments_list):
-            cov_mat = vec2mat(moments)
-            self.moments_arr[i] = moments
-            self.corr_arr[i] = mat2vec(cov2corr(cov_mat))
-            self.twiss2D_arr[i] = get_twiss2D(cov_mat)
-            self.twiss4D_arr[i] = get_twiss4D(cov_mat, self.mode)
-            angle, cx, cy = rms_ellipse_dims(cov_mat, 'x', 'y')
-            cx *= 2 # Get real radii instead of rms
-            cy *= 2 # Get real radii instead of rms
-            angle = np.degrees(angle)
-            self.realspace_arr[i] = [angle, cx, cy, np.pi*cx*cy]
+        cov_mats = vec2mat(moments_list)
+        self.moments_arr[:] = moments_list
+        self.corr_arr[:] = mat2vec(cov2corr(cov_mats))
+        self.twiss2D_arr[:] = get_twiss2D(cov_mats)
+        self.twiss4D_arr[:] = get_twiss4D(cov_mats, self.mode)
+        angle, cx, cy = rms_ellipse_dims(cov_mats, 'x', 'y')
+        cx = 2 * cx # Get real radii instead of rms
+        cy = 2 * cy # Get real radii instead of rms
+        angle = np.degrees(angle)
+        self.realspace_arr[:] = np.stack([angle, cx, cy, np.pi*cx*cy], axis=-1)
         self._create_dfs()
         
     def read_env(self, env_params_list):
+        """Compute the statistics from the envelope parameters at each frame.
+
+        The envelope parameters are also stored in `env_params`, which
+        otherwise stays at zero (see the class docstring).
+        """
+        env_params_list = np.asarray(env_params_list)
         if not self._initialized:
             self._create_empty_arrays(env_params_list)
-        moments_list = []
-        for env_params in env_params_list:
-            a, b, ap, bp, e, f, ep, fp = env_params
-            P = np.array([[a, b], [ap, bp], [e, f], [ep, fp]])
-            Sigma = 0.25 * np.matmul(P, P.T)
-            moments_list.append(mat2vec(Sigma))
+        self.env_params_arr[:] = env_params_list
+        moments_list = mat2vec(env_to_cov(env_params_list))
         return self.read_moments(moments_list)
 
     def _create_dfs(self):
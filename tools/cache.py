@@ -0,0 +1,56 @@
+"""Helpers for on-disk caches: content hashes and directory creation.
+
+`hash_items` hashes the full contents of NumPy arrays (dtype, shape and
+data), recursing into lists, tuples and dicts, so that the key of a cached
+result changes whenever any input changes. (The `repr` of a large array is
+abbreviated with '...', so it cannot be used as a key.)
+"""
+import os
+import errno
+import hashlib
+
+import numpy as np
+
+
+def _update(sha, item):
+    if isinstance(item, np.ndarray):
+        sha.update(repr(('ndarray', item.dtype.str, item.shape)).encode('utf-8'))
+        sha.update(np.ascontiguousarray(item).tobytes())
+    elif isinstance(item, bytes):
+        sha.update('bytes{}:'.format(len(item)).encode('utf-8'))
+        sha.update(item)
+    elif isinstance(item, (list, tuple)):
+        sha.update('{}{}:'.format(type(item).__name__, len(item)).encode('utf-8'))
+        for element in item:
+            _update(sha, element)
+    elif isinstance(item, dict):
+        sha.update('dict{}:'.format(len(item)).encode('utf-8'))
+        for key in sorted(item):
+            _update(sha, key)
+            _update(sha, item[key])
+    else:
+        sha.update(repr(item).encode('utf-8'))
+    sha.update(b';')
+
+
+def hash_items(*items):
+    """Return SHA-1 hex digest of the items (see module docstring)."""
+    sha = hashlib.sha1()
+    for item in items:
+        _update(sha, item)
+    return sha.hexdigest()
+
+
+def func_name(func):
+    """Return 'module.qualified_name' of a function, for use in cache keys."""
+    name = getattr(func, '__qualname__', None) or getattr(func, '__name__', repr(func))
+    return '{}.{}'.format(getattr(func, '__module__', ''), name)
+
+
+def makedirs(directory):
+    """Create `directory` if needed; safe when several processes race."""
+    try:
+        os.makedirs(directory)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,399 @@
+"""Streaming statistics over sequences of coordinate arrays (frames).
+
+The functions here only need to iterate over the frames once, so they work
+on lazy frame sources (such as a list of memory-mapped arrays or a generator
+which loads one file at a time) that do not fit in memory. `FrameSource`
+and its subclasses provide such sources.
+"""
+import os
+import queue
+import zipfile
+import threading
+
+import numpy as np
+
+
+class AbsQuantileSketch:
+    """One-pass, mergeable quantile estimate of |values|.
+
+    The absolute values are counted in logarithmically spaced bins, with bin
+    k covering (gamma^(k-1), gamma^k] and gamma = (1 + rel_err) / (1 - rel_err).
+    Any quantile is then estimated with relative error `rel_err`, using
+    memory which grows with the log of the dynamic range of the data instead
+    of the number of values.
+
+    Attributes
+    ----------
+    rel_err : float
+        Relative accuracy of the quantile estimates.
+    count : int
+        Number of values seen.
+    max : float
+        Exact maximum absolute value.
+    """
+    def __init__(self, rel_err=0.01):
+        self.rel_err = rel_err
+        self.gamma = (1.0 + rel_err) / (1.0 - rel_err)
+        self._log_gamma = np.log(self.gamma)
+        self.count = 0
+        self.max = 0.0
+        self._zeros = 0
+        self._kmin = None
+        self._counts = np.zeros(0, dtype=np.int64)
+
+    def update(self, values):
+        """Add an array of values."""
+        values = np.abs(np.ravel(values))
+        if values.size == 0:
+            return
+        self.count += values.size
+        self.max = max(self.max, float(np.max(values)))
+        nonzero = values[values > 0]
+        self._zeros += values.size - nonzero.size
+        if nonzero.size == 0:
+            return
+        keys = np.ceil(np.log(nonzero) / self._log_gamma).astype(np.int64)
+        kmin = int(np.min(keys))
+        counts = np.bincount(keys - kmin)
+        self._add_counts(kmin, counts)
+
+    def _add_counts(self, kmin, counts):
+        if self._kmin is None:
+            self._kmin, self._counts = kmin, counts.astype(np.int64)
+            return
+        lo = min(self._kmin, kmin)
+        hi = max(self._kmin + len(self._counts), kmin + len(counts))
+        merged = np.zeros(hi - lo, dtype=np.int64)
+        merged[self._kmin - lo:self._kmin - lo + len(self._counts)] += self._counts
+        merged[kmin - lo:kmin - lo + len(counts)] += counts
+        self._kmin, self._counts = lo, merged
+
+    def merge(self, other):
+        """Add the counts of another sketch with the same `rel_err`."""
+        self.count += other.count
+        self.max = max(self.max, other.max)
+        self._zeros += other._zeros
+        if other._kmin is not None:
+            self._add_counts(other._kmin, other._counts)
+
+    def quantile(self, q):
+        """Return the estimated q-quantile (0 <= q <= 1) of |values|."""
+        if self.count == 0:
+            raise ValueError('The sketch is empty.')
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        if rank < self._zeros:
+            return 0.0
+        cumsum = np.cumsum(self._counts)
+        k = self._kmin + int(np.searchsorted(cumsum, rank - self._zeros, side='right'))
+        value = 2.0 * self.gamma**k / (self.gamma + 1.0)
+        return min(value, self.max)
+
+
+def _chunks(X, chunk_size):
+    for start in range(0, X.shape[0], chunk_size):
+        yield np.asarray(X[start:start + chunk_size])
+
+
+def stream_limits(frames, q=None, rel_err=0.01, chunk_size=1000000):
+    """Return plot limits (umax, upmax) from a sequence of frames.
+
+    Each frame is read once, in chunks of `chunk_size` rows, so neither the
+    frames nor a full frame need to be held in memory.
+
+    Parameters
+    ----------
+    frames : iterable
+        Coordinate arrays with columns [x, x', y, y'] (for example, a list
+        of memory-mapped arrays or a generator).
+    q : float or None
+        If None, return the maximum x{y} and x'{y'} of any particle in any
+        frame (same as `plotting.max_u_up_global`). Otherwise return the
+        q-quantile of |x| and |y| combined, and of |x'| and |y'| combined,
+        over all frames, such as q = 0.999. Robust to a few stray particles.
+    rel_err : float
+        Relative accuracy of the quantile estimate.
+    chunk_size : int
+        Number of rows read at a time.
+
+    Returns
+    -------
+    ndarray, shape (2,)
+    """
+    if q is None:
+        maxs = np.full(4, -np.inf)
+        for X in frames:
+            for chunk in _chunks(X, chunk_size):
+                if len(chunk):
+                    maxs = np.maximum(maxs, np.max(chunk[:, :4], axis=0))
+        return np.array([max(maxs[0], maxs[2]), max(maxs[1], maxs[3])])
+    sketches = [AbsQuantileSketch(rel_err), AbsQuantileSketch(rel_err)]
+    for X in frames:
+        for chunk in _chunks(X, chunk_size):
+            sketches[0].update(chunk[:, [0, 2]])
+            sketches[1].update(chunk[:, [1, 3]])
+    return np.array([sketch.quantile(q) for sketch in sketches])
+
+
+# Frame sources
+#------------------------------------------------------------------------------
+class FrameSource:
+    """Sequence of coordinate arrays which are loaded on demand.
+
+    Subclasses implement `__len__` and `_load(t)`, which returns the
+    coordinate array at frame t. `nparts(t)` should be overridden if the
+    number of particles can be found without loading the frame.
+    """
+    def __len__(self):
+        raise NotImplementedError
+
+    def _load(self, t):
+        raise NotImplementedError
+
+    def __getitem__(self, t):
+        if t < 0:
+            t += len(self)
+        if not 0 <= t < len(self):
+            raise IndexError('Frame {} out of range.'.format(t))
+        return self._load(t)
+
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self[t]
+
+    def nparts(self, t):
+        """Return the number of particles at frame t."""
+        return self[t].shape[0]
+
+    def select(self, frames):
+        """Return a source containing only the given frame indices."""
+        return SelectedFrames(self, frames)
+
+
+class ArrayFrames(FrameSource):
+    """Frames which are already in memory (list or ndarray)."""
+    def __init__(self, coords):
+        self.coords = coords
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _load(self, t):
+        return self.coords[t]
+
+
+class SelectedFrames(FrameSource):
+    """Subset of the frames of another source."""
+    def __init__(self, source, frames):
+        self.source = source
+        self.frames = list(frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _load(self, t):
+        return self.source[self.frames[t]]
+
+    def nparts(self, t):
+        return self.source.nparts(self.frames[t])
+
+
+def _memmap_npz_member(filename, name):
+    """Memory-map an array stored (uncompressed) in an .npz file.
+
+    Returns None if the member is compressed.
+    """
+    with zipfile.ZipFile(filename) as zfile:
+        info = zfile.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(filename, 'rb') as file:
+        # The data follows the 30-byte local file header, the file name and
+        # the extra field.
+        file.seek(info.header_offset + 26)
+        name_len, extra_len = np.frombuffer(file.read(4), dtype='<u2')
+        file.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(file)
+        else:
+            header = np.lib.format.read_array_header_2_0(file)
+        shape, fortran_order, dtype = header
+        offset = file.tell()
+    order = 'F' if fortran_order else 'C'
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order=order)
+
+
+class StackedFrames(FrameSource):
+    """Ragged frames stored as one stacked array (see `utils.stack_ragged`).
+
+    Parameters
+    ----------
+    stacked : ndarray, shape (n_total, 4)
+        The stacked coordinate arrays. Can be memory-mapped.
+    index : ndarray
+        The indices at which to split `stacked` into frames.
+    """
+    def __init__(self, stacked, index):
+        self.stacked = stacked
+        self.bounds = np.concatenate([[0], index, [stacked.shape[0]]]).astype(int)
+
+    @classmethod
+    def from_npz(cls, filename):
+        """Open a file written by `utils.save_stacked_array`.
+
+        The stacked array is memory-mapped if the file is not compressed;
+        otherwise it is loaded into memory.
+        """
+        stacked = _memmap_npz_member(filename, 'stacked_array.npy')
+        npz_file = np.load(filename)
+        if stacked is None:
+            stacked = npz_file['stacked_array']
+        return cls(stacked, npz_file['stacked_index'])
+
+    @classmethod
+    def from_dir(cls, directory):
+        """Open a directory written by the injection `SnapshotWriter`.
+
+        Contains 'stacked_array.npy' (memory-mapped) and 'stacked_index.npy'.
+        """
+        stacked = np.load(os.path.join(directory, 'stacked_array.npy'), mmap_mode='r')
+        index = np.load(os.path.join(directory, 'stacked_index.npy'))
+        return cls(stacked, index)
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def _load(self, t):
+        return self.stacked[self.bounds[t]:self.bounds[t + 1]]
+
+    def nparts(self, t):
+        return self.bounds[t + 1] - self.bounds[t]
+
+
+class FileFrames(FrameSource):
+    """One file per frame.
+
+    Parameters
+    ----------
+    filenames : list[str]
+        File name of each frame.
+    loader : callable
+        Function which loads a file. By default, .npy files are memory-mapped
+        and other files are read with `np.loadtxt`.
+    """
+    def __init__(self, filenames, loader=None):
+        self.filenames = list(filenames)
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def _load(self, t):
+        filename = self.filenames[t]
+        if self.loader is not None:
+            return self.loader(filename)
+        if filename.endswith('.npy'):
+            return np.load(filename, mmap_mode='r')
+        return np.loadtxt(filename)
+
+
+class HDF5Frames(FrameSource):
+    """Frames stored in an HDF5 file (requires h5py).
+
+    The dataset `key` has shape (n_frames, nparts, 4), or it is a stacked
+    array of shape (n_total, 4) if the dataset `index_key` (split indices, as
+    in `utils.stack_ragged`) exists.
+    """
+    def __init__(self, filename, key='coords', index_key='stacked_index'):
+        import h5py
+        self.file = h5py.File(filename, 'r')
+        self.dataset = self.file[key]
+        self.bounds = None
+        if index_key in self.file:
+            index = self.file[index_key][()]
+            self.bounds = np.concatenate([[0], index, [self.dataset.shape[0]]])
+            self.bounds = self.bounds.astype(int)
+
+    def __len__(self):
+        if self.bounds is not None:
+            return len(self.bounds) - 1
+        return self.dataset.shape[0]
+
+    def _load(self, t):
+        if self.bounds is not None:
+            return self.dataset[self.bounds[t]:self.bounds[t + 1]]
+        return self.dataset[t]
+
+    def nparts(self, t):
+        if self.bounds is not None:
+            return self.bounds[t + 1] - self.bounds[t]
+        return self.dataset.shape[1]
+
+
+def as_frames(coords):
+    """Return a FrameSource.
+
+    `coords` can be a FrameSource, a list or ndarray of coordinate arrays,
+    or a file name: '.npz' files written by `utils.save_stacked_array` and
+    snapshot directories are memory-mapped, and '.h5'/'.hdf5' files are
+    opened with `HDF5Frames`.
+    """
+    if isinstance(coords, FrameSource):
+        return coords
+    if isinstance(coords, str):
+        if os.path.isdir(coords):
+            return StackedFrames.from_dir(coords)
+        if coords.endswith('.npz'):
+            return StackedFrames.from_npz(coords)
+        if coords.endswith('.h5') or coords.endswith('.hdf5'):
+            return HDF5Frames(coords)
+        raise ValueError('Unknown file type: {}'.format(coords))
+    return ArrayFrames(coords)
+
+
+def prefetch(frames, depth=2):
+    """Iterate over frames while loading the next frames in a thread.
+
+    At most `depth` frames are held in the queue, so memory use is bounded
+    by a few frames. Frames from an in-memory source are yielded directly.
+    """
+    if depth < 1 or isinstance(frames, (ArrayFrames, list, np.ndarray)):
+        for X in frames:
+            yield X
+        return
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def load():
+        try:
+            for X in frames:
+                X = np.array(X) # read memory-mapped data in this thread
+                while not stop.is_set():
+                    try:
+                        items.put(X, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put(done)
+        except Exception as error:
+            items.put(error)
+
+    thread = threading.Thread(target=load)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
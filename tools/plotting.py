@@ -3,14 +3,18 @@ from cycler import cycler
 import numpy as np
 import pandas as pd
 import matplotlib
+import matplotlib.collections
 from matplotlib import pyplot as plt, animation, ticker
 from matplotlib.lines import Line2D
 from matplotlib.patches import Ellipse
 import seaborn as sns
 import scipy
+import scipy.ndimage
+import scipy.signal
 
 from .utils import rand_rows, is_number
 from .beam_analysis import get_ellipse_coords, rms_ellipse_dims
+from .frames import stream_limits
 
 
 _labels = [r"$x$", r"$x'$", r"$y$", r"$y'$"]
@@ -48,15 +52,17 @@ def min_u_up(X):
     return np.array([umin, upmin])
     
     
-def max_u_up_global(coords):
+def max_u_up_global(coords, q=None):
     """Get the maximum x{y} and x'{y'} extents for any frame in `coords`.
 
-    coords : ndarray, shape (nframes, nparts, 4)
-        Coordinate arrays at each frame.
+    coords : iterable, shape (nframes, nparts, 4)
+        Coordinate arrays at each frame. They are read one at a time, so a
+        lazy sequence of frames can be passed.
+    q : float or None
+        If provided, use the q-quantile of |x|, |y| (|x'|, |y'|) over all
+        frames instead of the maximum. See `frames.stream_limits`.
     """
-    u_up_local_maxes = np.array([max_u_up(X) for X in coords])
-    umax_global, upmax_global = np.max(u_up_local_maxes, axis=0)
-    return np.array([umax_global, upmax_global])
+    return stream_limits(coords, q)
     
     
 def colorcycle(cmap, nsamples=1, start_end=(0, 1)):
@@ -323,6 +329,74 @@ def setup_corner(
         plt.tight_layout(rect=[0, 0, 1.025, 0.975])
     return fig, axes
 
+
+def bin_indices(x, edges):
+    """Return the bin index of each value of `x`, offset by one.
+
+    The bins must be evenly spaced. Values below (above) the first (last)
+    edge get index 0 (n_bins + 1), so the counts of bins 1 to n_bins
+    can be taken from `np.bincount` without masking. As in `np.histogram`,
+    the last bin includes its right edge.
+    """
+    n_bins = len(edges) - 1
+    idx = (x - edges[0]) * (n_bins / (edges[-1] - edges[0]))
+    np.floor(idx, out=idx)
+    idx += 1
+    np.clip(idx, 0, n_bins + 1, out=idx)
+    idx = idx.astype(np.intp)
+    idx[x == edges[-1]] = n_bins
+    return idx
+
+
+def binned_projections(X, edges):
+    """Histogram every 1D and 2D projection of the coordinate array.
+
+    Each column of `X` is binned once; the 2D histograms are computed from
+    the stored bin indices with `np.bincount`.
+
+    Parameters
+    ----------
+    X : ndarray, shape (nparts, n)
+        Coordinate array.
+    edges : list[ndarray], length n
+        Evenly spaced bin edges for each column.
+
+    Returns
+    -------
+    hists_1D : list[ndarray]
+        The 1D histogram of each column.
+    hists_2D : dict
+        hists_2D[(i, j)] is the histogram of column i vs. column j (i > j),
+        with shape (len(edges[j]) - 1, len(edges[i]) - 1).
+    """
+    n = X.shape[1]
+    idx = [bin_indices(X[:, i], edges[i]) for i in range(n)]
+    size = [len(e) + 1 for e in edges] # including the two overflow bins
+    hists_1D = [np.bincount(idx[i], minlength=size[i])[1:-1] for i in range(n)]
+    hists_2D = {}
+    for i in range(n):
+        for j in range(i):
+            H = np.bincount(idx[j] * size[i] + idx[i],
+                            minlength=size[j] * size[i])
+            hists_2D[(i, j)] = H.reshape(size[j], size[i])[1:-1, 1:-1]
+    return hists_1D, hists_2D
+
+
+def density(ax, H, xedges, yedges, log=False, **kws):
+    """Plot 2D histogram H[x, y] with `imshow`.
+
+    Empty bins are left blank. If `log` is True, use a logarithmic color
+    scale.
+    """
+    kws.setdefault('cmap', 'viridis')
+    kws.setdefault('interpolation', 'nearest')
+    kws.setdefault('aspect', 'auto')
+    H = np.ma.masked_less_equal(H.T, 0)
+    if log:
+        kws.setdefault('norm', matplotlib.colors.LogNorm())
+    extent = (xedges[0], xedges[-1], yedges[0], yedges[-1])
+    return ax.imshow(H, origin='lower', extent=extent, **kws)
+
     
 def corner(
     X, env_params=None, moments=False, limits=None, zero_center=True,
@@ -358,6 +432,7 @@ def corner(
         plot window on the projected means of the distribution.
     samples : int
         The number of randomly sampled points to use in the scatter plots.
+        Not used if `kind='hist'`.
     pad : float
         Padding for the axis ranges: umax_new = (1 + pad) * 0.5 * w, where w is
         the width of the distribution (max - min).
@@ -368,8 +443,11 @@ def corner(
         If 'all', plot all 6 phase space projections. Otherwise provide a tuple
         like ('x', 'yp') which plots x vs. y'.
     kind : {'scatter', 'scatter_density', 'hist', 'kde'}
-        The kind of plot to make on the off-diagonal subplots. Note: the 'kde'
-        and 'hist' options are not implemented yet.
+        The kind of plot to make on the off-diagonal subplots. If 'hist', all
+        particles are binned on a grid which spans the plot windows (the same
+        edges are used for x and y and for x' and y') and the density is
+        drawn with `imshow`; the diagonal histograms use the same bins. Note:
+        the 'kde' option is not implemented yet.
     diag_kind : {'hist', 'kde', 'none'}
         The kind of plot to make on the diagonal subplots. If 'none', these are
         excluded and a 3x3 grid is produced.
@@ -390,7 +468,9 @@ def corner(
         Key word arguments. They are passed to the following functions:
         * plt_kws  : `plt.scatter`. This doesn't need to be passed as a dict.
                      For example, `s=10` can be added to the function call to
-                     change the marker size.
+                     change the marker size. If `kind='hist'`, they are
+                     passed to `plt.imshow`, except for 'bins' (number of
+                     bins, default 100) and 'log' (log color scale).
         * diag_kws : `plt.hist`. More options will be added in the future like
                      kde.
         * env_kws  : `plt.plot`. For plotting the envelope ellipses.
@@ -426,9 +506,15 @@ def corner(
     env_kws.setdefault('lw', 1)
     env_kws.setdefault('zorder', 6)
     text_kws.setdefault('horizontalalignment', 'center')
+    if kind == 'hist':
+        bins = plt_kws.pop('bins', 100)
+        log = plt_kws.pop('log', False)
     
     # Get data
-    X_samp = rand_rows(X, samples) # sample of particles for scatter plots
+    if kind == 'hist':
+        X_samp = None
+    else:
+        X_samp = rand_rows(X, samples) # sample of particles for scatter plots
     X_env = None
     if env_params is not None:
         X_env = get_ellipse_coords(env_params, npts=100)
@@ -466,6 +552,12 @@ def corner(
             _limits.append(limits[1])
         limits = _limits
         
+    # Bin the particles on a grid spanning the plot windows.
+    if kind == 'hist':
+        edges = 2 * [np.linspace(lo, hi, bins + 1) for (lo, hi) in limits]
+        if dims == 'all':
+            hists_1D, hists_2D = binned_projections(X, edges)
+        
     # Create figure
     fig, axes = setup_corner(
         limits, figsize, norm_labels, units, dims=dims, plt_diag=plt_diag,
@@ -475,8 +567,12 @@ def corner(
     # Single particle
     if dims != 'all':
         j, i = [var_indices[dim] for dim in dims]
-        x, y = X_samp[:, j], X_samp[:, i]
         ax = axes
+        if kind == 'hist':
+            _, hists_2D = binned_projections(X[:, [j, i]], [edges[j], edges[i]])
+            density(ax, hists_2D[(1, 0)], edges[j], edges[i], log, **plt_kws)
+        else:
+            x, y = X_samp[:, j], X_samp[:, i]
         if kind == 'scatter':
             ax.scatter(x, y, **plt_kws)
         elif kind == 'scatter_density':
@@ -495,7 +591,11 @@ def corner(
                 ind = np.linspace(-lim, lim, 1000)
                 ax.plot(ind, gkde.evaluate(ind), **diag_kws)
             elif diag_kind == 'hist':
-                g = ax.hist(data, **diag_kws)
+                if kind == 'hist':
+                    diag_kws['bins'] = edges[i]
+                    g = ax.hist(edges[i][:-1], weights=hists_1D[i], **diag_kws)
+                else:
+                    g = ax.hist(data, **diag_kws)
         # Change height
         top_left_ax = axes[0, 0]
         new_ylim = (1.0 / hist_height) * top_left_ax.get_ylim()[1]
@@ -507,13 +607,15 @@ def corner(
     for i in range(3):
         for j in range(i + 1):
             ax = scatter_axes[i, j]
-            x, y = X_samp[:, j], X_samp[:, i+1]
+            if kind == 'hist':
+                density(ax, hists_2D[(i + 1, j)], edges[j], edges[i+1], log,
+                        **plt_kws)
+            else:
+                x, y = X_samp[:, j], X_samp[:, i+1]
             if kind == 'scatter':
                 ax.scatter(x, y, **plt_kws)
             elif kind == 'scatter_density':
                 scatter_density(ax, x, y, **plt_kws)
-            elif kind == 'hist':
-                ax.hist2d(x, y, **plt_kws)
             if X_env is not None:
                 ax.plot(X_env[:, j], X_env[:, i+1], **env_kws)
     if moments:
@@ -585,7 +687,7 @@ def corner_env(
         params = np.array(params)
     if params.ndim == 1:
         params = params[np.newaxis, :]
-    coords = [get_ellipse_coords(p, npts=100) for p in params]
+    coords = get_ellipse_coords(params, npts=100)
     limits = (1 + pad) * max_u_up_global(coords)
     
     # Set default key word arguments
@@ -674,14 +776,61 @@ def fft(ax, x, y, grid=True, figname=None):
     return ax
 
 
-def scatter_density(ax, x, y, **kws):
+def point_density(x, y, bins=128, smooth=1.0):
+    """Approximate density of 2D points, evaluated at each point.
+
+    The points are binned on a `bins` x `bins` grid, the grid is smoothed
+    by convolution (FFT) with a Gaussian kernel, and the result is
+    interpolated back to the points. The cost is O(N + G log G), where G is
+    the number of grid cells. Increase `bins` (and decrease `smooth`) for
+    better resolution.
+
+    Parameters
+    ----------
+    x, y : ndarray, shape (N,)
+        Point coordinates.
+    bins : int
+        Number of grid cells along each dimension.
+    smooth : float
+        Standard deviation of the Gaussian kernel in units of grid cells. No
+        smoothing is done if zero.
+
+    Returns
+    -------
+    ndarray, shape (N,)
+        The (unnormalized) density at each point.
+    """
+    coords = []
+    for u in (x, y):
+        umin, umax = np.min(u), np.max(u)
+        scale = bins / (umax - umin) if umax > umin else 1.0
+        coords.append((u - umin) * scale)
+    idx = [np.clip(c.astype(np.intp), 0, bins - 1) for c in coords]
+    H = np.bincount(idx[0] * bins + idx[1], minlength=bins**2)
+    H = H.reshape(bins, bins).astype(float)
+    if smooth > 0:
+        half = int(np.ceil(4 * smooth))
+        t = np.arange(-half, half + 1)
+        kernel = np.exp(-0.5 * (t / smooth)**2)
+        H = scipy.signal.fftconvolve(H, np.outer(kernel, kernel), mode='same')
+    # Grid values are located at the cell centers.
+    return scipy.ndimage.map_coordinates(H, [c - 0.5 for c in coords],
+                                         order=1, mode='nearest')
+
+
+def scatter_density(ax, x, y, bins=128, smooth=1.0, exact=False, **kws):
     """Scatter plot with color weighted by density.
-    
-    Taken from StackOverflow answer by Joe Kington: 'https://stackoverflow.com/questions/20105364/how-can-i-make-a-scatter-plot-colored-by-density-in-matplotlib'
+
+    The density is computed with `point_density`. If `exact` is True,
+    `scipy.stats.gaussian_kde` is evaluated at every point instead, which is
+    O(N^2). Taken from StackOverflow answer by Joe Kington: 'https://stackoverflow.com/questions/20105364/how-can-i-make-a-scatter-plot-colored-by-density-in-matplotlib'
     """
     # Calculate the point density
-    xy = np.vstack([x, y])
-    z = scipy.stats.gaussian_kde(xy)(xy)
+    if exact:
+        xy = np.vstack([x, y])
+        z = scipy.stats.gaussian_kde(xy)(xy)
+    else:
+        z = point_density(x, y, bins, smooth)
 
     # Sort the points by density, so that the densest points are plotted last
     idx = z.argsort()
@@ -791,8 +940,46 @@ def ellipse(ax, c1, c2, angle=0.0, **plt_kws):
     return ax
 
 
+def ellipses(ax, c1, c2, angles=0.0, **plt_kws):
+    """Plot many origin-centered ellipses as a single `EllipseCollection`.
+
+    `c1`, `c2` and `angles` are arrays of semi-axes and angles, with the
+    same meaning as in `ellipse`. `plt_kws` accepts the usual patch key
+    words ('color', 'ec', 'fc', 'lw', 'ls', 'fill', ...).
+    """
+    c1, c2, angles = np.broadcast_arrays(np.ravel(c1), np.ravel(c2),
+                                         np.ravel(angles))
+    plt_kws = dict(plt_kws)
+    fill = plt_kws.pop('fill', False)
+    color = plt_kws.pop('color', plt_kws.pop('c', None))
+    ec = plt_kws.pop('ec', plt_kws.pop('edgecolor', color))
+    fc = plt_kws.pop('fc', plt_kws.pop('facecolor', color))
+    lw = plt_kws.pop('lw', plt_kws.pop('linewidth', None))
+    ls = plt_kws.pop('ls', plt_kws.pop('linestyle', None))
+    coll_kws = {'edgecolors': 'k' if ec is None else ec,
+                'facecolors': (fc if fc is not None else 'C0') if fill else 'none'}
+    if lw is not None:
+        coll_kws['linewidths'] = lw
+    if ls is not None:
+        coll_kws['linestyles'] = ls
+    if hasattr(matplotlib.collections.Collection, 'set_offset_transform'):
+        coll_kws['offset_transform'] = ax.transData
+    else:
+        coll_kws['transOffset'] = ax.transData
+    coll_kws.update(plt_kws)
+    collection = matplotlib.collections.EllipseCollection(
+        2 * c1, 2 * c2, -np.degrees(angles), units='xy',
+        offsets=np.zeros((len(c1), 2)), **coll_kws)
+    ax.add_collection(collection, autolim=False)
+    return collection
+
+
 def rms_ellipses(Sigmas, figsize=(5, 5), pad=0.5, axes=None, **plt_kws):
-    """Plot rms ellipse parameters directly from covariance matrix."""
+    """Plot rms ellipse parameters directly from covariance matrix.
+
+    The ellipse dimensions of all covariance matrices are computed at once,
+    and the ellipses in each subplot are drawn as one collection.
+    """
     Sigmas = np.array(Sigmas)
     if Sigmas.ndim == 2:
         Sigmas = Sigmas[np.newaxis, :, :]
@@ -803,9 +990,8 @@ def rms_ellipses(Sigmas, figsize=(5, 5), pad=0.5, axes=None, **plt_kws):
         upmax = (1 + pad) * 2 * np.sqrt(max(xp2_max, yp2_max))
         fig, axes = setup_corner((umax, upmax), figsize, units='mm-mrad')
     dims = {0:'x', 1:'xp', 2:'y', 3:'yp'}
-    for Sigma in Sigmas:
-        for i in range(3):
-            for j in range(i + 1):
-                angle, c1, c2 = rms_ellipse_dims(Sigma, dims[j], dims[i + 1])
-                ellipse(axes[i, j], 2*c1, 2*c2, angle, **plt_kws)
+    for i in range(3):
+        for j in range(i + 1):
+            angle, c1, c2 = rms_ellipse_dims(Sigmas, dims[j], dims[i + 1])
+            ellipses(axes[i, j], 2*c1, 2*c2, angle, **plt_kws)
     return axes
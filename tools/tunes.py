@@ -0,0 +1,215 @@
+"""Tune analysis of turn-by-turn data.
+
+The functions here act on turn-by-turn arrays with the turn number along the
+first axis, for example `coords` with shape (n_turns, nparts, 4), so that
+the tunes of every particle in a bunch are computed with one batched FFT.
+The raw FFT peak only gives the tune to within 1 / n_turns; it is refined
+either by interpolating between the FFT bins (Hann window), or by maximizing
+the windowed Fourier amplitude near the peak (NAFF, fundamental frequency
+only). For a pure sinusoid the two methods give errors of the same size,
+which are limited by leakage from the negative-frequency image of the
+signal; NAFF is slower, so `fft_tunes` is usually enough.
+"""
+import numpy as np
+
+
+def window_func(n, window='hann'):
+    """Return the window function evaluated at turns 0, ..., n - 1."""
+    if window is None:
+        return np.ones(n)
+    if window == 'hann':
+        return 0.5 * (1.0 - np.cos(2.0 * np.pi * np.arange(n) / n))
+    raise ValueError("Unknown window '{}'.".format(window))
+
+
+def _prepare(x, window):
+    x = np.asarray(x, dtype=float)
+    w = window_func(x.shape[0], window).reshape((-1,) + (1,) * (x.ndim - 1))
+    return (x - np.mean(x, axis=0)) * w
+
+
+def fft_tunes(x, window='hann'):
+    """Return fractional tunes from interpolated FFT peaks.
+
+    Parameters
+    ----------
+    x : ndarray, shape (n_turns, ...)
+        Real turn-by-turn signal(s), such as x[turn, particle].
+    window : {'hann', None}
+        Window function. The interpolation formula depends on the window.
+
+    Returns
+    -------
+    ndarray, shape (...)
+        Fractional tunes in the range [0, 0.5].
+    """
+    n = np.shape(x)[0]
+    amps = np.abs(np.fft.rfft(_prepare(x, window), axis=0))
+    amps[0] = 0.0
+    k = np.argmax(amps, axis=0)
+    k = np.clip(k, 1, amps.shape[0] - 2)[np.newaxis]
+    a = np.take_along_axis(amps, k, axis=0)[0]
+    a_left = np.take_along_axis(amps, k - 1, axis=0)[0]
+    a_right = np.take_along_axis(amps, k + 1, axis=0)[0]
+    right = a_right >= a_left
+    a_nb = np.where(right, a_right, a_left)
+    sign = np.where(right, 1.0, -1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if window == 'hann':
+            delta = (2.0 * a_nb - a) / (a + a_nb)
+        else:
+            delta = a_nb / (a + a_nb)
+    delta = np.nan_to_num(delta)
+    return (k[0] + sign * delta) / n
+
+
+def naff_tunes(x, window='hann', n_iter=30, chunk_size=None):
+    """Return fractional tunes by maximizing the windowed Fourier amplitude.
+
+    The starting point is `fft_tunes`. The amplitude
+    |sum_t w(t) x(t) exp(-2 pi i nu t)| is then maximized within one FFT bin
+    of the starting point by golden-section search, which is done for all
+    signals at once.
+
+    Parameters
+    ----------
+    x : ndarray, shape (n_turns, ...)
+        Real turn-by-turn signal(s).
+    window : {'hann', None}
+        Window function.
+    n_iter : int
+        Number of golden-section iterations. The bracket shrinks by 0.618
+        per iteration, starting from a width of 2 / n_turns.
+    chunk_size : int or None
+        Number of signals processed at a time (limits memory use). If None,
+        chosen so that each chunk holds about 10^7 samples.
+
+    Returns
+    -------
+    ndarray, shape (...)
+    """
+    xw = _prepare(x, window)
+    shape = xw.shape[1:]
+    n = xw.shape[0]
+    xw = xw.reshape(n, -1)
+    nu0 = fft_tunes(x, window).ravel()
+    if chunk_size is None:
+        chunk_size = max(1, 10000000 // n)
+    turns = np.arange(n)[:, np.newaxis]
+    invphi = 0.5 * (np.sqrt(5.0) - 1.0)
+    tunes = np.empty_like(nu0)
+    for start in range(0, xw.shape[1], chunk_size):
+        cols = slice(start, start + chunk_size)
+        xc = xw[:, cols]
+
+        def amp(nu):
+            phase = np.exp(-2j * np.pi * turns * nu)
+            return np.abs(np.sum(xc * phase, axis=0))
+
+        lo, hi = nu0[cols] - 1.0 / n, nu0[cols] + 1.0 / n
+        c = hi - invphi * (hi - lo)
+        d = lo + invphi * (hi - lo)
+        fc, fd = amp(c), amp(d)
+        for _ in range(n_iter):
+            left = fc > fd
+            hi = np.where(left, d, hi)
+            lo = np.where(left, lo, c)
+            # One interior point is kept; the other is the only new
+            # evaluation.
+            new = np.where(left, hi - invphi * (hi - lo), lo + invphi * (hi - lo))
+            f_new = amp(new)
+            c, d = np.where(left, new, d), np.where(left, c, new)
+            fc, fd = np.where(left, f_new, fd), np.where(left, fc, f_new)
+        tunes[cols] = 0.5 * (lo + hi)
+    return np.abs(tunes).reshape(shape)
+
+
+def tunes(coords, method='fft', window='hann', **kws):
+    """Return the horizontal and vertical tunes of every particle.
+
+    Parameters
+    ----------
+    coords : ndarray, shape (n_turns, nparts, 4)
+        Turn-by-turn coordinates [x, x', y, y'].
+    method : {'fft', 'naff'}
+        Use `fft_tunes` or `naff_tunes`.
+    window : {'hann', None}
+        Window function.
+    **kws
+        Key word arguments passed to `naff_tunes`.
+
+    Returns
+    -------
+    ndarray, shape (nparts, 2)
+        The fractional tunes (nux, nuy) in the range [0, 0.5].
+    """
+    coords = np.asarray(coords)
+    signals = coords[..., [0, 2]]
+    if method == 'fft':
+        return fft_tunes(signals, window)
+    elif method == 'naff':
+        return naff_tunes(signals, window, **kws)
+    raise ValueError("Unknown method '{}'.".format(method))
+
+
+def sliding_tunes(coords, n_window, step=None, method='fft', window='hann',
+                  **kws):
+    """Return the tunes in sliding windows of `n_window` turns.
+
+    The windows of all particles are gathered into one array, so that
+    (in the case of 'fft') they are analyzed with a single batched FFT.
+
+    Parameters
+    ----------
+    coords : ndarray, shape (n_turns, nparts, 4)
+        Turn-by-turn coordinates.
+    n_window : int
+        Number of turns in each window.
+    step : int
+        Number of turns between the starts of consecutive windows. Defaults
+        to `n_window` (non-overlapping windows).
+    method, window, **kws
+        See `tunes`.
+
+    Returns
+    -------
+    ndarray, shape (n_windows, nparts, 2)
+    """
+    if step is None:
+        step = n_window
+    signals = np.asarray(coords)[..., [0, 2]]
+    n_turns = signals.shape[0]
+    starts = np.arange(0, n_turns - n_window + 1, step)
+    idx = starts[np.newaxis, :] + np.arange(n_window)[:, np.newaxis]
+    windows = signals[idx] # (n_window, n_windows, nparts, 2)
+    if method == 'fft':
+        return fft_tunes(windows, window)
+    elif method == 'naff':
+        return naff_tunes(windows, window, **kws)
+    raise ValueError("Unknown method '{}'.".format(method))
+
+
+def diffusion(coords, method='fft', window='hann', **kws):
+    """Return the tune diffusion index of every particle.
+
+    The tunes are computed in the first and second halves of the data. The
+    diffusion index is d = log10(sqrt(dnux^2 + dnuy^2)), where dnux and dnuy
+    are the changes in tune. Regular orbits have d close to the accuracy of
+    the tune estimate (very negative); chaotic orbits have larger d.
+
+    Parameters
+    ----------
+    coords : ndarray, shape (n_turns, nparts, 4)
+        Turn-by-turn coordinates.
+    method, window, **kws
+        See `tunes`.
+
+    Returns
+    -------
+    ndarray, shape (nparts,)
+    """
+    n_window = np.shape(coords)[0] // 2
+    nu = sliding_tunes(coords, n_window, n_window, method, window, **kws)
+    dnu = nu[1] - nu[0]
+    with np.errstate(divide='ignore'):
+        return np.log10(np.sqrt(np.sum(dnu**2, axis=-1)))
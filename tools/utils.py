@@ -141,15 +141,94 @@ def symmetrize(M):
     return M + M.T - np.diag(M.diagonal())
     
     
-def rand_rows(X, n):
-    """Return n random elements of X."""
-    Xsamp = np.copy(X)
-    if n < len(X):
-        idx = np.random.choice(Xsamp.shape[0], n, replace=False)
-        Xsamp = Xsamp[idx]
+def _get_rng(rng):
+    if rng is None:
+        return np.random
+    if isinstance(rng, (int, np.integer)):
+        return np.random.RandomState(rng)
+    return rng
+
+
+def rand_indices(n, k, rng=None):
+    """Return k distinct random integers from range(n), sorted.
+
+    Indices are drawn with replacement and duplicates are redrawn, so the
+    expected cost is O(k log k) rather than O(n) when k << n. If k > n / 2,
+    a random permutation is used instead.
+
+    Parameters
+    ----------
+    n, k : int
+        Population size and sample size.
+    rng : int, np.random.RandomState, np.random.Generator, or None
+        Random seed or generator. If None, use the global NumPy random state.
+    """
+    rng = _get_rng(rng)
+    if k >= n:
+        return np.arange(n)
+    draw = getattr(rng, 'integers', None) or rng.randint
+    if 2 * k > n:
+        return np.sort(rng.permutation(n)[:k])
+    idx = np.unique(draw(0, n, size=k))
+    while len(idx) < k:
+        extra = draw(0, n, size=k - len(idx))
+        idx = np.unique(np.concatenate([idx, extra]))
+    return idx
+
+
+def rand_rows(X, n, rng=None):
+    """Return a copy of n random rows of X, in random order.
+
+    If n >= len(X), a copy of X is returned. Otherwise only the sampled rows
+    are read (in sorted order, which is faster for memory-mapped arrays) and
+    then shuffled. See `rand_indices` for `rng`.
+    """
+    if n >= len(X):
+        return np.array(X)
+    rng = _get_rng(rng)
+    Xsamp = X[rand_indices(len(X), n, rng)]
+    rng.shuffle(Xsamp)
     return Xsamp
 
 
+def consistent_samples(nparts_list, n, seed=None):
+    """Return row indices of a random sample of n particles for each frame.
+
+    Row i is assumed to hold the same particle in every frame, with new
+    particles added to the end of the array (as in injection painting). Each
+    particle is given a random priority and the n particles with lowest
+    priority are kept in each frame (bottom-k sampling). Thus the same
+    particles are followed from frame to frame; a sampled particle is only
+    replaced when a new particle with lower priority appears.
+
+    Parameters
+    ----------
+    nparts_list : list[int]
+        Number of particles in each frame.
+    n : int
+        Sample size.
+    seed : int or None
+        Random seed.
+
+    Returns
+    -------
+    list[ndarray]
+        Sorted row indices for each frame.
+    """
+    priority = np.random.RandomState(seed).random_sample(max(nparts_list))
+    idx_list = []
+    idx, last = None, None
+    for nparts in nparts_list:
+        if nparts != last:
+            if n >= nparts:
+                idx = np.arange(nparts)
+            else:
+                idx = np.sort(np.argpartition(priority[:nparts], n)[:n])
+            last = nparts
+        idx_list.append(idx)
+    return idx_list
+
+
 def mat2vec(Sigma):
     """Return vector of independent elements in 4x4 symmetric matrix Sigma."""
     return Sigma[np.triu_indices(4)]
@@ -195,11 +274,13 @@ def load_stacked_arrays(filename, axis=0):
 
 # Math
 def cov2corr(cov_mat):
-    """Form correlation matrix from covariance matrix."""
-    D = np.sqrt(np.diag(cov_mat.diagonal()))
-    Dinv = la.inv(D)
-    corr_mat = la.multi_dot([Dinv, cov_mat, Dinv])
-    return corr_mat
+    """Form correlation matrix from covariance matrix.
+
+    `cov_mat` can also have shape (..., n, n).
+    """
+    cov_mat = np.asarray(cov_mat)
+    d = np.sqrt(np.diagonal(cov_mat, axis1=-2, axis2=-1))
+    return cov_mat / (d[..., :, np.newaxis] * d[..., np.newaxis, :])
     
     
 def rotation_matrix(angle):